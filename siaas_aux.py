@@ -10,13 +10,83 @@ import sys
 import re
 import json
 import socket
-from copy import copy
+import base64
+import hashlib
+import time
+import mmap
+import struct
+import zlib
+import threading
+import fcntl
+from concurrent.futures import ProcessPoolExecutor
+from copy import copy, deepcopy
 from datetime import datetime, timedelta
-from pymongo import MongoClient
+from itertools import repeat
+from bson.objectid import ObjectId
+from pymongo import MongoClient, ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError
 from urllib.parse import quote_plus
 
 logger = logging.getLogger(__name__)
 
+# MongoDB indexes managed by the server, matching the query shapes used in this module (scope + origin/destiny, sorted by _id)
+MONGODB_INDEXES = [
+    {"name": "scope_origin_id_index", "keys": [
+        ("scope", 1), ("origin", 1), ("_id", -1)]},
+    {"name": "scope_destiny_id_index", "keys": [
+        ("scope", 1), ("destiny", 1), ("_id", -1)]},
+    {"name": "scope_id_index", "keys": [("scope", 1), ("_id", -1)]},
+    {"name": "scope_timestamp_index", "keys": [("scope", 1), ("timestamp", 1)],
+     "partialFilterExpression": {"payload": {"$exists": True}}},
+    {"name": "scope_last_seen_index", "keys": [
+        ("scope", 1), ("last_seen", -1)]},
+    {"name": "scope_last_stored_index", "keys": [("scope", 1), ("last_stored", 1)],
+     "partialFilterExpression": {"last_stored": {"$exists": True}}},
+    # One current snapshot and one registry record per agent (partial filters only take equality before MongoDB 6.0, hence one index per scope)
+    {"name": "agent_data_current_origin_unique_index", "keys": [("scope", 1), ("origin", 1)], "unique": True,
+     "partialFilterExpression": {"scope": "agent_data_current"}},
+    {"name": "agent_registry_origin_unique_index", "keys": [("scope", 1), ("origin", 1)], "unique": True,
+     "partialFilterExpression": {"scope": "agent_registry"}},
+]
+
+# Indexes from older versions, superseded by the ones above
+MONGODB_OBSOLETE_INDEXES = ["agent_origin_index",
+                            "agent_destiny_index", "agent_timestamp_index"]
+
+# Indexes for the vulnerability index collection ('<collection>_vulns')
+MONGODB_VULNS_INDEXES = [
+    {"name": "origin_data_id_index", "keys": [("origin", 1), ("data_id", 1)]},
+    {"name": "origin_id_index", "keys": [("origin", 1), ("_id", -1)]},
+    {"name": "type_exploit_id_index", "keys": [
+        ("type", 1), ("exploit", 1), ("_id", -1)]},
+    {"name": "target_host_id_index", "keys": [
+        ("target_host", 1), ("_id", -1)]},
+    {"name": "vuln_id_index", "keys": [("vuln_id", 1)]},
+]
+
+# Parsed configuration DBs, by file path, with the (mtime, inode, size) of the file they were read from
+CONFIG_DB_CACHE = {}
+
+# Local state store: shared memory segments holding the latest snapshot of local DBs, by file path
+# Segments are anonymous shared mappings, so they must be created before the server forks its module processes
+LOCAL_STATE_STORE = {}
+LOCAL_STATE_HEADER = struct.Struct("=QQI")  # version, length, CRC32 of the snapshot
+LOCAL_STATE_TOO_LARGE = 0xFFFFFFFFFFFFFFFF  # length marker for snapshots that didn't fit the segment
+
+# Config ETags computed by this process, by (scope, agent UIDs, merge broadcast)
+# They are valid while no configs are written by this process (generation) and for a while after they were checked against the DB
+CONFIG_ETAG_CACHE = {}
+CONFIG_GENERATION = 0
+CONFIG_GENERATION_LOCK = threading.Lock()
+
+# Version (record ID and version) and payload hash of the server configs last merged into the local configs DB by this process, and when they were last checked
+SERVER_CONFIGS_STATE = {"version": None, "payload_hash": None,
+                        "generation": None, "checked": 0}
+SERVER_CONFIGS_LOCK = threading.Lock()
+
+# Collection holding the agent data history, by full name of the main collection (the storage mode is only checked once per process)
+HISTORY_COLLECTIONS = {}
+
 
 def merge_module_dicts(modules=""):
     """
@@ -31,6 +101,8 @@ def merge_module_dicts(modules=""):
             module_dict = read_from_local_file(
                 os.path.join(sys.path[0], 'var/'+str(module)+'.db'))
             if module_dict != None:
+                if isinstance(module_dict, dict):
+                    module_dict = dict(module_dict)  # might be a shared snapshot
                 next_dict_to_merge[module] = module_dict
                 merged_dict = dict(
                     list(merged_dict.items())+list(next_dict_to_merge.items()))
@@ -55,7 +127,7 @@ def merge_configs_from_upstream(local_dict=os.path.join(sys.path[0], 'var/config
     local_config_dict = {}
     merged_config_dict = {}
     delta_dict = {}
-    protected_configs = ["log_level", "mongo_collection", "mongo_db",
+    protected_configs = ["log_level", "mongo_collection", "mongo_db", "mongo_history_timeseries",
                          "mongo_host", "mongo_port", "mongo_pwd", "mongo_user"]
     try:
         local_config_dict = get_config_from_configs_db(local_dict=local_dict)
@@ -92,7 +164,7 @@ def get_config_from_configs_db(local_dict=os.path.join(sys.path[0], 'var/config.
     if config_name == None:
 
         logger.debug("Getting configuration dictionary from local DB ...")
-        config_dict = read_from_local_file(
+        config_dict = read_config_db_cached(
             local_dict)
         if not isinstance(config_dict, dict):
             logger.error(
@@ -105,7 +177,7 @@ def get_config_from_configs_db(local_dict=os.path.join(sys.path[0], 'var/config.
                     out_dict[k] = str(config_dict[k])
                 else:
                     out_dict[k] = config_dict[k]
-            return config_dict
+            return dict(config_dict)
 
         logger.error("Couldn't get configuration dictionary from local DB.")
         return {}
@@ -114,7 +186,7 @@ def get_config_from_configs_db(local_dict=os.path.join(sys.path[0], 'var/config.
 
         logger.debug("Getting configuration value '" +
                      config_name+"' from local DB ...")
-        config_dict = read_from_local_file(
+        config_dict = read_config_db_cached(
             local_dict)
         if not isinstance(config_dict, dict):
             logger.error(
@@ -132,6 +204,51 @@ def get_config_from_configs_db(local_dict=os.path.join(sys.path[0], 'var/config.
         return None
 
 
+def read_config_db_cached(local_dict=os.path.join(sys.path[0], 'var/config.db')):
+    """
+    Reads a configuration DB (dict) from a local file, keeping the parsed dict in memory
+    The file is only read and parsed again when its mtime, inode or size change
+    If the file has a snapshot published in the local state store, it is read from there instead
+    Returns None if it failed
+    """
+    config_dict = read_from_local_state(local_dict)
+    if config_dict != None:
+        return config_dict
+
+    try:
+        file_stat = os.stat(local_dict)
+    except Exception as e:
+        logger.error("There was an error reading from local file " +
+                     local_dict+": "+str(e))
+        return None
+    file_version = (file_stat.st_mtime_ns,
+                    file_stat.st_ino, file_stat.st_size)
+
+    if local_dict in CONFIG_DB_CACHE.keys():
+        cached_version, cached_dict = CONFIG_DB_CACHE[local_dict]
+        if cached_version == file_version:
+            return cached_dict
+
+    logger.debug("Reading configuration DB from local file " +
+                 local_dict+" ...")
+    read_time_ns = time.time_ns()
+    try:
+        with open(local_dict, 'r') as file:
+            config_dict = json.loads(file.read())
+    except Exception as e:
+        logger.error("There was an error reading from local file " +
+                     local_dict+": "+str(e))
+        return None
+
+    # If the file was modified within the same clock tick as this read, a later write could go unnoticed with the same mtime, so don't cache it yet
+    if file_stat.st_mtime_ns < read_time_ns - 1000000000:
+        CONFIG_DB_CACHE[local_dict] = (file_version, config_dict)
+    else:
+        CONFIG_DB_CACHE.pop(local_dict, None)
+
+    return config_dict
+
+
 def write_config_db_from_conf_file(conf_file=os.path.join(sys.path[0], 'conf/siaas_server.cnf'), output=os.path.join(sys.path[0], 'var/config.db')):
     """
     Writes the configuration DB (dict) from the config file. If the file is empty or does not exist, returns False
@@ -199,6 +316,70 @@ def get_dict_current_server_configs(collection):
     return out_dict
 
 
+def get_server_configs_version(collection):
+    """
+    Reads the version of the current server configs, without reading the payload
+    The version is made of the record ID and its version counter, so it also changes if the configs are deleted and created again
+    Returns the version string (None if there are no server configs). Returns False if data can't be read
+    """
+    try:
+        results = list(collection.find(
+            {'$and': [{"payload": {'$exists': True}}, {
+                "scope": "server_configs"}, {"destiny": "server"}]}, {"_id": 1, "version": 1}
+        ).sort('_id', -1).limit(1))
+    except Exception as e:
+        logger.error("Can't read data from the DB server: "+str(e))
+        return False
+
+    if len(results) == 0:
+        return None
+    return str(results[0]["_id"])+":"+str(results[0].get("version", 0))
+
+
+def refresh_server_configs(collection):
+    """
+    Merges the server configs from the DB into the local configs DB, only if they have changed since the last merge made by this process
+    The version is checked without reading the payload, and at most once every 'api_configs_etag_revalidate_sec' seconds while no configs are written by this process
+    The local configs DB is only rewritten if the payload itself has changed
+    Returns True if all OK (or nothing to do); False if NOK
+    """
+    try:
+        revalidate_sec = int(get_config_from_configs_db(
+            config_name="api_configs_etag_revalidate_sec"))
+    except:
+        revalidate_sec = 60
+
+    with SERVER_CONFIGS_LOCK:
+        generation = CONFIG_GENERATION
+        if SERVER_CONFIGS_STATE["generation"] == generation and time.monotonic() - SERVER_CONFIGS_STATE["checked"] < revalidate_sec:
+            return True
+
+        version = get_server_configs_version(collection)
+        if type(version) == bool and version == False:
+            return False
+        if version != None and version == SERVER_CONFIGS_STATE["version"]:
+            SERVER_CONFIGS_STATE["generation"] = generation
+            SERVER_CONFIGS_STATE["checked"] = time.monotonic()
+            return True
+
+        upstream_dict = get_dict_current_server_configs(collection)
+        if type(upstream_dict) == bool and upstream_dict == False:
+            return False
+        payload_hash = get_payload_hash(upstream_dict)
+        if payload_hash != SERVER_CONFIGS_STATE["payload_hash"]:
+            logger.debug("Server configs have changed (version " +
+                         str(version)+"). Merging them into the local configs ...")
+            if not merge_configs_from_upstream(upstream_dict=upstream_dict):
+                return False
+
+        SERVER_CONFIGS_STATE["version"] = version
+        SERVER_CONFIGS_STATE["payload_hash"] = payload_hash
+        SERVER_CONFIGS_STATE["generation"] = generation
+        SERVER_CONFIGS_STATE["checked"] = time.monotonic()
+
+    return True
+
+
 def create_or_update_server_configs(collection, config_dict=None, orig_ip="127.0.0.1", convert_to_string=True):
     """
     Receives a dict with server configs, validates it, and calls the mongodb insertion function to insert it
@@ -266,60 +447,539 @@ d or malicious data
     return result
 
 
-def upload_agent_data(collection, agent_uid=None, data_dict=None, orig_ip="127.0.0.1"):
+def build_agent_data_record(agent_uid=None, data_dict=None, orig_ip="127.0.0.1"):
     """
-    Receives a dict with agent data, validates it, and calls the mongodb insertion function to insert it
-    Returns True if all OK; False if NOK
+    Receives a dict with agent data, validates it, and builds the agent data record to be inserted in the DB
+    Returns the record if all OK; None if NOK
     """
 
     if data_dict == None:
         data_dict = {}
 
-    logger.info(
-        "Agent data received and now being uploaded to the DB ["+str(agent_uid)+"] ...")
-
     if type(data_dict) is not dict:
         logger.error(
             "No valid agent data dict received. No agent data was uploaded.")
-        return False
+        return None
 
     for k in data_dict.keys():
         if not validate_string_key(k):
             logger.error("Agent data dict has an invalid key: " +
                          k+". No agent data was uploaded.")
-            return False
+            return None
 
     if not validate_string_key(agent_uid):
-        logger.error("Agent UID '" + agent_uid +
+        logger.error("Agent UID '" + str(agent_uid) +
                      "' is not valid. No agent data was uploaded.")
-        return False
+        return None
 
     # Create a new dict with a date object and date transfer direction so we can easily filter it and order entries in MongoDB
 
     # MongoDB fields in SIAAS data model are:
-    # _id - (Auto-generated by Mongo)
+    # _id - (Generated here, so the agent can name this snapshot as the base of its next upload)
     # scope - What type of content there's in this entry
     # origin - Creator of this entry
     # destiny - Intended destiny
     # payload - Data payload
+    # payload_hash - Hash of the canonical form of the payload (agent data only)
+    # portscanner_hash - Hash of the canonical form of the portscanner data in the payload (agent data only)
     # orig_ip - IP address of the requester
     # timestamp - Data object with creation timestamp of the record
+    # first_seen - Data object with the first time this payload was seen (agent data only)
+    # last_seen - Data object with the last time this payload was seen (agent data only)
+    # seen_count - Number of consecutive uploads with this payload (agent data only)
 
     complete_dict = {}
+    complete_dict["_id"] = ObjectId()
     complete_dict["scope"] = "agent_data"
     complete_dict["origin"] = "agent_"+agent_uid.lower()
     complete_dict["destiny"] = "server"
     complete_dict["payload"] = data_dict
+    complete_dict["payload_hash"] = get_payload_hash(data_dict)
+    complete_dict["portscanner_hash"] = get_payload_hash(
+        data_dict.get("portscanner"))
     complete_dict["orig_ip"] = str(orig_ip)
     complete_dict["timestamp"] = get_now_utc_obj()
+    complete_dict["first_seen"] = complete_dict["timestamp"]
+    complete_dict["last_seen"] = complete_dict["timestamp"]
+    complete_dict["seen_count"] = 1
+
+    return complete_dict
+
+
+def get_payload_hash(payload):
+    """
+    Returns the SHA-256 hash of the canonical JSON form of a payload (sorted keys, no whitespace), so equal payloads always have the same hash
+    """
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=str).encode('utf-8')).hexdigest()
 
-    result = insert_in_mongodb_collection(collection, complete_dict)
 
-    logger.info("Agent data upload to the DB finished ["+str(agent_uid)+"].")
+def upload_agent_data(collection, agent_uid=None, data_dict=None, orig_ip="127.0.0.1"):
+    """
+    Receives a dict with agent data, validates it, and calls the mongodb insertion function to insert it
+    Returns True if all OK; False if NOK
+    """
+    complete_dict = build_agent_data_record(
+        agent_uid=agent_uid, data_dict=data_dict, orig_ip=orig_ip)
+    if complete_dict == None:
+        return False
+
+    return upload_agent_data_record(collection, complete_dict)
+
+
+def upload_agent_data_record(collection, complete_dict):
+    """
+    Inserts an agent data record (already validated) in the DB and updates the current snapshot of the agent
+    Returns True if all OK; False if NOK
+    """
+    logger.info(
+        "Agent data received and now being uploaded to the DB ["+str(complete_dict["origin"])+"] ...")
+
+    stored = store_agent_data_records(collection, [complete_dict])
+    result = stored != None and stored[0]
+
+    logger.info("Agent data upload to the DB finished [" +
+                str(complete_dict["origin"])+"].")
 
     return result
 
 
+def build_agent_data_record_from_patch(collection, agent_uid=None, patch=None, base_id=None, orig_ip="127.0.0.1"):
+    """
+    Receives a JSON patch (RFC 6902) of agent data, applies it to the current snapshot of the agent, and builds the resulting agent data record (with the full payload)
+    The patch must be based on the current snapshot, named by its data ID; agents should upload their full data when it isn't
+    Returns a tuple with the record (None if it wasn't built) and why it wasn't: 'invalid' if the agent UID or base ID are not valid; 'conflict' if the base is not the current snapshot of the agent; 'unprocessable' if the patch is not valid, can't be applied, or its result is not valid agent data; 'failure' if the DB can't be read
+    """
+    logger.debug(
+        "Agent data patch received ["+str(agent_uid)+"] ...")
+
+    if not validate_string_key(agent_uid):
+        logger.error("Agent UID '" + str(agent_uid) +
+                     "' is not valid. No agent data was uploaded.")
+        return (None, "invalid")
+
+    if not ObjectId.is_valid(base_id or ''):
+        logger.error("Base data ID '" + str(base_id) +
+                     "' is not valid. No agent data was uploaded.")
+        return (None, "invalid")
+
+    try:
+        current = collection.find_one(
+            {'$and': [{"scope": "agent_data_current"}, {"origin": "agent_"+agent_uid.lower()}]})
+    except Exception as e:
+        logger.error("Can't read data from the DB server: "+str(e))
+        return (None, "failure")
+
+    if current == None or str(current.get("data_id")) != base_id:
+        logger.warning("Agent data patch is not based on the current snapshot of the agent [" +
+                       str(agent_uid)+"]. The agent needs to upload its full data.")
+        return (None, "conflict")
+
+    data_dict = apply_json_patch(current.get("payload", {}), patch)
+    if data_dict == None:
+        logger.error(
+            "Agent data patch couldn't be applied. No agent data was uploaded.")
+        return (None, "unprocessable")
+
+    record = build_agent_data_record(
+        agent_uid=agent_uid, data_dict=data_dict, orig_ip=orig_ip)
+    if record == None:
+        return (None, "unprocessable")
+
+    return (record, None)
+
+
+def upload_agent_data_bulk(collection, entries=None, orig_ip="127.0.0.1"):
+    """
+    Receives a list of agent data entries ({"agent_uid": ..., "payload": {...}}), validates each of them like upload_agent_data(), and inserts all valid entries in a single unordered bulk insertion
+    Returns a list with the result of each entry, in the same order as received; False if the list itself is not valid
+    """
+    if entries == None:
+        entries = []
+
+    if type(entries) is not list:
+        logger.error(
+            "No valid agent data list received. No agent data was uploaded.")
+        return False
+
+    logger.info("Bulk agent data received and now being uploaded to the DB (" +
+                str(len(entries))+" entries) ...")
+
+    results = []
+    records = []
+    records_index = []
+    for n, e in enumerate(entries):
+        agent_uid = None
+        record = None
+        if type(e) is dict:
+            agent_uid = e.get("agent_uid")
+            record = build_agent_data_record(
+                agent_uid=agent_uid, data_dict=e.get("payload"), orig_ip=orig_ip)
+        results.append({"agent_uid": agent_uid, "status": "failure"})
+        if record != None:
+            records.append(record)
+            records_index.append(n)
+
+    stored = store_agent_data_records(collection, records)
+    if stored == None:
+        stored = [False] * len(records)
+    for i, ok in enumerate(stored):
+        if ok:
+            results[records_index[i]]["status"] = "success"
+            results[records_index[i]]["data_id"] = str(records[i]["_id"])
+
+    logger.info("Bulk agent data upload to the DB finished (" + str(len([r for r in results if r["status"] == "success"])) +
+                " of "+str(len(results))+" entries uploaded).")
+
+    return results
+
+
+def store_agent_data_records(collection, records=None):
+    """
+    Stores agent data records (already validated) in the history, and updates the current snapshot of each agent
+    A record with the same payload as the previous snapshot of its agent (same hash) is not stored again: the history record of that snapshot is marked as seen again instead (last seen time refreshed and seen count increased), unless 'ingest_dedup' is disabled
+    All new records are inserted in a single bulk insertion, and all "seen again" updates in a single bulk write
+    Returns a list of booleans with the result of each record, in the same order as received. Returns None if the DB couldn't be reached
+    """
+    if records == None:
+        records = []
+    if len(records) == 0:
+        return []
+
+    records = [copy(r) for r in records]
+    for r in records:
+        r.pop("history_id", None)
+        if "payload_hash" not in r:
+            r["payload_hash"] = get_payload_hash(r["payload"])
+        if "portscanner_hash" not in r:
+            r["portscanner_hash"] = get_payload_hash(
+                r["payload"].get("portscanner"))
+
+    # Time-series collections compress repeated payloads by themselves (and their records can't be updated), so there's no deduplication there
+    history_collection = get_history_collection(collection)
+
+    # Latest payload hash and history record of each agent (and the hash of its portscanner data), starting from their current snapshots
+    latest = {}
+    previous_portscanner = {}
+    try:
+        for c in collection.find({'$and': [{"scope": "agent_data_current"}, {"origin": {"$in": list(set([r["origin"] for r in records]))}}]}, {"origin": 1, "payload_hash": 1, "history_id": 1, "portscanner_hash": 1}):
+            previous_portscanner[c["origin"]] = c.get("portscanner_hash")
+            if c.get("payload_hash") != None and c.get("history_id") != None:
+                latest[c["origin"]] = (c["payload_hash"], c["history_id"])
+    except Exception as e:
+        logger.error("Can't read data from the DB server: "+str(e))
+        return None
+    dedup = history_collection == collection and validate_bool_string(
+        get_config_from_configs_db(config_name="ingest_dedup"), default_output=True)
+
+    to_insert = []
+    to_update = []
+    for n, r in enumerate(records):
+        if dedup and latest.get(r["origin"], (None, None))[0] == r["payload_hash"]:
+            r["history_id"] = latest[r["origin"]][1]
+            to_update.append(n)
+        else:
+            to_insert.append(n)
+            latest[r["origin"]] = (r["payload_hash"], r["_id"])
+
+    results = [False] * len(records)
+    inserted = insert_many_in_mongodb_collection(
+        history_collection, [records[n] for n in to_insert])
+    if inserted == None:
+        return None
+    for n, ok in zip(to_insert, inserted):
+        results[n] = ok
+
+    if len(to_update) > 0:
+        logger.debug("Marking "+str(len(to_update)) +
+                     " unchanged agent data snapshots as seen again ...")
+        operations = []
+        for n in to_update:
+            operations.append(UpdateOne({'_id': records[n]["history_id"], 'scope': "agent_data"}, {'$max': {
+                "last_seen": records[n]["timestamp"]}, '$set': {"orig_ip": records[n]["orig_ip"]}, '$inc': {"seen_count": 1}}))
+        try:
+            result = collection.bulk_write(operations, ordered=False)
+            missing = []
+            if result.matched_count < len(to_update):
+                # Some history records are gone (i.e. deleted by the DB maintenance), so these snapshots are stored again
+                existing = [d["_id"] for d in collection.find(
+                    {"_id": {"$in": [records[n]["history_id"] for n in to_update]}}, {"_id": 1})]
+                missing = [
+                    n for n in to_update if records[n]["history_id"] not in existing]
+            for n in to_update:
+                results[n] = n not in missing
+            if len(missing) > 0:
+                # Uploads of the same snapshot in this batch are stored again as a single record, seen as many times
+                reinsert = {}
+                for n in missing:
+                    key = (records[n]["origin"], records[n]["payload_hash"])
+                    if key not in reinsert.keys():
+                        reinsert[key] = n
+                        records[n].pop("history_id", None)
+                    else:
+                        first = records[reinsert[key]]
+                        first["seen_count"] = first.get("seen_count", 1) + 1
+                        first["last_seen"] = max(first.get(
+                            "last_seen", first["timestamp"]), records[n]["timestamp"])
+                        records[n]["history_id"] = first["_id"]
+                inserted = insert_many_in_mongodb_collection(
+                    collection, [records[n] for n in reinsert.values()])
+                for n, ok in zip(reinsert.values(), inserted or []):
+                    results[n] = ok
+                for n in missing:
+                    results[n] = results[reinsert[(
+                        records[n]["origin"], records[n]["payload_hash"])]]
+        except Exception as e:
+            logger.error(
+                "Can't update agent data snapshots in the DB server: "+str(e))
+
+    # Keep the latest snapshot of these agents up to date, so current data reads don't have to go through the whole history
+    stored_records = [r for r, ok in zip(records, results) if ok]
+    if len(stored_records) > 0:
+        if not update_current_agent_data(collection, stored_records):
+            return [False] * len(records)
+
+    # Only agents whose portscanner data changed go to the vulnerability index (it can be rebuilt, so failures here don't fail the upload)
+    latest_stored = {}
+    for r in stored_records:
+        latest_stored[r["origin"]] = r
+    update_vulns_index(collection, [r for r in latest_stored.values(
+    ) if r["portscanner_hash"] != previous_portscanner.get(r["origin"])])
+
+    return results
+
+
+def update_agent_registry_last_seen(collection, data_to_insert):
+    """
+    Receives an agent data record and updates the last seen time and IP of that agent in the agent registry
+    There is only one registry record per agent, with the scope "agent_registry"
+    Returns True if all OK; False if NOK
+    """
+    logger.debug("Updating the agent registry in the DB server ...")
+    try:
+        collection.update_one({'scope': "agent_registry", 'origin': data_to_insert["origin"]}, {'$set': {
+            "destiny": "server", "orig_ip": data_to_insert["orig_ip"], "last_seen": data_to_insert["timestamp"], "timestamp": get_now_utc_obj()}}, upsert=True)
+        logger.debug("Agent registry successfully updated in the DB server.")
+        return True
+    except Exception as e:
+        logger.error("Can't update the agent registry in the DB server: "+str(e))
+        return False
+
+
+def update_agent_registry_configs(collection, agent_uid=None, config_dict=None):
+    """
+    Receives an agent UID and its published configs dict, and updates the nickname and description of that agent in the agent registry
+    Keys that don't exist in the configs dict are removed from the registry
+    Returns True if all OK; False if NOK
+    """
+    if config_dict == None:
+        config_dict = {}
+
+    logger.debug("Updating the agent registry in the DB server ...")
+    set_dict = {"destiny": "server", "timestamp": get_now_utc_obj()}
+    unset_dict = {}
+    for k in ["nickname", "description"]:
+        if k in config_dict.keys():
+            set_dict[k] = str(config_dict[k])
+        else:
+            unset_dict[k] = ""
+    update_dict = {'$set': set_dict}
+    if len(unset_dict) > 0:
+        update_dict['$unset'] = unset_dict
+    try:
+        collection.update_one(
+            {'scope': "agent_registry", 'origin': "agent_"+agent_uid.lower()}, update_dict, upsert=True)
+        logger.debug("Agent registry successfully updated in the DB server.")
+        return True
+    except Exception as e:
+        logger.error("Can't update the agent registry in the DB server: "+str(e))
+        return False
+
+
+def sync_agent_registry_configs(collection, agent_uid=None):
+    """
+    Syncs the nickname and description of the agents in the registry with their currently published configs
+    We can select a list of agent UIDs, else it will sync all agents in the registry
+    Returns True if all OK; False if NOK
+    """
+    logger.debug("Syncing the agent registry with the published agent configs ...")
+    registry_query = {"scope": "agent_registry"}
+    configs_query = {"scope": "agent_configs",
+                     "destiny": {"$regex": "^agent_"}}
+    if agent_uid != None:
+        agent_list = []
+        for u in agent_uid.split(','):
+            agent_list.append("agent_"+u.strip().lower())
+        registry_query["origin"] = {'$in': agent_list}
+        configs_query["destiny"] = {'$in': agent_list}
+    try:
+        configs = {}
+        for r in collection.find(configs_query, {"destiny": 1, "payload.nickname": 1, "payload.description": 1}):
+            configs[r["destiny"]] = r.get("payload", {})
+        result = True
+        for r in collection.find(registry_query, {"origin": 1}):
+            uid = r["origin"].split("_", 1)[1]
+            if not update_agent_registry_configs(collection, agent_uid=uid, config_dict=configs.get(r["origin"], {})):
+                result = False
+        return result
+    except Exception as e:
+        logger.error("Can't sync the agent registry in the DB server: "+str(e))
+        return False
+
+
+def rebuild_agent_registry(collection):
+    """
+    Rebuilds the agent registry from the current agent data snapshots and the published agent configs
+    Returns the number of agents in the registry, or False if error
+    """
+    logger.info("Rebuilding the agent registry ...")
+    count = 0
+    try:
+        cursor = collection.find({"scope": "agent_data_current"}, {
+                                 "origin": 1, "orig_ip": 1, "timestamp": 1})
+        for r in cursor:
+            if update_agent_registry_last_seen(collection, r):
+                count += 1
+    except Exception as e:
+        logger.error("Can't rebuild the agent registry: "+str(e))
+        return False
+
+    if not sync_agent_registry_configs(collection):
+        return False
+
+    logger.info("Agent registry rebuilt: "+str(count)+" agents.")
+
+    return count
+
+
+def remove_duplicate_agent_records(collection):
+    """
+    Removes duplicate current agent data snapshots and agent registry records (older versions could leave more than one per agent, from concurrent uploads), keeping the latest one of each agent
+    Needs to run before the unique indexes of these scopes are created
+    Returns the number of removed records, or False if error
+    """
+    count = 0
+    try:
+        for scope, latest_field in [("agent_data_current", "data_id"), ("agent_registry", "last_seen")]:
+            for d in collection.aggregate([{"$match": {"scope": scope}}, {"$group": {"_id": "$origin", "count": {"$sum": 1}}}, {"$match": {"count": {"$gt": 1}}}], allowDiskUse=True):
+                ids = [r["_id"] for r in collection.find({'$and': [{"scope": scope}, {"origin": d["_id"]}]}, {
+                    "_id": 1}).sort([(latest_field, -1), ("_id", -1)])]
+                count += collection.delete_many(
+                    {"_id": {"$in": ids[1:]}}).deleted_count
+    except Exception as e:
+        logger.error("Can't remove duplicate agent records: "+str(e))
+        return False
+
+    if count > 0:
+        logger.warning("Duplicate agent records removed: "+str(count)+".")
+        # Nicknames and descriptions might have been kept in a removed registry record
+        sync_agent_registry_configs(collection)
+
+    return count
+
+
+def update_current_agent_data(collection, records=None, update_registry=True):
+    """
+    Receives a list of agent data records and upserts the current (latest) snapshot of each agent, with the scope "agent_data_current"
+    Also updates the last seen time and IP of those agents in the agent registry, unless update_registry is False
+    If the same agent shows up more than once, its last record wins. All updates are sent in a single bulk write
+    Records seen again (with a history record already, from deduplication) only refresh the time, IP and data ID of the snapshot, which has the same payload
+    A snapshot is only replaced by a newer one (by data ID), and the registry only moves its last seen time forward, so concurrent uploads of the same agent can't roll them back
+    Snapshots keep the time they were last stored, so readers can pick up only the agents that were updated since a given time
+    Returns True if all OK; False if NOK
+    """
+    if records == None:
+        records = []
+
+    logger.debug("Updating the current agent data snapshots in the DB server ...")
+    latest = {}
+    replaced = set()
+    for r in records:
+        latest[r["origin"]] = r
+        if r.get("history_id") == None:
+            replaced.add(r["origin"])
+    last_stored = get_now_utc_obj()
+    operations = []
+    for r in latest.values():
+        data = copy(r)
+        data["last_stored"] = last_stored
+        record_id = data.pop("_id", None)
+        if type(record_id) is ObjectId:
+            data["data_id"] = record_id
+        newer_filter = {'$or': [{"data_id": {'$lt': data["data_id"]}}, {
+            "data_id": {'$exists': False}}]}
+        if data["origin"] not in replaced:
+            operations.append(UpdateOne({'scope': "agent_data_current", 'origin': data["origin"], '$and': [newer_filter]}, {'$set': {
+                              "timestamp": data["timestamp"], "orig_ip": data["orig_ip"], "last_stored": last_stored, "data_id": data["data_id"]}}))
+        else:
+            if data.get("history_id") == None and data.get("data_id") != None:
+                data["history_id"] = data["data_id"]
+            data.pop("first_seen", None)
+            data.pop("last_seen", None)
+            data.pop("seen_count", None)
+            data["scope"] = "agent_data_current"
+            operations.append(ReplaceOne(
+                {'scope': data["scope"], 'origin': data["origin"], '$and': [newer_filter]}, data, upsert=True))
+        if update_registry:
+            operations.append(UpdateOne({'scope': "agent_registry", 'origin': data["origin"], '$or': [{"last_seen": {'$lte': data["timestamp"]}}, {"last_seen": {'$exists': False}}]}, {'$set': {
+                "destiny": "server", "orig_ip": data["orig_ip"], "last_seen": data["timestamp"], "timestamp": get_now_utc_obj()}}, upsert=True))
+    if len(operations) == 0:
+        return True
+    # An upsert whose filter doesn't match because a newer record exists tries to insert a second record for the agent, which the unique index rejects: that update is stale, and skipped
+    # The same happens to the loser of two concurrent first upserts, so those are retried once (the record exists by then, and the filter decides)
+    for attempt in range(2):
+        try:
+            collection.bulk_write(operations, ordered=False)
+            break
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            if len([err for err in errors if err.get("code") != 11000]) > 0:
+                logger.error("Can't update the current agent data snapshots in the DB server: " +
+                             str(len(errors))+" updates failed.")
+                return False
+            operations = [operations[err["index"]] for err in errors]
+            if attempt == 0:
+                logger.debug("Retrying "+str(len(errors)) +
+                             " agent data snapshot updates that didn't find a record to update ...")
+            else:
+                logger.debug("Skipped "+str(len(errors)) +
+                             " agent data snapshot updates older than the stored ones.")
+        except Exception as e:
+            logger.error(
+                "Can't update the current agent data snapshots in the DB server: "+str(e))
+            return False
+    logger.debug(
+        "Current agent data snapshots successfully updated in the DB server.")
+    return True
+
+
+def rebuild_current_agent_data(collection):
+    """
+    Rebuilds the current (latest) snapshot records from the agent data history
+    This goes through the whole history, so it's only meant to be run once (i.e. after upgrading from a version without current snapshots)
+    Returns the number of rebuilt snapshots, or False if error
+    """
+    logger.info("Rebuilding the current agent data snapshots from history ...")
+    count = 0
+    try:
+        cursor = get_history_collection(collection).aggregate([
+            {"$match": {
+                '$and': [{"origin": {"$regex": "^agent_"}}, {"scope": "agent_data"}]}},
+            {"$sort": {"_id": 1}},
+            {"$group": {"_id": {"origin": "$origin"}, "scope": {"$last": "$scope"}, "origin": {"$last": "$origin"}, "destiny": {
+                "$last": "$destiny"}, "payload": {"$last": "$payload"}, "orig_ip": {"$last": "$orig_ip"}, "timestamp": {"$last": "$timestamp"}, "data_id": {"$last": "$_id"}, "payload_hash": {"$last": "$payload_hash"}}}
+        ], allowDiskUse=True)
+        for r in cursor:
+            if update_current_agent_data(collection, [r], update_registry=False):
+                count += 1
+    except Exception as e:
+        logger.error("Can't rebuild the current agent data snapshots: "+str(e))
+        return False
+
+    logger.info("Current agent data snapshots rebuilt: "+str(count)+".")
+
+    return count
+
+
 def create_or_update_agent_configs(collection, agent_uid=None, config_dict=None, orig_ip="127.0.0.1", convert_to_string=True):
     """
     Receives a dict with agent configs, validates it, and calls the mongodb insertion function to insert it
@@ -396,6 +1056,11 @@ def create_or_update_agent_configs(collection, agent_uid=None, config_dict=None,
 
         if not create_or_update_in_mongodb_collection(collection, complete_dict):
             result = False
+            continue
+
+        if uid.lower() != "ffffffff-ffff-ffff-ffff-ffffffffffff":
+            if not update_agent_registry_configs(collection, agent_uid=uid, config_dict=complete_dict["payload"]):
+                result = False
 
     logger.info(
         "Agent configs upload to the DB finished ["+str(agent_uid)+"].")
@@ -405,20 +1070,17 @@ def create_or_update_agent_configs(collection, agent_uid=None, config_dict=None,
 
 def get_dict_active_agents(collection, sort_by="date"):
     """
-    Reads a list of active agents. Returns nickname and description if they exist in configs DB
+    Reads a list of active agents from the agent registry. Returns nickname and description if they exist in configs DB
     Returns a list of records. Returns False if data can't be read
     """
     logger.debug("Reading data from the DB server ...")
     out_dict = {}
 
     try:
-        cursor = collection.aggregate([
-            {"$match": {"origin": {"$regex": "^agent_"}}},
-            {"$group": {"_id": {"origin": "$origin"}, "origin": {
-                "$last": "$origin"}, "timestamp": {"$last": "$timestamp"},
-                "orig_ip": {"$last": "$orig_ip"}}},
-            {"$sort": {"timestamp": -1}}
-        ])
+        cursor = collection.find(
+            {'$and': [{"scope": "agent_registry"}, {
+                "last_seen": {'$exists': True}}]}
+        ).sort('last_seen', -1)
         results = list(cursor)
     except Exception as e:
         logger.error("Can't read data from the DB server: "+str(e))
@@ -428,18 +1090,12 @@ def get_dict_active_agents(collection, sort_by="date"):
         try:
             uid = r["origin"].split("_", 1)[1]
             out_dict[uid] = {}
-            try:
-                out_dict[uid]["nickname"] = str(get_dict_current_agent_configs(
-                    collection, agent_uid=uid, merge_broadcast=False)[uid]["nickname"])
-            except:
-                pass
-            try:
-                out_dict[uid]["description"] = str(get_dict_current_agent_configs(
-                    collection, agent_uid=uid, merge_broadcast=False)[uid]["description"])
-            except:
-                pass
+            if "nickname" in r.keys():
+                out_dict[uid]["nickname"] = str(r["nickname"])
+            if "description" in r.keys():
+                out_dict[uid]["description"] = str(r["description"])
             out_dict[uid]["origin_ip"] = r["orig_ip"]
-            out_dict[uid]["last_seen"] = r["timestamp"].strftime(
+            out_dict[uid]["last_seen"] = r["last_seen"].strftime(
                 '%Y-%m-%dT%H:%M:%SZ')
         except:
             logger.debug(
@@ -452,15 +1108,36 @@ def get_dict_active_agents(collection, sort_by="date"):
     return out_dict
 
 
-def get_dict_history_agent_data(collection, agent_uid=None, module=None, limit_outputs=99999, days=99999, sort_by="date", older_first=False, hide_empty=False):
+def get_history_recent_filter(last_d, timeseries=False):
+    """
+    Returns the filter for agent data history records seen since a given date
+    A run of unchanged uploads keeps its first upload time in 'timestamp' and its latest in 'last_seen' (records from older versions only have 'timestamp', which was moved forward instead), while time-series history has a record per upload
+    """
+    if timeseries:
+        return {"timestamp": {"$gte": last_d}}
+    return {'$or': [{"last_seen": {"$gte": last_d}}, {"timestamp": {"$gte": last_d}}]}
+
+
+def get_history_expired_filter(last_d):
+    """
+    Returns the filter for records older than a given date, where agent data history runs are only old once they were last seen before it (see get_history_recent_filter)
+    """
+    return {'$and': [{"timestamp": {"$lt": last_d}}, {"last_seen": {"$not": {"$gte": last_d}}}]}
+
+
+def get_dict_history_agent_data(collection, agent_uid=None, module=None, limit_outputs=99999, days=99999, sort_by="date", older_first=False, hide_empty=False, page_token=None, paginate=False, show_runs=False):
     """
     Reads historical agent data from the Mongo DB collection
     We can select a list of agents and modules to display
     We can sort, select a day limit, limit outputs, order by older records first, and hide empty records
-    Returns a list of records. Returns False if data can't be read
+    Consecutive uploads with the same data are kept as a single record (a run), listed under the first time it was seen and selected by the day limit while it was last seen within it. If show_runs is set, each entry also shows when the run was first and last seen and how many uploads it had
+    If paginate is set, results are read in pages of limit_outputs records, and the page token of the next page is also returned (None if it's the last page)
+    The page token is opaque, and seeks directly to the first record of the next page (by _id), so every page costs the same
+    Returns a list of records, or a tuple with a list of records and the next page token if paginate is set. Returns False if data can't be read
     """
     logger.debug("Reading data from the DB server ...")
     out_dict = {}
+    next_page_token = None
 
     if sort_by.lower() == "agent":
         sort_field = "origin"
@@ -472,37 +1149,63 @@ def get_dict_history_agent_data(collection, agent_uid=None, module=None, limit_o
     else:
         id_sort_type = -1
 
-    if agent_uid == None:
-        try:
-            if(int(limit_outputs) < 0):
-                limit_outputs = 0
-            last_d = datetime.utcnow() - timedelta(days=int(days))
-            cursor = collection.find(
-                {'$and': [{"payload": {'$exists': True}}, {"scope": "agent_data"}, {"timestamp": {"$gte": last_d}}
-                          ]}
-            ).sort('_id', id_sort_type).limit(int(limit_outputs))
-            results = list(cursor)
-        except Exception as e:
-            logger.error("Can't read data from the DB server: "+str(e))
-            return False
-
+    # Time-series collections are organized by time, so records are sorted (and pages are sought) by timestamp first
+    history_collection = get_history_collection(collection)
+    timeseries = history_collection != collection
+    if timeseries:
+        sort_keys = [('timestamp', id_sort_type), ('_id', id_sort_type)]
     else:
-        results = []
-        agent_list = []
-        for u in agent_uid.split(','):
-            agent_list.append("agent_"+u.strip().lower())
-        try:
-            if(int(limit_outputs) < 0):
-                limit_outputs = 0
-            last_d = datetime.utcnow() - timedelta(days=int(days))
-            cursor = collection.find(
-                {'$and': [{"payload": {'$exists': True}}, {"scope": "agent_data"}, {
-                    "timestamp": {"$gte": last_d}}, {"origin": {'$in': agent_list}}]}
-            ).sort('_id', id_sort_type).limit(int(limit_outputs))
-            results = results+list(cursor)
-        except Exception as e:
-            logger.error("Can't read data from the DB server: "+str(e))
-            return False
+        sort_keys = [('_id', id_sort_type)]
+    projection = get_payload_projection(
+        module, fields=["origin", "timestamp", "first_seen", "last_seen", "seen_count"])
+
+    try:
+        if(int(limit_outputs) < 0):
+            limit_outputs = 0
+        last_d = datetime.utcnow() - timedelta(days=int(days))
+        query = [{"payload": {'$exists': True}}, {
+            "scope": "agent_data"}, get_history_recent_filter(last_d, timeseries)]
+        if agent_uid != None:
+            agent_list = []
+            for u in agent_uid.split(','):
+                agent_list.append("agent_"+u.strip().lower())
+            query.append({"origin": {'$in': agent_list}})
+        if len(page_token or '') > 0:
+            page = decode_page_token(page_token)
+            if page == None or page.get("older") != int(bool(older_first)):
+                raise ValueError("Invalid page token.")
+            if older_first:
+                operator = '$gt'
+            else:
+                operator = '$lt'
+            if timeseries:
+                # Pages follow the (timestamp, _id) sort, so the next one starts after the last record in that order
+                page_ts = datetime.fromisoformat(page["ts"])
+                query.append({'$or': [{"timestamp": {operator: page_ts}}, {
+                             "timestamp": page_ts, "_id": {operator: ObjectId(page["id"])}}]})
+            else:
+                query.append({"_id": {operator: ObjectId(page["id"])}})
+        if paginate and int(limit_outputs) > 0:
+            # Read one more record than needed, just to know if there's a next page
+            cursor = history_collection.find({'$and': query}, projection).sort(
+                sort_keys).limit(int(limit_outputs)+1)
+            results = list(cursor)
+            if len(results) > int(limit_outputs):
+                results = results[:int(limit_outputs)]
+                next_page = {"id": str(results[-1]["_id"]),
+                             "older": int(bool(older_first))}
+                if timeseries:
+                    next_page["ts"] = results[-1]["timestamp"].isoformat()
+                next_page_token = encode_page_token(next_page)
+        else:
+            cursor = history_collection.find({'$and': query}, projection).sort(
+                sort_keys).limit(int(limit_outputs))
+            results = list(cursor)
+    except Exception as e:
+        logger.error("Can't read data from the DB server: "+str(e))
+        if paginate:
+            return (False, None)
+        return False
 
     if sort_field == "origin":
         for r in results:
@@ -518,7 +1221,7 @@ def get_dict_history_agent_data(collection, agent_uid=None, module=None, limit_o
                         out_dict[uid][timestamp] = {}
                         for m in sorted(set(module.lower().split(','))):
                             mod = m.strip()
-                            if mod in r["payload"].keys():
+                            if mod in r.get("payload", {}).keys():
                                 out_dict[uid][timestamp][mod] = r["payload"][mod]
                     if hide_empty:
                         for k in list(out_dict[uid][timestamp].keys()):
@@ -526,6 +1229,9 @@ def get_dict_history_agent_data(collection, agent_uid=None, module=None, limit_o
                                 out_dict[uid][timestamp].pop(k, None)
                         if len(out_dict[uid][timestamp]) == 0:
                             out_dict[uid].pop(timestamp, None)
+                    if show_runs and timestamp in out_dict[uid].keys():
+                        out_dict[uid][timestamp] = get_agent_data_run(
+                            r, out_dict[uid][timestamp])
             except:
                 logger.debug(
                     "Ignoring invalid entry when grabbing agent data.")
@@ -546,7 +1252,7 @@ def get_dict_history_agent_data(collection, agent_uid=None, module=None, limit_o
                         out_dict[timestamp][uid] = {}
                         for m in sorted(set(module.lower().split(','))):
                             mod = m.strip()
-                            if mod in r["payload"].keys():
+                            if mod in r.get("payload", {}).keys():
                                 out_dict[timestamp][uid][mod] = r["payload"][mod]
                     out_dict[timestamp] = dict(sorted(out_dict[timestamp].items(
                     ), key=lambda x: x[0].casefold() if len(x or "") > 0 else None))
@@ -556,6 +1262,9 @@ def get_dict_history_agent_data(collection, agent_uid=None, module=None, limit_o
                                 out_dict[timestamp][uid].pop(k, None)
                         if len(out_dict[timestamp][uid]) == 0:
                             out_dict[timestamp].pop(uid, None)
+                    if show_runs and uid in out_dict[timestamp].keys():
+                        out_dict[timestamp][uid] = get_agent_data_run(
+                            r, out_dict[timestamp][uid])
             except:
                 logger.debug(
                     "Ignoring invalid entry when grabbing agent data.")
@@ -565,45 +1274,78 @@ def get_dict_history_agent_data(collection, agent_uid=None, module=None, limit_o
             if len(out_dict[k]) == 0:
                 out_dict.pop(k, None)
 
+    if paginate:
+        return (out_dict, next_page_token)
+
     return out_dict
 
 
-def get_dict_current_agent_data(collection, agent_uid=None, module=None):
+def get_payload_projection(module=None, fields=None):
     """
-    Reads agent data from the Mongo DB collection
-    We can select a list of agents and modules to display
-    Returns a list of records. Returns False if data can't be read
+    Turns a comma-separated list of modules into a MongoDB projection, so only those modules of the payload (plus the given top-level fields) are read from the DB
+    Module names that can't be payload keys are ignored
+    Returns the projection dict, or None (all fields) if no modules are selected
+    """
+    if module == None:
+        return None
+    if fields == None:
+        fields = []
+    projection = {}
+    for f in fields:
+        projection[f] = 1
+    for m in module.lower().split(','):
+        mod = m.strip()
+        if validate_string_key(mod):
+            projection["payload."+mod] = 1
+    return projection
+
+
+def get_agent_data_run(record, payload):
+    """
+    Returns a dict describing the run of an agent data history record (first seen, last seen, and number of uploads), with its (filtered) payload
+    """
+    return {
+        "first_seen": record.get("first_seen", record["timestamp"]).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        "last_seen": record.get("last_seen", record["timestamp"]).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        "seen_count": record.get("seen_count", 1),
+        "payload": payload
+    }
+
+
+def get_dict_current_agent_data(collection, agent_uid=None, module=None):
+    """
+    Reads agent data from the Mongo DB collection (from the current snapshot records, one per agent)
+    We can select a list of agents and modules to display
+    Returns a list of records. Returns False if data can't be read
     """
     logger.debug("Reading data from the DB server ...")
     out_dict = {}
+    projection = get_payload_projection(module, fields=["origin"])
 
     if agent_uid == None:
         try:
-            cursor = collection.aggregate([
-                {"$match": {
-                    '$and': [{"origin": {"$regex": "^agent_"}}, {"scope": "agent_data"}]}},
-                {"$group": {"_id": {"origin": "$origin"}, "scope": {"$last": "$scope"}, "origin": {"$last": "$origin"}, "destiny": {
-                    "$last": "$destiny"}, "payload": {"$last": "$payload"}, "timestamp": {"$last": "$timestamp"}}},
-                {"$sort": {"origin": 1}}
-            ])
+            cursor = collection.find(
+                {'$and': [{"payload": {'$exists': True}}, {
+                    "scope": "agent_data_current"}]}, projection
+            ).sort('origin', 1)
             results = list(cursor)
         except Exception as e:
             logger.error("Can't read data from the DB server: "+str(e))
             return False
 
     else:
-        results = []
+        agent_list = []
         for u in agent_uid.split(','):
-            uid = u.strip().lower()
-            try:
-                cursor = collection.find(
-                    {'$and': [{"payload": {'$exists': True}}, {
-                        "scope": "agent_data"}, {"origin": "agent_"+uid}]}
-                ).sort('_id', -1).limit(1)
-                results = results+list(cursor)
-            except Exception as e:
-                logger.error("Can't read data from the DB server: "+str(e))
-                return False
+            agent_list.append("agent_"+u.strip().lower())
+        try:
+            cursor = collection.find(
+                {'$and': [{"payload": {'$exists': True}}, {
+                    "scope": "agent_data_current"}, {"origin": {'$in': agent_list}}]}, projection
+            )
+            results = list(cursor)
+        except Exception as e:
+            logger.error("Can't read data from the DB server: "+str(e))
+            return False
 
     for r in results:
         try:
@@ -615,7 +1357,7 @@ def get_dict_current_agent_data(collection, agent_uid=None, module=None):
                     out_dict[uid] = {}
                     for m in sorted(set(module.lower().split(','))):
                         mod = m.strip()
-                        if mod in r["payload"].keys():
+                        if mod in r.get("payload", {}).keys():
                             out_dict[uid][mod] = r["payload"][mod]
         except:
             logger.debug("Ignoring invalid entry when grabbing agent data.")
@@ -626,6 +1368,45 @@ def get_dict_current_agent_data(collection, agent_uid=None, module=None):
     return out_dict
 
 
+def get_current_agent_data_hashes(collection, stored_since=None):
+    """
+    Reads the payload hash of the current snapshot of each agent, without reading the payloads
+    We can select only the snapshots stored after a given time (datetime object)
+    Returns a dict of agent UIDs and their payload hashes (None if unknown). Returns False if data can't be read
+    """
+    logger.debug("Reading data from the DB server ...")
+    out_dict = {}
+    query = [{"scope": "agent_data_current"}]
+    if stored_since != None:
+        query.append({"last_stored": {"$gt": stored_since}})
+    try:
+        results = list(collection.find(
+            {'$and': query}, {"origin": 1, "payload_hash": 1}))
+    except Exception as e:
+        logger.error("Can't read data from the DB server: "+str(e))
+        return False
+
+    for r in results:
+        if str(r.get("origin")).startswith("agent_"):
+            out_dict[r["origin"].split("_", 1)[1]] = r.get("payload_hash")
+
+    return out_dict
+
+
+def get_current_agent_uids(collection):
+    """
+    Returns the list of agent UIDs with a current data snapshot. Returns False if data can't be read
+    """
+    logger.debug("Reading data from the DB server ...")
+    try:
+        origins = collection.distinct(
+            "origin", {"scope": "agent_data_current"})
+    except Exception as e:
+        logger.error("Can't read data from the DB server: "+str(e))
+        return False
+    return [o.split("_", 1)[1] for o in origins if str(o).startswith("agent_")]
+
+
 def get_dict_current_agent_configs(collection, agent_uid=None, merge_broadcast=False):
     """
     Reads agent configs from the Mongo DB collection
@@ -637,13 +1418,11 @@ def get_dict_current_agent_configs(collection, agent_uid=None, merge_broadcast=F
 
     if agent_uid == None:
         try:
-            cursor = collection.aggregate([
-                {"$match": {'$and': [{"destiny": {"$regex": "^agent_"}}, {
-                    "scope": "agent_configs"}]}},
-                {"$group": {"_id": {"destiny": "$destiny"}, "scope": {"$last": "$scope"}, "origin": {"$last": "$origin"}, "destiny": {
-                    "$last": "$destiny"}, "payload": {"$last": "$payload"}, "timestamp": {"$last": "$timestamp"}}},
-                {"$sort": {"destiny": 1}}
-            ])
+            # Agent configs are created or updated in place, so there's only one record per agent
+            cursor = collection.find(
+                {'$and': [{"payload": {'$exists': True}}, {
+                    "scope": "agent_configs"}, {"destiny": {"$regex": "^agent_"}}]}
+            ).sort('destiny', 1)
             results = list(cursor)
         except Exception as e:
             logger.error("Can't read data from the DB server: "+str(e))
@@ -712,6 +1491,66 @@ def get_dict_current_agent_configs(collection, agent_uid=None, merge_broadcast=F
     return out_dict
 
 
+def get_configs_etag(collection, scope="agent_configs", agent_uid=None, merge_broadcast=False):
+    """
+    Returns an ETag for the configs that would be returned for the same arguments, derived from the IDs and versions of the stored config records (payloads are not read)
+    The ETag is cached and reused without querying the DB while no configs are written by this process, for up to 'api_configs_etag_revalidate_sec' seconds
+    Returns False if it can't be computed
+    """
+    if scope == "server_configs":
+        destinies = ["server"]
+    elif agent_uid == None:
+        destinies = None
+    else:
+        destinies = sorted(set(
+            ["agent_"+u.strip().lower() for u in agent_uid.split(',')]))
+        if merge_broadcast:
+            destinies.append("agent_ffffffff-ffff-ffff-ffff-ffffffffffff")
+
+    cache_key = (scope, ','.join(destinies or []), bool(merge_broadcast))
+    try:
+        revalidate_sec = int(get_config_from_configs_db(
+            config_name="api_configs_etag_revalidate_sec"))
+    except:
+        revalidate_sec = 60
+
+    generation = CONFIG_GENERATION
+    cached = CONFIG_ETAG_CACHE.get(cache_key)
+    if cached != None and cached["generation"] == generation and time.monotonic() - cached["checked"] < revalidate_sec:
+        return cached["etag"]
+
+    try:
+        if destinies == None:
+            query = {'$and': [{"payload": {'$exists': True}}, {
+                "scope": scope}, {"destiny": {"$regex": "^agent_"}}]}
+        else:
+            query = {'$and': [{"payload": {'$exists': True}}, {
+                "scope": scope}, {"destiny": {"$in": destinies}}]}
+        results = list(collection.find(
+            query, {"_id": 1, "destiny": 1, "version": 1}).sort('destiny', 1))
+    except Exception as e:
+        logger.error("Can't read data from the DB server: "+str(e))
+        return False
+
+    etag_source = [scope, str(bool(merge_broadcast))] + sorted(
+        [str(r.get("destiny"))+":"+str(r["_id"])+":"+str(r.get("version", 0)) for r in results])
+    etag = hashlib.sha1('|'.join(etag_source).encode('utf-8')).hexdigest()
+    if len(CONFIG_ETAG_CACHE) >= 10000:
+        CONFIG_ETAG_CACHE.clear()
+    CONFIG_ETAG_CACHE[cache_key] = {
+        "generation": generation, "checked": time.monotonic(), "etag": etag}
+    return etag
+
+
+def bump_config_generation():
+    """
+    Invalidates all cached config ETags of this process (called whenever configs are written)
+    """
+    global CONFIG_GENERATION
+    with CONFIG_GENERATION_LOCK:
+        CONFIG_GENERATION += 1
+
+
 def delete_all_records_older_than(collection, scope=None, agent_uid=None, days_to_keep=99999):
     """
     Delete records older than n-days
@@ -727,13 +1566,13 @@ def delete_all_records_older_than(collection, scope=None, agent_uid=None, days_t
             last_d = datetime.utcnow() - timedelta(days=int(days_to_keep))
             if scope == None:
                 c = collection.delete_many(
-                    {'$and': [{"payload": {'$exists': True}}, {"timestamp": {"$lt": last_d}}
+                    {'$and': [{"payload": {'$exists': True}}, get_history_expired_filter(last_d)
                               ]}
                 )
                 count += c.deleted_count
             else:
                 c = collection.delete_many(
-                    {'$and': [{"payload": {'$exists': True}}, {"scope": scope}, {"timestamp": {"$lt": last_d}}
+                    {'$and': [{"payload": {'$exists': True}}, {"scope": scope}, get_history_expired_filter(last_d)
                               ]}
                 )
                 count += c.deleted_count
@@ -749,13 +1588,13 @@ def delete_all_records_older_than(collection, scope=None, agent_uid=None, days_t
             last_d = datetime.utcnow() - timedelta(days=int(days_to_keep))
             if scope == None:
                 c = collection.delete_many(
-                    {'$and': [{"payload": {'$exists': True}}, {"timestamp": {"$lt": last_d}}, {
+                    {'$and': [{"payload": {'$exists': True}}, get_history_expired_filter(last_d), {
                         '$or': [{"destiny": {'$in': agent_list}}, {"origin": {'$in': agent_list}}]}]}
                 )
                 count += c.deleted_count
             else:
                 c = collection.delete_many(
-                    {'$and': [{"payload": {'$exists': True}}, {"scope": scope}, {"timestamp": {"$lt": last_d}}, {
+                    {'$and': [{"payload": {'$exists': True}}, {"scope": scope}, get_history_expired_filter(last_d), {
                         '$or': [{"destiny": {'$in': agent_list}}, {"origin": {'$in': agent_list}}]}]}
                 )
                 count += c.deleted_count
@@ -763,118 +1602,522 @@ def delete_all_records_older_than(collection, scope=None, agent_uid=None, days_t
             logger.error("Can't delete data from the DB server: "+str(e))
             return False
 
+    # The agent data history might be stored in its own time-series collection
+    history_collection = get_history_collection(collection)
+    if history_collection != collection and (scope == None or scope == "agent_data"):
+        try:
+            history_query = [{"timestamp": {"$lt": last_d}}]
+            if agent_uid != None:
+                history_query.append({"origin": {'$in': agent_list}})
+            c = history_collection.delete_many({'$and': history_query})
+            count += c.deleted_count
+        except Exception as e:
+            logger.error("Can't delete data from the DB server: "+str(e))
+            return False
+
+    if scope == None or scope in ["agent_configs", "server_configs"]:
+        bump_config_generation()
+
+    # The current snapshot of an agent is as old as its last upload, so it only goes away when all of its history is gone too
+    if scope == "agent_data":
+        c = delete_all_records_older_than(
+            collection, scope="agent_data_current", agent_uid=agent_uid, days_to_keep=days_to_keep)
+        if type(c) == bool and c == False:
+            return False
+        try:
+            last_d = datetime.utcnow() - timedelta(days=int(days_to_keep))
+            registry_query = {'$and': [
+                {"scope": "agent_registry"}, {"last_seen": {"$lt": last_d}}]}
+            if agent_uid != None:
+                registry_query['$and'].append({"origin": {'$in': agent_list}})
+            collection.delete_many(registry_query)
+            # Findings of agents without a current snapshot are gone too
+            get_vulns_collection(collection).delete_many({"origin": {"$nin": collection.distinct(
+                "origin", {"scope": "agent_data_current"})}})
+        except Exception as e:
+            logger.error("Can't delete data from the DB server: "+str(e))
+            return False
+
+    # Nicknames and descriptions in the agent registry come from the published agent configs
+    if scope == "agent_configs":
+        if not sync_agent_registry_configs(collection, agent_uid=agent_uid):
+            return False
+
     return count
 
 
-def grab_vulns_from_agent_data_dict(agent_data_dict, target_host=None, report_type="vuln_only"):
+def delete_agent_data_in_batches(collection, days_to_keep=99999, batch_size=1000, docs_per_sec=5000):
+    """
+    Deletes agent data history records older than n-days (runs of unchanged uploads, once last seen before that) from the main collection, in batches of up to batch_size records (each one a bounded _id range), throttled to docs_per_sec deleted records per second
+    Progress is checkpointed in the DB after every batch, so an interrupted cleanup is resumed (with its original cutoff date) by the next call
+    Returns number of deleted records, or False if error
+    """
+    try:
+        checkpoint = collection.find_one(
+            {'$and': [{"scope": "dbmaintenance_state"}, {"destiny": "server"}]})
+    except Exception as e:
+        logger.error("Can't read data from the DB server: "+str(e))
+        return False
+
+    state = (checkpoint or {}).get("payload", {})
+    if type(state.get("cutoff")) is datetime and type(state.get("last_id")) is ObjectId:
+        cutoff = state["cutoff"]
+        last_id = state["last_id"]
+        count = int(state.get("deleted", 0))
+        resumed = True
+        logger.info("Resuming interrupted history cleanup (cutoff date: "+cutoff.strftime(
+            '%Y-%m-%dT%H:%M:%SZ')+", "+str(count)+" records deleted so far) ...")
+    else:
+        resumed = False
+        cutoff = datetime.utcnow() - timedelta(days=int(days_to_keep))
+        last_id = None
+        count = 0
+
+    # Records are stored as they come, so none older than the cutoff date has an _id after it: this bounds the walk (otherwise the last batch would go through all the kept history)
+    max_id = ObjectId.from_datetime(cutoff)
+
+    while True:
+        start = time.monotonic()
+        id_range = {"$lt": max_id}
+        if last_id != None:
+            id_range["$gt"] = last_id
+        try:
+            # Walk the history by _id, so each batch is a contiguous range and the next one starts where this one ended
+            ids = [r["_id"] for r in collection.find({'$and': [{"payload": {'$exists': True}}, {"scope": "agent_data"}, {"_id": id_range},
+                get_history_expired_filter(cutoff)]}, {"_id": 1}).sort('_id', 1).hint("scope_id_index").limit(int(batch_size))]
+            if len(ids) == 0:
+                break
+            c = collection.delete_many({'$and': [{"payload": {'$exists': True}}, {"scope": "agent_data"},
+                get_history_expired_filter(cutoff), {"_id": {"$gte": ids[0], "$lte": ids[-1]}}]})
+            count += c.deleted_count
+            last_id = ids[-1]
+            collection.update_one({'scope': "dbmaintenance_state", 'destiny': "server"}, {'$set': {"payload": {
+                                  "cutoff": cutoff, "last_id": last_id, "deleted": count}, "timestamp": get_now_utc_obj()}}, upsert=True)
+        except Exception as e:
+            logger.error("Can't delete data from the DB server: "+str(e))
+            return False
+
+        elapsed = time.monotonic() - start
+        logger.info("History cleanup batch: "+str(c.deleted_count)+" records deleted in "+str(round(elapsed*1000, 1))+" ms (" +
+                    str(round(c.deleted_count/max(elapsed, 0.001)))+" records/s). Total so far: "+str(count)+".")
+
+        # Stay within the budget of deleted records per second (and let other DB clients in, between batches)
+        time.sleep(max(c.deleted_count/int(docs_per_sec) - elapsed, 0))
+
+    try:
+        collection.delete_many({"scope": "dbmaintenance_state"})
+    except Exception as e:
+        logger.error("Can't delete data from the DB server: "+str(e))
+        return False
+
+    # The interrupted cleanup had an older cutoff date, so there might be more to delete now
+    if resumed:
+        c = delete_agent_data_in_batches(
+            collection, days_to_keep=days_to_keep, batch_size=batch_size, docs_per_sec=docs_per_sec)
+        if type(c) == bool and c == False:
+            return False
+        count += c
+
+    return count
+
+
+def generate_vulns_from_portscanner(portscanner_dict, exploit_only=False):
+    """
+    Walks the portscanner data of an agent (host -> scanned_ports -> port -> scan_results -> scan -> script -> group -> vuln ID) and yields one flat dict per finding, from vulners/vulscan scripts
+    A dict for each host (type 'host', with its last check, if it has one) is also yielded, before or after its findings (type 'vuln') depending on which comes first in the host data; with exploit_only, findings without exploits are skipped
+    Parts of the tree that don't have the expected format are skipped
+    """
+    if type(portscanner_dict) is not dict:
+        return
+    for host, host_dict in portscanner_dict.items():
+        if type(host_dict) is not dict:
+            continue
+        host_vuln = {"type": "host", "target_host": host}
+        if "last_check" in host_dict:
+            host_vuln["last_check"] = host_dict["last_check"]
+        host_keys = list(host_dict.keys())
+        findings_first = "last_check" in host_dict and "scanned_ports" in host_dict and host_keys.index(
+            "scanned_ports") < host_keys.index("last_check")
+        if not findings_first:
+            yield host_vuln
+        scanned_ports = host_dict.get("scanned_ports")
+        if type(scanned_ports) is not dict:
+            scanned_ports = {}
+        for port, port_dict in scanned_ports.items():
+            if type(port_dict) is not dict or type(port_dict.get("scan_results")) is not dict:
+                continue
+            for scan, scan_dict in port_dict["scan_results"].items():
+                if type(scan_dict) is not dict:
+                    continue
+                for script, script_dict in scan_dict.items():
+                    if ("vulners" not in script and "vulscan" not in script) or type(script_dict) is not dict:
+                        continue
+                    for group, group_dict in script_dict.items():
+                        if type(group_dict) is not dict:
+                            continue
+                        group_vuln = {"type": "vuln", "target_host": host, "port": port, "scan": scan, "script": script,
+                                      "source": "vulners" if "vulners" in script else "vulscan", "group": group}
+                        if "last_check" in host_dict:
+                            group_vuln["last_check"] = host_dict["last_check"]
+                        for vuln_id, details in group_dict.items():
+                            try:
+                                exploit = "siaas_exploit_tag" in details
+                            except TypeError:
+                                exploit = False
+                            if exploit_only and not exploit:
+                                continue
+                            v = group_vuln.copy()
+                            v["vuln_id"] = vuln_id
+                            v["details"] = details
+                            v["exploit"] = exploit
+                            yield v
+        if findings_first:
+            yield host_vuln
+
+
+def read_mailer_state(collection):
+    """
+    Reads the mailer report state persisted in the DB: report type, high-water time, digest and time of the last report sent, and the payload hash and findings digest of each agent
+    Findings themselves are not persisted, so agents come back without them (None)
+    Returns the state dict, or None if there's no valid state. Returns False if data can't be read
+    """
+    try:
+        record = collection.find_one(
+            {'$and': [{"scope": "mailer_state"}, {"destiny": "server"}]})
+    except Exception as e:
+        logger.error("Can't read data from the DB server: "+str(e))
+        return False
+
+    payload = (record or {}).get("payload")
+    if type(payload) is not dict:
+        return None
+    try:
+        state = {"report_type": payload["report_type"], "high_water": payload["high_water"], "agents": {},
+                 "sent_digest": payload.get("sent_digest"), "sent_time": payload.get("sent_time")}
+        if type(state["high_water"]) is not datetime:
+            raise ValueError("High-water time is not a date.")
+        for uid, payload_hash, digest in payload["agents"]:
+            state["agents"][uid] = {"payload_hash": payload_hash,
+                                    "vulns": None, "digest": digest}
+    except Exception as e:
+        logger.warning("Ignoring invalid mailer state in the DB: "+str(e))
+        return None
+
+    return state
+
+
+def write_mailer_state(collection, state):
+    """
+    Persists the mailer report state in the DB, without the findings of each agent (see read_mailer_state)
+    Returns True if all OK; False if NOK
+    """
+    # Agent UIDs are kept in a list, as they're not guaranteed to be valid field names
+    payload = {"report_type": state["report_type"], "high_water": state["high_water"], "sent_digest": state["sent_digest"], "sent_time": state["sent_time"],
+               "agents": [[uid, a["payload_hash"], a["digest"]] for uid, a in state["agents"].items()]}
+    try:
+        collection.update_one({'scope': "mailer_state", 'destiny': "server"}, {
+                              '$set': {"payload": payload, "timestamp": get_now_utc_obj()}}, upsert=True)
+    except Exception as e:
+        logger.error("Can't write the mailer state in the DB server: "+str(e))
+        return False
+    return True
+
+
+def get_vulns_collection(collection):
+    """
+    Returns the vulnerability index collection ('<collection>_vulns'), with one flat record per finding in the current snapshot of each agent
+    """
+    return collection.database[collection.name+"_vulns"]
+
+
+def update_vulns_index(collection, records=None):
+    """
+    Receives a list of agent data records and replaces the findings of their agents in the vulnerability index (if the same agent shows up more than once, its last record wins)
+    New findings are inserted first and only then are the ones from older snapshots (lower data ID) deleted, so agents never show up without findings in between
+    Concurrent updates of the same agent (in any order) leave only the findings of its newest snapshot
+    Returns True if all OK; False if NOK
+    """
+    if records == None:
+        records = []
+
+    latest = {}
+    for r in records:
+        latest[r["origin"]] = r
+    if len(latest) == 0:
+        return True
+
+    vuln_records = []
+    for r in latest.values():
+        for v in generate_vulns_from_portscanner(r.get("payload", {}).get("portscanner")):
+            v["origin"] = r["origin"]
+            v["data_id"] = r.get("data_id", r.get("_id"))
+            v["timestamp"] = r["timestamp"]
+            vuln_records.append(v)
+
+    logger.debug("Updating the vulnerability index in the DB server (" +
+                 str(len(vuln_records))+" records) ...")
+    vulns_collection = get_vulns_collection(collection)
+    try:
+        if len(vuln_records) > 0:
+            vulns_collection.insert_many(vuln_records, ordered=False)
+        vulns_collection.delete_many({"$or": [{"origin": o, "data_id": {"$lt": r.get(
+            "data_id", r.get("_id"))}} for o, r in latest.items()]})
+        # A newer snapshot might have been indexed meanwhile (i.e. a concurrent upload), in which case these findings are already stale
+        newer = vulns_collection.distinct("origin", {"$or": [{"origin": o, "data_id": {
+                                          "$gt": r.get("data_id", r.get("_id"))}} for o, r in latest.items()]})
+        if len(newer) > 0:
+            vulns_collection.delete_many({"$or": [{"origin": o, "data_id": latest[o].get(
+                "data_id", latest[o].get("_id"))} for o in newer]})
+    except Exception as e:
+        logger.error(
+            "Can't update the vulnerability index in the DB server: "+str(e))
+        return False
+
+    return True
+
+
+def rebuild_vulns_index(collection):
+    """
+    Rebuilds the vulnerability index from the current snapshots of all agents
+    Returns the number of agents indexed, or False if error
+    """
+    logger.info("Rebuilding the vulnerability index ...")
+    count = 0
+    try:
+        cursor = collection.find({'$and': [{"payload": {'$exists': True}}, {"scope": "agent_data_current"}]}, {
+                                 "origin": 1, "data_id": 1, "timestamp": 1, "payload.portscanner": 1})
+        for r in cursor:
+            r.pop("_id", None)
+            if update_vulns_index(collection, [r]):
+                count += 1
+    except Exception as e:
+        logger.error("Can't rebuild the vulnerability index: "+str(e))
+        return False
+
+    logger.info("Vulnerability index rebuilt for "+str(count)+" agents.")
+
+    return count
+
+
+def get_dict_vulns(collection, agent_uid=None, target_host=None, port=None, source=None, vuln_id=None, exploit_only=False, limit_outputs=1000, page_token=None):
+    """
+    Reads vulnerability findings from the vulnerability index
+    We can filter by agents, target hosts, ports (i.e. '22' or '22/tcp'), script sources ('vulners', 'vulscan'), a substring of the vulnerability ID, and select exploits only
+    The output has the same shape as the 'vuln_only' report (or 'exploit_vuln_only', if exploit_only is set); hosts without findings are only shown when no port, source or ID filters are used
+    Results are read in pages of limit_outputs findings (the findings of an agent may span more than one page), and the page token of the next page is also returned (None if it's the last page)
+    Returns a tuple with a dict of findings and the next page token. Returns (False, None) if data can't be read
+    """
+    logger.debug("Reading data from the DB server ...")
+    out_dict = {}
+    next_page_token = None
+
+    try:
+        if(int(limit_outputs) < 0):
+            limit_outputs = 0
+        query = []
+        if len(port or '') > 0 or len(source or '') > 0 or len(vuln_id or '') > 0:
+            query.append({"type": "vuln"})
+            if exploit_only:
+                query.append({"exploit": True})
+        elif exploit_only:
+            query.append({"$or": [{"type": "host"}, {
+                          "type": "vuln", "exploit": True}]})
+        else:
+            query.append({"type": {"$in": ["host", "vuln"]}})
+        if agent_uid != None:
+            query.append({"origin": {"$in": [
+                "agent_"+u.strip().lower() for u in agent_uid.split(',')]}})
+        if len(target_host or '') > 0:
+            query.append({"target_host": {"$in": [
+                h.strip() for h in target_host.split(',')]}})
+        if len(port or '') > 0:
+            port_patterns = []
+            for p in port.lower().split(','):
+                if "/" in p:
+                    port_patterns.append(re.escape(p.strip()))
+                else:
+                    port_patterns.append(re.escape(p.strip())+"/.*")
+            query.append(
+                {"port": {"$regex": "^("+'|'.join(port_patterns)+")$"}})
+        if len(source or '') > 0:
+            query.append({"source": {"$in": [
+                s.strip().lower() for s in source.split(',')]}})
+        if len(vuln_id or '') > 0:
+            query.append(
+                {"vuln_id": {"$regex": re.escape(vuln_id), "$options": "i"}})
+        if len(page_token or '') > 0:
+            page = decode_page_token(page_token)
+            if page == None:
+                raise ValueError("Invalid page token.")
+            query.append({"_id": {'$gt': ObjectId(page["id"])}})
+        if int(limit_outputs) > 0:
+            # Read one more record than needed, just to know if there's a next page
+            results = list(get_vulns_collection(collection).find(
+                {'$and': query}).sort('_id', 1).limit(int(limit_outputs)+1))
+            if len(results) > int(limit_outputs):
+                results = results[:int(limit_outputs)]
+                next_page_token = encode_page_token(
+                    {"id": str(results[-1]["_id"])})
+        else:
+            results = list(get_vulns_collection(
+                collection).find({'$and': query}).sort('_id', 1))
+    except Exception as e:
+        logger.error("Can't read data from the DB server: "+str(e))
+        return (False, None)
+
+    for r in results:
+        r["agent_uid"] = str(r.get("origin")).split("_", 1)[-1]
+    out_dict = build_vulns_dict(
+        results, report_type="exploit_vuln_only" if exploit_only else "vuln_only")
+    out_dict = dict(sorted(
+        out_dict.items(), key=lambda x: x[0].casefold() if len(x or "") > 0 else None))
+
+    return (out_dict, next_page_token)
+
+
+def generate_vulns_from_agent_data_dict(agent_data_dict, target_host=None, exploit_only=False):
+    """
+    Receives an agent data dict and yields one flat dict per host and per finding of each agent (see generate_vulns_from_portscanner), with the agent UID added
+    We can filter by target hosts (comma-separated), and select findings with exploits only
+    """
+    if type(agent_data_dict) is not dict:
+        return
+    target_hosts = None
+    if len(target_host or '') > 0:
+        target_hosts = target_host.split(',')
+    for agent_uid, agent_dict in agent_data_dict.items():
+        if type(agent_dict) is not dict or type(agent_dict.get("portscanner")) is not dict:
+            continue
+        portscanner_dict = agent_dict["portscanner"]
+        if target_hosts != None:
+            portscanner_dict = {
+                h: portscanner_dict[h] for h in portscanner_dict.keys() if h in target_hosts}
+        for v in generate_vulns_from_portscanner(portscanner_dict, exploit_only=exploit_only):
+            v["agent_uid"] = agent_uid
+            yield v
+
+
+def build_vulns_dict(vuln_records, report_type="vuln_only"):
+    """
+    Receives flat vulnerability records (with their agent UID) and nests them in the report layout: agent -> portscanner -> host -> scanned_ports -> port -> scan_results -> scan -> script -> group -> vuln ID
+    Hosts show their last check (if they have one), while 'exploit_vuln_only' reports only show findings with exploits; hosts without last check nor findings are left out
+    Returns the vuln dict
+    """
+    exploit_only = (report_type or '').lower() == "exploit_vuln_only"
+    new_dict = {}
+    # Findings of the same group come in a row, so the group dict is kept at hand instead of walking down the tree for each of them
+    group_key = None
+    group_dict = None
+    for r in vuln_records:
+        try:
+            if r["type"] == "vuln":
+                if exploit_only and not r["exploit"]:
+                    continue
+                key = (r["agent_uid"], r["target_host"], r["port"],
+                       r["scan"], r["script"], r["group"])
+                if key != group_key:
+                    host_dict = new_dict.setdefault(r["agent_uid"], {}).setdefault(
+                        "portscanner", {}).setdefault(r["target_host"], {})
+                    group_dict = host_dict.setdefault("scanned_ports", {}).setdefault(r["port"], {}).setdefault("scan_results", {}).setdefault(
+                        r["scan"], {}).setdefault(r["script"], {}).setdefault(r["group"], {})
+                    # Set after the findings, so the last check keeps its place if the host record comes later
+                    if "last_check" in r:
+                        host_dict["last_check"] = r["last_check"]
+                    group_key = key
+                group_dict[r["vuln_id"]] = r["details"]
+            elif "last_check" in r:
+                new_dict.setdefault(r["agent_uid"], {}).setdefault("portscanner", {}).setdefault(
+                    r["target_host"], {})["last_check"] = r["last_check"]
+        except (KeyError, TypeError):
+            logger.debug("Ignoring invalid entry when grabbing vulnerabilities.")
+    return new_dict
+
+
+def grab_vuln_only_hosts(portscanner_dict, target_hosts=None):
+    """
+    Walks the portscanner data of an agent and returns its hosts with their last check and the vulners/vulscan script results, as in the 'vuln_only' report
+    Script results are not copied (the returned dict shares them with the input), and parts of the tree that don't have the expected format are skipped
+    Returns a dict of hosts
+    """
+    hosts_dict = {}
+    for host, host_dict in portscanner_dict.items():
+        if (target_hosts != None and host not in target_hosts) or type(host_dict) is not dict:
+            continue
+        new_host_dict = {}
+        for k, v in host_dict.items():
+            if k == "last_check":
+                new_host_dict["last_check"] = v
+            elif k == "scanned_ports" and type(v) is dict:
+                for port, port_dict in v.items():
+                    if type(port_dict) is not dict or type(port_dict.get("scan_results")) is not dict:
+                        continue
+                    for scan, scan_dict in port_dict["scan_results"].items():
+                        if type(scan_dict) is not dict:
+                            continue
+                        for script in scan_dict.keys():
+                            if "vulners" in script or "vulscan" in script:
+                                new_host_dict.setdefault("scanned_ports", {}).setdefault(port, {}).setdefault(
+                                    "scan_results", {}).setdefault(scan, {})[script] = scan_dict[script]
+        if len(new_host_dict) > 0:
+            hosts_dict[host] = new_host_dict
+    return hosts_dict
+
+
+def grab_vulns_from_agent_data_dict(agent_data_dict, target_host=None, report_type="vuln_only", workers=1):
     """
     Receives an agent data dict and returns a list of vulnerabilities, depending on report_type: 'all', 'vuln_only', 'exploit_vuln_only'
+    With more than one worker, agents are split across a pool of processes (one agent per task); sending the agent data to the workers costs more than the walk itself, so this is slower than a single worker
     Returns the vuln dict if all OK; Returns False if anything fails
     """
     if len(report_type or '') == 0:
         report_type = "vuln_only"
 
-    new_dict = {}
+    if type(agent_data_dict) is not dict:
+        logger.error("Error generating new dict: agent data is not a dict.")
+        return False
 
-    if report_type.lower() == "all":
-        try:
-            for a in agent_data_dict.keys():
-                for b in agent_data_dict[a].keys():
-                    if b == "portscanner":
-                        for c in agent_data_dict[a][b].keys():
-                            if len(target_host or '') > 0 and c not in target_host.split(','):
-                                continue
-                            if a not in new_dict.keys():
-                                new_dict[a] = {}
-                            if b not in new_dict[a].keys():
-                                new_dict[a][b] = {}
-                            new_dict[a][b][c] = agent_data_dict[a][b][c]
-        except Exception as e:
-            logger.error("Error generating new dict: "+str(e))
-            return False
-    else:
+    try:
+        workers = int(workers)
+    except:
+        workers = 1
+
+    if workers > 1 and len(agent_data_dict) > 1:
+        new_dict = {}
         try:
-            for a in agent_data_dict.keys():
-                for b in agent_data_dict[a].keys():
-                    if b == "portscanner":
-                        for c in agent_data_dict[a][b].keys():
-                            if len(target_host or '') > 0 and c not in target_host.split(','):
-                                continue
-                            for d in agent_data_dict[a][b][c].keys():
-                                if d == "last_check":
-                                    if a not in new_dict.keys():
-                                        new_dict[a] = {}
-                                    if b not in new_dict[a].keys():
-                                        new_dict[a][b] = {}
-                                    if c not in new_dict[a][b].keys():
-                                        new_dict[a][b][c] = {}
-                                    new_dict[a][b][c]["last_check"] = agent_data_dict[a][b][c]["last_check"]
-                                if d == "scanned_ports":
-                                    for e in agent_data_dict[a][b][c][d].keys():
-                                        for f in agent_data_dict[a][b][c][d][e].keys():
-                                            if f == "scan_results":
-                                                for g in agent_data_dict[a][b][c][d][e][f].keys():
-                                                    for h in agent_data_dict[a][b][c][d][e][f][g].keys():
-                                                        if "vulners" in h or "vulscan" in h:
-                                                            if report_type.lower() == "exploit_vuln_only":
-                                                                for i in agent_data_dict[a][b][c][d][e][f][g][h].keys():
-                                                                    for j in agent_data_dict[a][b][c][d][e][f][g][h][i].keys():
-                                                                        if "siaas_exploit_tag" in agent_data_dict[a][b][c][d][e][f][g][h][i][j]:
-                                                                            if a not in new_dict.keys():
-                                                                                new_dict[a] = {
-                                                                                }
-                                                                            if b not in new_dict[a].keys():
-                                                                                new_dict[a][b] = {
-                                                                                }
-                                                                            if c not in new_dict[a][b].keys():
-                                                                                new_dict[a][b][c] = {
-                                                                                }
-                                                                            if d not in new_dict[a][b][c].keys():
-                                                                                new_dict[a][b][c][d] = {
-                                                                                }
-                                                                            if e not in new_dict[a][b][c][d].keys():
-                                                                                new_dict[a][b][c][d][e] = {
-                                                                                }
-                                                                            if f not in new_dict[a][b][c][d][e].keys():
-                                                                                new_dict[a][b][c][d][e][f] = {
-                                                                                }
-                                                                            if g not in new_dict[a][b][c][d][e][f].keys():
-                                                                                new_dict[a][b][c][d][e][f][g] = {
-                                                                                }
-                                                                            if h not in new_dict[a][b][c][d][e][f][g].keys():
-                                                                                new_dict[a][b][c][d][e][f][g][h] = {
-                                                                                }
-                                                                            if i not in new_dict[a][b][c][d][e][f][g][h].keys():
-                                                                                new_dict[a][b][c][d][e][f][g][h][i] = {
-                                                                                }
-                                                                            new_dict[a][b][c][d][e][f][g][h][i][
-                                                                                j] = agent_data_dict[a][b][c][d][e][f][g][h][i][j]
-                                                            else:  # default to vuln_only
-                                                                if a not in new_dict.keys():
-                                                                    new_dict[a] = {
-                                                                    }
-                                                                if b not in new_dict[a].keys():
-                                                                    new_dict[a][b] = {
-                                                                    }
-                                                                if c not in new_dict[a][b].keys():
-                                                                    new_dict[a][b][c] = {
-                                                                    }
-                                                                if d not in new_dict[a][b][c].keys():
-                                                                    new_dict[a][b][c][d] = {
-                                                                    }
-                                                                if e not in new_dict[a][b][c][d].keys():
-                                                                    new_dict[a][b][c][d][e] = {
-                                                                    }
-                                                                if f not in new_dict[a][b][c][d][e].keys():
-                                                                    new_dict[a][b][c][d][e][f] = {
-                                                                    }
-                                                                if g not in new_dict[a][b][c][d][e][f].keys():
-                                                                    new_dict[a][b][c][d][e][f][g] = {
-                                                                    }
-                                                                new_dict[a][b][c][d][e][f][g][h] = agent_data_dict[a][b][c][d][e][f][g][h]
+            with ProcessPoolExecutor(max_workers=min(workers, len(agent_data_dict))) as executor:
+                for agent_vulns_dict in executor.map(grab_vulns_from_agent_data_dict, [{a: agent_data_dict[a]} for a in agent_data_dict.keys()], repeat(target_host), repeat(report_type)):
+                    if agent_vulns_dict == False:
+                        return False
+                    new_dict.update(agent_vulns_dict)
         except Exception as e:
             logger.error("Error generating new dict: "+str(e))
             return False
+        return new_dict
+
+    new_dict = {}
+    try:
+        if report_type.lower() == "exploit_vuln_only":
+            # Only a few findings have exploits, so these go through the flat records (the others aren't even built)
+            new_dict = build_vulns_dict(generate_vulns_from_agent_data_dict(
+                agent_data_dict, target_host=target_host, exploit_only=True), report_type=report_type)
+        else:
+            target_hosts = None
+            if len(target_host or '') > 0:
+                target_hosts = target_host.split(',')
+            for a, agent_dict in agent_data_dict.items():
+                if type(agent_dict) is not dict or type(agent_dict.get("portscanner")) is not dict:
+                    continue
+                if report_type.lower() == "all":
+                    hosts_dict = {h: agent_dict["portscanner"][h] for h in agent_dict["portscanner"].keys(
+                    ) if target_hosts == None or h in target_hosts}
+                else:  # default to vuln_only
+                    hosts_dict = grab_vuln_only_hosts(
+                        agent_dict["portscanner"], target_hosts=target_hosts)
+                if len(hosts_dict) > 0:
+                    new_dict[a] = {"portscanner": hosts_dict}
+    except Exception as e:
+        logger.error("Error generating new dict: "+str(e))
+        return False
 
     return new_dict
 
@@ -921,9 +2164,35 @@ def insert_in_mongodb_collection(collection, data_to_insert):
         return False
 
 
+def insert_many_in_mongodb_collection(collection, data_to_insert):
+    """
+    Inserts a list of data (usually dicts) into a said collection, in a single unordered bulk insertion
+    Returns a list of booleans with the result of each insertion, in the same order as received. Returns None if nothing could be inserted (i.e. the DB is unreachable)
+    """
+    logger.debug("Inserting data in bulk in the DB server ...")
+    if len(data_to_insert) == 0:
+        return []
+    results = [True] * len(data_to_insert)
+    try:
+        logger.debug("All data that will now be inserted in the database:\n" +
+                     pprint.pformat(data_to_insert, sort_dicts=False))
+        collection.insert_many([copy(d)
+                               for d in data_to_insert], ordered=False)
+        logger.debug("Data successfully inserted in the DB server.")
+    except BulkWriteError as e:
+        for err in e.details.get("writeErrors", []):
+            results[err["index"]] = False
+        logger.error("Can't insert some of the data in the DB server: " +
+                     str(len(e.details.get("writeErrors", [])))+" insertions failed.")
+    except Exception as e:
+        logger.error("Can't insert data in the DB server: "+str(e))
+        return None
+    return results
+
+
 def create_or_update_in_mongodb_collection(collection, data_to_insert):
     """
-    Creates or updates an object with data
+    Creates or updates an object with data, increasing its version
     Returns True if all was OK. Returns False if the insertion failed
     """
     logger.debug("Creating or updating data in the DB server ...")
@@ -932,7 +2201,9 @@ def create_or_update_in_mongodb_collection(collection, data_to_insert):
                      pprint.pformat(data_to_insert, sort_dicts=False))
         data = copy(data_to_insert)
         collection.find_one_and_update(
-            {'destiny': data["destiny"], 'scope': data["scope"]}, {'$set': data}, upsert=True)
+            {'destiny': data["destiny"], 'scope': data["scope"]}, {'$set': data, '$inc': {'version': 1}}, upsert=True)
+        if data["scope"] in ["agent_configs", "server_configs"]:
+            bump_config_generation()
         logger.debug("Data successfully created or updated in the DB server.")
         return True
     except Exception as e:
@@ -977,22 +2248,414 @@ def connect_mongodb_collection(mongo_user=None, mongo_password=None, mongo_host=
         return None
 
 
+def get_history_collection(collection):
+    """
+    Returns the collection where the agent data history is stored
+    That's the time-series collection '<collection>_history' if 'mongo_history_timeseries' is enabled and the collection exists; else, it's the collection itself
+    """
+    if collection.full_name in HISTORY_COLLECTIONS.keys():
+        return HISTORY_COLLECTIONS[collection.full_name]
+
+    history_collection = collection
+    if validate_bool_string(get_config_from_configs_db(config_name="mongo_history_timeseries")):
+        try:
+            name = collection.name+"_history"
+            if len(list(collection.database.list_collections(filter={"name": name, "type": "timeseries"}))) > 0:
+                history_collection = collection.database[name]
+            else:
+                logger.warning("Time-series collection '"+name +
+                               "' doesn't exist. Agent data history will be kept in the main collection.")
+        except Exception as e:
+            logger.error(
+                "Can't check the time-series collection in the DB server: "+str(e))
+            return collection
+
+    HISTORY_COLLECTIONS[collection.full_name] = history_collection
+    return history_collection
+
+
+def set_history_ttl(collection, days_to_keep=None):
+    """
+    Reconciles the TTL-based expiry of the agent data history, so MongoDB deletes records older than days_to_keep continuously, in small pieces
+    In the main collection, that's a TTL index on 'last_seen', partial on the 'agent_data' scope (so runs of unchanged uploads only expire once they stop being seen); in a time-series history collection, it's the collection's own expiry
+    If days_to_keep is None, TTL-based expiry is removed
+    Returns True if all OK; False if NOK
+    """
+    history_collection = get_history_collection(collection)
+    ttl_name = "agent_data_ttl_index"
+    if days_to_keep == None:
+        expire_after = None
+    else:
+        expire_after = int(days_to_keep)*86400
+
+    try:
+        if history_collection != collection:
+            options = list(collection.database.list_collections(
+                filter={"name": history_collection.name}))[0].get("options", {})
+            if options.get("expireAfterSeconds") != expire_after:
+                logger.info("Setting the expiry of the time-series collection to " +
+                            str(expire_after)+" seconds ...")
+                collection.database.command({"collMod": history_collection.name,
+                                             "expireAfterSeconds": expire_after if expire_after != None else "off"})
+            return True
+
+        existing_indexes = collection.index_information()
+        # Older versions had the TTL index on 'timestamp'
+        if ttl_name in existing_indexes.keys() and (expire_after == None or existing_indexes[ttl_name].get("key") != [("last_seen", 1)]):
+            logger.info("Dropping TTL index '"+ttl_name+"' ...")
+            collection.drop_index(ttl_name)
+            existing_indexes.pop(ttl_name)
+        if expire_after != None and ttl_name not in existing_indexes.keys():
+            # Records without 'last_seen' would never expire
+            collection.update_many({'$and': [{"scope": "agent_data"}, {"last_seen": {'$exists': False}}]}, [
+                                   {'$set': {"last_seen": "$timestamp"}}])
+            logger.info("Creating TTL index '"+ttl_name+"' (" +
+                        str(expire_after)+" seconds) ...")
+            collection.create_index([("last_seen", 1)], name=ttl_name, expireAfterSeconds=expire_after,
+                                    partialFilterExpression={"scope": "agent_data"})
+        elif expire_after != None and existing_indexes[ttl_name].get("expireAfterSeconds") != expire_after:
+            logger.info("Changing TTL index '"+ttl_name+"' to " +
+                        str(expire_after)+" seconds ...")
+            collection.database.command({"collMod": collection.name, "index": {
+                                        "name": ttl_name, "expireAfterSeconds": expire_after}})
+    except Exception as e:
+        logger.error(
+            "Can't set the expiry of the agent data history in the DB server: "+str(e))
+        return False
+
+    return True
+
+
+def create_history_timeseries_collection(collection, batch_size=1000):
+    """
+    Creates the time-series collection for the agent data history ('<collection>_history', with timeField 'timestamp' and metaField 'origin'), if 'mongo_history_timeseries' is enabled and it doesn't exist yet
+    Any agent data history still in the main collection is then moved there, in batches (needs MongoDB 5.0 or newer). Moving can be safely retried if it's interrupted
+    Returns True if all OK; False if NOK
+    """
+    name = collection.name+"_history"
+    if not validate_bool_string(get_config_from_configs_db(config_name="mongo_history_timeseries")):
+        try:
+            if name in collection.database.list_collection_names():
+                logger.warning("Time-series collection '"+name +
+                               "' exists, but 'mongo_history_timeseries' is disabled. The agent data history in it won't be shown.")
+        except:
+            pass
+        return True
+
+    try:
+        if name not in collection.database.list_collection_names():
+            logger.info("Creating time-series collection '" +
+                        name+"' for the agent data history ...")
+            collection.database.create_collection(name, timeseries={
+                "timeField": "timestamp", "metaField": "origin", "granularity": "minutes"})
+        history_collection = collection.database[name]
+        history_collection.create_index(
+            [("origin", 1), ("timestamp", -1)], name="origin_timestamp_index")
+    except Exception as e:
+        logger.error(
+            "Can't create the time-series collection in the DB server: "+str(e))
+        return False
+
+    HISTORY_COLLECTIONS.pop(collection.full_name, None)
+
+    count = 0
+    try:
+        while True:
+            batch = list(collection.find({"scope": "agent_data"}).sort(
+                '_id', 1).limit(batch_size))
+            if len(batch) == 0:
+                break
+            # Time-series collections don't enforce unique IDs, so records moved before an interrupted run (inserted, but not deleted here) are skipped
+            moved = set([d["_id"] for d in history_collection.find({"origin": {"$in": list(set([b["origin"] for b in batch]))}, "timestamp": {"$gte": min(
+                [b["timestamp"] for b in batch]), "$lte": max([b["timestamp"] for b in batch])}, "_id": {"$in": [b["_id"] for b in batch]}}, {"_id": 1})])
+            to_move = [b for b in batch if b["_id"] not in moved]
+            if len(to_move) > 0:
+                history_collection.insert_many(to_move, ordered=False)
+            collection.delete_many(
+                {'$and': [{"scope": "agent_data"}, {"_id": {"$in": [b["_id"] for b in batch]}}]})
+            count += len(batch)
+    except Exception as e:
+        logger.error(
+            "Can't move the agent data history to the time-series collection: "+str(e))
+        return False
+    if count > 0:
+        logger.info("Agent data history records moved to the time-series collection: " +
+                    str(count)+".")
+
+    return True
+
+
+def create_mongodb_indexes(collection, indexes=None, obsolete_indexes=None):
+    """
+    Reconciles the indexes of a MongoDB collection with the managed index set
+    Missing indexes are created, indexes with a changed definition are recreated, and obsolete indexes are dropped
+    Returns True if all OK; False if NOK
+    """
+    if indexes == None:
+        indexes = MONGODB_INDEXES
+    if obsolete_indexes == None:
+        obsolete_indexes = MONGODB_OBSOLETE_INDEXES
+
+    logger.debug("Reconciling indexes in the DB server ...")
+    result = True
+    try:
+        existing_indexes = collection.index_information()
+    except Exception as e:
+        logger.error("Can't read indexes from the DB server: "+str(e))
+        return False
+
+    for i in indexes:
+        options = {}
+        for k in i.keys():
+            if k not in ["name", "keys"]:
+                options[k] = i[k]
+        try:
+            if i["name"] in existing_indexes.keys():
+                existing = existing_indexes[i["name"]]
+                existing_keys = [(k, int(v)) for k, v in existing["key"]]
+                existing_options = {}
+                for k in options.keys():
+                    if k in existing.keys():
+                        existing_options[k] = existing[k]
+                if existing_keys == i["keys"] and existing_options == options:
+                    continue
+                logger.info("Index '"+i["name"] +
+                            "' definition has changed. Recreating it ...")
+                collection.drop_index(i["name"])
+            logger.info("Creating index '"+i["name"]+"' ...")
+            collection.create_index(i["keys"], name=i["name"], **options)
+        except Exception as e:
+            logger.error("Can't create index '" +
+                         i["name"]+"' in the DB server: "+str(e))
+            result = False
+
+    for name in obsolete_indexes:
+        try:
+            if name in existing_indexes.keys():
+                logger.info("Dropping obsolete index '"+name+"' ...")
+                collection.drop_index(name)
+        except Exception as e:
+            logger.error("Can't drop index '"+name +
+                         "' in the DB server: "+str(e))
+            result = False
+
+    return result
+
+
+def get_canonical_mongodb_queries():
+    """
+    Returns the list of query shapes used by this module, as (name, filter, sort) tuples
+    Used to verify the query plans against the managed indexes. Keep this in sync with the query functions above
+    """
+    agent = "agent_00000000-0000-0000-0000-000000000000"
+    last_d = datetime.utcnow() - timedelta(days=14)
+    return [
+        ("current_server_configs", {'$and': [{"payload": {'$exists': True}}, {
+            "scope": "server_configs"}, {"destiny": "server"}]}, [('_id', -1)]),
+        ("active_agents", {'$and': [{"scope": "agent_registry"}, {
+            "last_seen": {'$exists': True}}]}, [('last_seen', -1)]),
+        ("history_agent_data", {'$and': [{"payload": {'$exists': True}}, {
+            "scope": "agent_data"}, get_history_recent_filter(last_d)]}, [('_id', -1)]),
+        ("history_agent_data_by_agent", {'$and': [{"payload": {'$exists': True}}, {"scope": "agent_data"},
+                                                  get_history_recent_filter(last_d), {"origin": {'$in': [agent]}}]}, [('_id', -1)]),
+        ("history_agent_data_page", {'$and': [{"payload": {'$exists': True}}, {"scope": "agent_data"},
+                                              get_history_recent_filter(last_d), {"_id": {'$lt': ObjectId()}}]}, [('_id', -1)]),
+        ("current_agent_data", {'$and': [{"payload": {'$exists': True}}, {
+            "scope": "agent_data_current"}]}, [('origin', 1)]),
+        ("current_agent_data_by_agent", {'$and': [{"payload": {'$exists': True}}, {
+            "scope": "agent_data_current"}, {"origin": {'$in': [agent]}}]}, None),
+        ("current_agent_data_stored_since", {'$and': [{"scope": "agent_data_current"}, {
+            "last_stored": {"$gt": last_d}}]}, None),
+        ("current_agent_configs", {'$and': [{"payload": {'$exists': True}}, {
+            "scope": "agent_configs"}, {"destiny": {"$regex": "^agent_"}}]}, [('destiny', 1)]),
+        ("current_agent_configs_by_agent", {'$and': [{"payload": {'$exists': True}}, {
+            "scope": "agent_configs"}, {"destiny": agent}]}, [('_id', -1)]),
+        ("old_records", {'$and': [{"payload": {'$exists': True}}, {
+            "scope": "agent_data"}, get_history_expired_filter(last_d)]}, None),
+        ("old_records_by_agent", {'$and': [{"payload": {'$exists': True}}, {"scope": "agent_data"}, get_history_expired_filter(last_d), {
+            '$or': [{"destiny": {'$in': [agent]}}, {"origin": {'$in': [agent]}}]}]}, None),
+        ("old_records_batch", {'$and': [{"payload": {'$exists': True}}, {"scope": "agent_data"}, {"_id": {"$gt": ObjectId.from_datetime(last_d - timedelta(days=1)), "$lt": ObjectId.from_datetime(last_d)}},
+            get_history_expired_filter(last_d)]}, [('_id', 1)]),
+    ]
+
+
+def get_query_plan_stages(plan):
+    """
+    Returns the set of all stage names found in a query plan (or part of it), walking it recursively
+    """
+    stages = set()
+    if isinstance(plan, dict):
+        for k in plan.keys():
+            if k == "stage" and type(plan[k]) is str:
+                stages.add(plan[k])
+            else:
+                stages = stages | get_query_plan_stages(plan[k])
+    elif isinstance(plan, list):
+        for p in plan:
+            stages = stages | get_query_plan_stages(p)
+    return stages
+
+
+def check_mongodb_query_plans(collection, queries=None):
+    """
+    Runs explain() on each canonical query and logs a warning if any of them is planned as a collection scan or an in-memory sort
+    Returns True if all query plans are OK; False if any of them isn't, or if something failed
+    """
+    if queries == None:
+        queries = get_canonical_mongodb_queries()
+
+    logger.debug("Verifying query plans in the DB server ...")
+    result = True
+    for name, query, sort in queries:
+        try:
+            cursor = collection.find(query)
+            if sort != None:
+                cursor = cursor.sort(sort)
+            plan = cursor.limit(1).explain()
+            stages = get_query_plan_stages(
+                plan["queryPlanner"]["winningPlan"])
+            if "COLLSCAN" in stages:
+                logger.warning("Query '"+name +
+                               "' is planned as a collection scan (COLLSCAN). Check the DB indexes!")
+                result = False
+            if "SORT" in stages:
+                logger.warning("Query '"+name +
+                               "' is planned with an in-memory sort (SORT). Check the DB indexes!")
+                result = False
+        except Exception as e:
+            logger.error("Can't verify the query plan for '" +
+                         name+"': "+str(e))
+            result = False
+
+    if result:
+        logger.debug("All query plans are using indexes.")
+
+    return result
+
+
+def init_local_state_store(files_to_share, segment_size=8388608):
+    """
+    Creates one shared memory segment for each local DB file in the list, so processes forked afterwards can exchange their contents without going through the disk
+    Segments are anonymous mappings, so memory is only used for the pages that are actually written
+    Writers of a segment (in any process) take turns through an exclusive lock on '<file>.lock', so there is only one writer at a time
+    Returns True if all went OK
+    Returns False if it failed
+    """
+    logger.debug("Initializing the local state store ...")
+    try:
+        for f in files_to_share:
+            LOCAL_STATE_STORE[os.path.abspath(f)] = {"segment": mmap.mmap(-1, int(
+                segment_size)), "cache": (0, None)}
+        return True
+    except Exception as e:
+        logger.error("There was an error initializing the local state store: "+str(e))
+        return False
+
+
+def write_to_local_state(file_to_write, data_to_insert):
+    """
+    Publishes data (usually a dict) in the shared memory segment of a local DB file, as a new versioned snapshot
+    The version is odd while the snapshot is being written, so readers know they have to retry
+    Writers hold an exclusive lock on '<file>.lock' (released by the OS if the process dies), so there is a single writer per segment at a time
+    Returns True if all went OK
+    Returns False if the file has no segment or if it failed (if the snapshot is too large, readers fall back to the local file)
+    """
+    file_path = os.path.abspath(file_to_write)
+    store = LOCAL_STATE_STORE.get(file_path)
+    if store == None:
+        return False
+    try:
+        content = json.dumps(data_to_insert, sort_keys=False).encode('utf-8')
+        segment = store["segment"]
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        # Each call opens the lock file again, as flock() locks shared through fork() wouldn't exclude the other processes
+        with open(file_path+".lock", 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            version = LOCAL_STATE_HEADER.unpack_from(segment, 0)[0]
+            if version % 2 == 1:
+                version += 1  # with the lock held, this can only be a previous writer that died midway
+            LOCAL_STATE_HEADER.pack_into(segment, 0, version+1, 0, 0)
+            if LOCAL_STATE_HEADER.size+len(content) > len(segment):
+                logger.warning("Local state snapshot for "+file_to_write +
+                               " is too large for the shared memory segment. Readers will use the local file instead.")
+                LOCAL_STATE_HEADER.pack_into(
+                    segment, 0, version+2, LOCAL_STATE_TOO_LARGE, 0)
+                return False
+            segment[LOCAL_STATE_HEADER.size:LOCAL_STATE_HEADER.size +
+                    len(content)] = content
+            LOCAL_STATE_HEADER.pack_into(
+                segment, 0, version+2, len(content), zlib.crc32(content))
+        return True
+    except Exception as e:
+        logger.error("There was an error while publishing the local state snapshot for " +
+                     file_to_write+": "+str(e))
+        return False
+
+
+def read_from_local_state(file_to_read, retries=10):
+    """
+    Reads the latest snapshot of a local DB file from its shared memory segment
+    Each new version is copied out of the segment and parsed once; while the version doesn't change, the same parsed object is returned after reading just the header (so it must not be modified)
+    Returns None if the file has no segment, if nothing was published yet, or if the snapshot is too large or can't be read (callers should then read the local file)
+    """
+    store = LOCAL_STATE_STORE.get(os.path.abspath(file_to_read))
+    if store == None:
+        return None
+    segment = store["segment"]
+    for i in range(int(retries)):
+        try:
+            version, length, checksum = LOCAL_STATE_HEADER.unpack_from(
+                segment, 0)
+            if version == 0 or length == LOCAL_STATE_TOO_LARGE:
+                return None
+            if version % 2 == 1:
+                time.sleep(0.001)  # snapshot is being written
+                continue
+            cached_version, cached_data = store["cache"]
+            if cached_version == version:
+                return cached_data
+            content = segment[LOCAL_STATE_HEADER.size:
+                              LOCAL_STATE_HEADER.size+length]
+            if LOCAL_STATE_HEADER.unpack_from(segment, 0)[0] != version or zlib.crc32(content) != checksum:
+                time.sleep(0.001)  # snapshot changed while it was being copied
+                continue
+            data = json.loads(content.decode('utf-8'))
+            store["cache"] = (version, data)
+            return data
+        except Exception as e:
+            logger.debug("There was an error reading the local state snapshot for " +
+                         file_to_read+": "+str(e))
+            return None
+    logger.debug("Couldn't get a consistent local state snapshot for " +
+                 file_to_read+". Reading the local file instead.")
+    return None
+
+
 def write_to_local_file(file_to_write, data_to_insert):
     """
     Writes data (usually a dict) to a local file, after converting it to a JSON format
+    If the file has a shared memory segment in the local state store, the data is also published there
+    The file is written to a temporary file first and then renamed, so readers never see a partially written file
     Returns True if all went OK
     Returns False if it failed
     """
     logger.debug("Inserting data to local file "+file_to_write+" ...")
+    write_to_local_state(file_to_write, data_to_insert)
     try:
         os.makedirs(os.path.dirname(os.path.join(
             sys.path[0], file_to_write)), exist_ok=True)
-        logger.debug("All data that will now be written to the file:\n" +
-                     pprint.pformat(data_to_insert, sort_dicts=False))
-        with open(file_to_write, 'w') as file:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("All data that will now be written to the file:\n" +
+                         pprint.pformat(data_to_insert, sort_dicts=False))
+        temp_file = file_to_write+"."+str(os.getpid())+"." + \
+            str(threading.get_ident())+".tmp"
+        with open(temp_file, 'w') as file:
             file.write(json.dumps(data_to_insert, sort_keys=False))
-            logger.debug("Local file write ended successfully.")
-            return True
+        if os.path.exists(file_to_write):
+            os.chmod(temp_file, os.stat(file_to_write).st_mode)
+        os.replace(temp_file, file_to_write)
+        logger.debug("Local file write ended successfully.")
+        return True
     except Exception as e:
         logger.error(
             "There was an error while writing to the local file "+file_to_write+": "+str(e))
@@ -1002,14 +2665,18 @@ def write_to_local_file(file_to_write, data_to_insert):
 def read_from_local_file(file_to_read):
     """
     Reads data from local file and returns it
+    If the file has a snapshot published in the local state store, it is read from there instead
     It will return None if it failed
     """
+    content = read_from_local_state(file_to_read)
+    if content != None:
+        return content
     logger.debug("Reading from local file "+file_to_read+" ...")
     try:
         with open(file_to_read, 'r') as file:
             content = file.read()
             try:
-                content = eval(content)
+                content = json.loads(content)
             except:
                 pass
             return content
@@ -1094,6 +2761,158 @@ def get_or_create_unique_system_id():
     return new_uid.lower()
 
 
+def parse_json_pointer(pointer):
+    """
+    Splits a JSON pointer (RFC 6901) into its reference tokens
+    Returns None if the pointer is not valid
+    """
+    if type(pointer) is not str:
+        return None
+    if pointer == "":
+        return []
+    if not pointer.startswith("/"):
+        return None
+    return [t.replace("~1", "/").replace("~0", "~") for t in pointer[1:].split("/")]
+
+
+def get_json_pointer_value(document, tokens):
+    """
+    Returns the value referenced by a list of JSON pointer tokens inside a document
+    Raises an exception if it doesn't exist
+    """
+    value = document
+    for t in tokens:
+        if type(value) is dict:
+            value = value[t]
+        elif type(value) is list:
+            if not re.match("^(0|[1-9][0-9]*)$", t):
+                raise ValueError("Invalid array index: "+t)
+            value = value[int(t)]
+        else:
+            raise ValueError("Path not found: /"+'/'.join(tokens))
+    return value
+
+
+def add_json_pointer_value(document, tokens, value):
+    """
+    Adds (or replaces) a value at the location referenced by a list of JSON pointer tokens inside a document
+    Returns the resulting document (a new value, if the whole document was replaced). Raises an exception if it can't be added
+    """
+    if len(tokens) == 0:
+        return value
+    parent = get_json_pointer_value(document, tokens[:-1])
+    key = tokens[-1]
+    if type(parent) is dict:
+        parent[key] = value
+    elif type(parent) is list:
+        if key == "-":
+            parent.append(value)
+        elif re.match("^(0|[1-9][0-9]*)$", key) and int(key) <= len(parent):
+            parent.insert(int(key), value)
+        else:
+            raise ValueError("Invalid array index: "+key)
+    else:
+        raise ValueError("Path not found: /"+'/'.join(tokens))
+    return document
+
+
+def remove_json_pointer_value(document, tokens):
+    """
+    Removes the value at the location referenced by a list of JSON pointer tokens inside a document
+    Returns the removed value. Raises an exception if it doesn't exist
+    """
+    if len(tokens) == 0:
+        raise ValueError("The whole document can't be removed.")
+    parent = get_json_pointer_value(document, tokens[:-1])
+    key = tokens[-1]
+    if type(parent) is dict:
+        return parent.pop(key)
+    if type(parent) is list and re.match("^(0|[1-9][0-9]*)$", key):
+        return parent.pop(int(key))
+    raise ValueError("Path not found: /"+'/'.join(tokens))
+
+
+def apply_json_patch(document, patch):
+    """
+    Applies a JSON patch (RFC 6902) to a copy of a document. Supports the operations add, remove, replace, move, copy and test
+    Patches are atomic: if any operation fails, nothing is applied
+    Returns the patched document; None if the patch is not valid or can't be applied
+    """
+    if type(patch) is not list:
+        logger.error("JSON patch is not a list of operations.")
+        return None
+
+    result = deepcopy(document)
+    try:
+        for operation in patch:
+            op = operation["op"]
+            path = parse_json_pointer(operation["path"])
+            if path == None:
+                raise ValueError("Invalid path: "+str(operation["path"]))
+            if op in ["move", "copy"]:
+                from_path = parse_json_pointer(operation["from"])
+                if from_path == None:
+                    raise ValueError("Invalid path: "+str(operation["from"]))
+            if op == "add":
+                result = add_json_pointer_value(
+                    result, path, deepcopy(operation["value"]))
+            elif op == "remove":
+                remove_json_pointer_value(result, path)
+            elif op == "replace":
+                if len(path) > 0:
+                    remove_json_pointer_value(result, path)
+                result = add_json_pointer_value(
+                    result, path, deepcopy(operation["value"]))
+            elif op == "move":
+                if path[:len(from_path)] == from_path and path != from_path:
+                    raise ValueError(
+                        "A value can't be moved into one of its children.")
+                value = remove_json_pointer_value(result, from_path)
+                result = add_json_pointer_value(result, path, value)
+            elif op == "copy":
+                value = deepcopy(get_json_pointer_value(result, from_path))
+                result = add_json_pointer_value(result, path, value)
+            elif op == "test":
+                if get_json_pointer_value(result, path) != operation["value"]:
+                    raise ValueError("Test failed at: " +
+                                     str(operation["path"]))
+            else:
+                raise ValueError("Unknown operation: "+str(op))
+    except Exception as e:
+        logger.error("Can't apply JSON patch: "+str(e))
+        return None
+
+    return result
+
+
+def encode_page_token(page_dict):
+    """
+    Encodes a dict with the position of the next page into an opaque (URL-safe) page token
+    Returns None if it fails
+    """
+    try:
+        return base64.urlsafe_b64encode(json.dumps(page_dict, separators=(',', ':')).encode('utf-8')).decode('ascii').rstrip('=')
+    except Exception as e:
+        logger.error("Can't encode page token: "+str(e))
+        return None
+
+
+def decode_page_token(page_token):
+    """
+    Decodes an opaque page token back into a dict with the position of the next page
+    Returns None if the page token is not valid
+    """
+    try:
+        page_dict = json.loads(base64.urlsafe_b64decode(
+            page_token+'=' * (-len(page_token) % 4)).decode('utf-8'))
+        if type(page_dict) is not dict or not ObjectId.is_valid(page_dict["id"]):
+            raise ValueError("Page token has an invalid format.")
+        return page_dict
+    except Exception as e:
+        logger.debug("Invalid page token received: "+str(e))
+        return None
+
+
 def validate_bool_string(input_string, default_output=False):
     """
     Validates string format and if it's not empty and returns a boolean
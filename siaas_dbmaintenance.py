@@ -14,23 +14,81 @@ logger = logging.getLogger(__name__)
 def delete_history_data(db_collection, days_to_keep):
     """
     Receives a MongoDB collection and number of days to keep
-    Deletes all documents older than those days
+    Deletes all documents older than those days, in throttled batches (resuming any interrupted cleanup first)
     Returns True if all OK; False if something failed
     """
     logger.info("Performing history database cleanup, keeping last " +
                 str(days_to_keep)+" days ...")
-    deleted_count = siaas_aux.delete_all_records_older_than(
-        db_collection, scope="agent_data", agent_uid=None, days_to_keep=days_to_keep)
+
+    try:
+        batch_size = int(siaas_aux.get_config_from_configs_db(
+            config_name="dbmaintenance_delete_batch_size"))
+        if batch_size < 1:
+            raise ValueError("Batch size must be positive.")
+    except:
+        batch_size = 1000
+    try:
+        docs_per_sec = int(siaas_aux.get_config_from_configs_db(
+            config_name="dbmaintenance_delete_docs_per_sec"))
+        if docs_per_sec < 1:
+            raise ValueError("Deletion rate must be positive.")
+    except:
+        docs_per_sec = 5000
+
+    deleted_count = siaas_aux.delete_agent_data_in_batches(
+        db_collection, days_to_keep=days_to_keep, batch_size=batch_size, docs_per_sec=docs_per_sec)
     if type(deleted_count) == bool and deleted_count == False:
         logger.error(
             "DB could not be cleaned up. This might result in an eventual disk exhaustion in the server!")
         return False
+
+    # Whatever is left: history in a time-series collection, and stale current snapshots and agents
+    remaining_count = siaas_aux.delete_all_records_older_than(
+        db_collection, scope="agent_data", agent_uid=None, days_to_keep=days_to_keep)
+    if type(remaining_count) == bool and remaining_count == False:
+        logger.error(
+            "DB could not be cleaned up. This might result in an eventual disk exhaustion in the server!")
+        return False
     else:
         logger.info("DB cleanup finished. " +
-                    str(deleted_count)+" records deleted.")
+                    str(deleted_count+remaining_count)+" records deleted.")
         return True
 
 
+def get_retention_configs():
+    """
+    Reads the retention configs: number of days to keep, and if the history expires through TTL
+    Returns a tuple with both
+    """
+    try:
+        days_to_keep = int(siaas_aux.get_config_from_configs_db(
+            config_name="dbmaintenance_history_days_to_keep"))
+        if days_to_keep < 0:
+            raise ValueError(
+                "Number of historical days can't be negative.")
+    except:
+        logger.debug(
+            "The number of days to keep in the database is not configured or is invalid. Using the value of 2 weeks by default.")
+        days_to_keep = 14
+    ttl = siaas_aux.validate_bool_string(siaas_aux.get_config_from_configs_db(
+        config_name="dbmaintenance_history_ttl"), default_output=True)
+    return (days_to_keep, ttl)
+
+
+def apply_retention(db_collection, days_to_keep, ttl):
+    """
+    Makes the DB expire history records older than the days to keep by itself (TTL), or stops it from doing so
+    Returns True if all OK; False if something failed
+    """
+    if ttl:
+        logger.info("History records will expire continuously after " +
+                    str(days_to_keep)+" days (TTL).")
+        return siaas_aux.set_history_ttl(db_collection, days_to_keep=days_to_keep)
+    logger.info(
+        "History records will only be deleted by the DB cleanup (TTL is disabled).")
+    return siaas_aux.set_history_ttl(db_collection, days_to_keep=None)
+
+
 def loop():
     """
     DB Maintenance loop (calls the delete historical data function)
@@ -74,17 +132,12 @@ def loop():
 
         logger.debug("Loop running ...")
 
-        try:
-            days_to_keep = int(siaas_aux.get_config_from_configs_db(
-                config_name="dbmaintenance_history_days_to_keep"))
-            if days_to_keep < 0:
-                raise ValueError(
-                    "Number of historical days can't be negative.")
-        except:
-            logger.debug(
-                "The number of days to keep in the database is not configured or is invalid. Using the value of 2 weeks by default.")
-            days_to_keep = 14
+        retention = get_retention_configs()
+        days_to_keep = retention[0]
+        if not apply_retention(db_collection, *retention):
+            retention = None  # try again after the next sleep slice
 
+        # With TTL, the DB cleanup only catches records the DB hasn't expired yet, and stale agents
         delete_history_data(db_collection, days_to_keep)
 
         # Sleep before next loop
@@ -93,11 +146,19 @@ def loop():
                 config_name="dbmaintenance_loop_interval_sec"))
             logger.debug("Sleeping for "+str(sleep_time) +
                          " seconds before next loop ...")
-            time.sleep(sleep_time)
         except:
             logger.debug(
                 "The interval loop time is not configured or is invalid. Sleeping now for 1 day by default ...")
-            time.sleep(86400)
+            sleep_time = 86400
+
+        # Sleep in slices, so retention config changes are applied to the DB right away
+        deadline = time.monotonic() + sleep_time
+        while time.monotonic() < deadline:
+            time.sleep(min(60, max(deadline - time.monotonic(), 0)))
+            current_retention = get_retention_configs()
+            if current_retention != retention:
+                if apply_retention(db_collection, *current_retention):
+                    retention = current_retention
 
 
 if __name__ == "__main__":
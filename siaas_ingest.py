@@ -0,0 +1,242 @@
+# Intelligent System for Automation of Security Audits (SIAAS)
+# Server - Ingestion module
+# By João Pedro Seara, 2022-2024
+
+import siaas_aux
+import atexit
+import logging
+import queue
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+INGEST_QUEUE = None
+INGEST_COLLECTION = None
+INGEST_THREAD = None
+INGEST_STOP = threading.Event()
+INGEST_LOCK = threading.Lock()
+INGEST_METRICS = {
+    "queue_depth": 0,
+    "queue_capacity": 0,
+    "enqueued_total": 0,
+    "rejected_total": 0,
+    "written_total": 0,
+    "failed_total": 0,
+    "flushes_total": 0,
+    "last_flush_size": 0,
+    "last_flush_latency_ms": 0.0,
+    "avg_flush_latency_ms": 0.0,
+    "max_flush_latency_ms": 0.0,
+    "last_flush": None
+}
+
+
+def get_int_config(config_name, default_value, min_value=1):
+    """
+    Reads an integer configuration from the configs DB
+    Returns the default value if the config is not defined or is invalid
+    """
+    try:
+        value = int(siaas_aux.get_config_from_configs_db(
+            config_name=config_name))
+        if value < min_value:
+            raise ValueError("Value is too low.")
+        return value
+    except:
+        return default_value
+
+
+def is_async_enabled():
+    """
+    Returns True if agent data uploads are configured to be queued and written in the background; False otherwise
+    """
+    return INGEST_QUEUE != None and siaas_aux.validate_bool_string(siaas_aux.get_config_from_configs_db(config_name="ingest_async"))
+
+
+def get_retry_after():
+    """
+    Returns the number of seconds agents should wait before retrying when the ingestion queue is full
+    """
+    return get_int_config("ingest_retry_after_sec", 5)
+
+
+def enqueue(record):
+    """
+    Puts an agent data record (already validated) in the ingestion queue, without blocking
+    Returns True if the record was queued; False if the queue is full, not running, or stopping
+    """
+    if INGEST_QUEUE == None:
+        return False
+    # The stop flag is checked and the record queued under the lock, so nothing is queued after the last drain
+    with INGEST_LOCK:
+        if INGEST_STOP.is_set():
+            INGEST_METRICS["rejected_total"] += 1
+            logger.warning("Ingestion queue is stopping. Rejecting agent data upload [" +
+                           str(record.get("origin"))+"].")
+            return False
+        try:
+            INGEST_QUEUE.put_nowait(record)
+            INGEST_METRICS["enqueued_total"] += 1
+            return True
+        except queue.Full:
+            INGEST_METRICS["rejected_total"] += 1
+    logger.warning("Ingestion queue is full. Rejecting agent data upload [" +
+                   str(record.get("origin"))+"].")
+    return False
+
+
+def get_metrics():
+    """
+    Returns a dict with the ingestion queue metrics (queue depth, totals, and flush latency)
+    """
+    with INGEST_LOCK:
+        metrics = dict(INGEST_METRICS)
+    metrics["enabled"] = is_async_enabled()
+    if INGEST_QUEUE != None:
+        metrics["queue_depth"] = INGEST_QUEUE.qsize()
+    return metrics
+
+
+def flush(db_collection, batch):
+    """
+    Writes a batch of agent data records in the DB, in bulk, and updates the agents' current snapshots
+    Returns True if the batch was handled (records which failed individually are dropped); False if the DB couldn't be reached, so the batch must be retried
+    """
+    start = time.perf_counter()
+    stored = siaas_aux.store_agent_data_records(db_collection, batch)
+    if stored == None:
+        return False
+    stored_records = [r for r, ok in zip(batch, stored) if ok]
+    latency_ms = (time.perf_counter() - start) * 1000
+    with INGEST_LOCK:
+        INGEST_METRICS["written_total"] += len(stored_records)
+        INGEST_METRICS["failed_total"] += len(batch) - len(stored_records)
+        INGEST_METRICS["flushes_total"] += 1
+        INGEST_METRICS["last_flush_size"] = len(batch)
+        INGEST_METRICS["last_flush_latency_ms"] = round(latency_ms, 3)
+        INGEST_METRICS["avg_flush_latency_ms"] = round(
+            latency_ms if INGEST_METRICS["flushes_total"] == 1 else 0.9*INGEST_METRICS["avg_flush_latency_ms"]+0.1*latency_ms, 3)
+        INGEST_METRICS["max_flush_latency_ms"] = round(
+            max(INGEST_METRICS["max_flush_latency_ms"], latency_ms), 3)
+        INGEST_METRICS["last_flush"] = siaas_aux.get_now_utc_str()
+    logger.debug("Flushed "+str(len(stored_records))+" of "+str(len(batch)) +
+                 " queued agent data records in "+str(round(latency_ms, 3))+" ms.")
+    return True
+
+
+def drain(db_collection):
+    """
+    Flushes everything that is still in the ingestion queue (used when stopping)
+    """
+    if INGEST_QUEUE == None:
+        return
+    batch = []
+    while True:
+        try:
+            batch.append(INGEST_QUEUE.get_nowait())
+        except queue.Empty:
+            break
+    if len(batch) > 0:
+        logger.info("Flushing "+str(len(batch)) +
+                    " queued agent data records before exiting ...")
+        if not flush(db_collection, batch):
+            logger.error("Couldn't write "+str(len(batch)) +
+                         " queued agent data records in the DB before exiting. These uploads are lost.")
+
+
+def loop(db_collection):
+    """
+    Ingestion loop (group commit)
+    Waits for the first queued record, then keeps collecting records until the batch is full or the flush interval expires, and writes them all at once
+    If the DB can't be reached, the same batch is retried with an increasing delay, and the queue fills up until uploads are rejected
+    When the queue is stopping, the batch in hand is still written (one last try if the DB can't be reached) and the loop returns
+    """
+    while not INGEST_STOP.is_set():
+
+        batch_size = get_int_config("ingest_batch_size", 500)
+        flush_interval = get_int_config(
+            "ingest_flush_interval_ms", 1000) / 1000
+
+        try:
+            batch = [INGEST_QUEUE.get(timeout=1)]
+        except queue.Empty:
+            continue
+        deadline = time.monotonic() + flush_interval
+        while len(batch) < batch_size and not INGEST_STOP.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(INGEST_QUEUE.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        retry_delay = 1
+        while not flush(db_collection, batch):
+            if INGEST_STOP.is_set():
+                logger.error("Couldn't write "+str(len(batch)) +
+                             " queued agent data records in the DB before exiting. These uploads are lost.")
+                break
+            logger.error("Couldn't write "+str(len(batch))+" queued agent data records in the DB. Retrying in " +
+                         str(retry_delay)+" seconds ...")
+            INGEST_STOP.wait(retry_delay)
+            retry_delay = min(retry_delay*2, 30)
+
+
+def stop():
+    """
+    Stops the ingestion queue: new uploads are rejected, the writer thread writes the batch it holds, and everything still queued is flushed
+    Waits up to 'ingest_stop_timeout_sec' for the writer thread. Records are only lost if the DB can't be reached in the meantime
+    """
+    if INGEST_QUEUE == None:
+        return
+    with INGEST_LOCK:
+        if INGEST_STOP.is_set() and (INGEST_THREAD == None or not INGEST_THREAD.is_alive()) and INGEST_QUEUE.empty():
+            return
+        INGEST_STOP.set()
+    logger.info("Stopping the ingestion queue ...")
+    if INGEST_THREAD != None:
+        INGEST_THREAD.join(get_int_config("ingest_stop_timeout_sec", 30))
+        if INGEST_THREAD.is_alive():
+            logger.error(
+                "Ingestion writer thread didn't finish in time. Its batch of agent data records might be lost.")
+    drain(INGEST_COLLECTION)
+    logger.info("Ingestion queue stopped.")
+
+
+def request_stop(signum, frame):
+    """
+    Signal handler for the API process (SIGTERM): stops the ingestion queue, flushing the queued uploads, and exits
+    """
+    stop()
+    sys.exit(0)
+
+
+def start(db_collection):
+    """
+    Creates the ingestion queue and starts the background writer thread
+    The queue size is read from the configs only at this point
+    The queue is flushed when the process exits normally or through request_stop() (SIGTERM); uploads still queued when the process is killed (SIGKILL) are lost
+    Returns True if all OK; False if NOK
+    """
+    global INGEST_QUEUE, INGEST_COLLECTION, INGEST_THREAD
+
+    if db_collection == None:
+        logger.error(
+            "No valid DB collection received. Agent data uploads will always be written synchronously.")
+        return False
+
+    queue_size = get_int_config("ingest_queue_size", 10000)
+    INGEST_STOP.clear()
+    INGEST_QUEUE = queue.Queue(maxsize=queue_size)
+    INGEST_COLLECTION = db_collection
+    INGEST_METRICS["queue_capacity"] = queue_size
+    INGEST_THREAD = threading.Thread(target=loop, args=(db_collection,),
+                                     name="ingest", daemon=True)
+    INGEST_THREAD.start()
+    atexit.register(stop)
+    logger.debug("Ingestion queue started (capacity: " +
+                 str(queue_size)+" records).")
+    return True
@@ -6,14 +6,16 @@ import siaas_aux
 import smtplib
 import ssl
 import csv
+import gzip
+import io
+import zipfile
 import platform
 import json
 import os
 import sys
 import logging
 import time
-from pathlib import Path
-from datetime import datetime
+from datetime import datetime, timedelta
 from email.utils import formataddr
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
@@ -21,34 +23,218 @@ from email.mime.application import MIMEApplication
 
 logger = logging.getLogger(__name__)
 
+CSV_DELIMITER = ';'
 
-def send_siaas_email(db_collection, smtp_account, smtp_pwd, smtp_receivers, smtp_server, smtp_tls_port, smtp_report_type, last_dict=None):
+
+# Snapshots stored right before a run may only become visible to the DB readers after it (concurrent writes), so each run looks this far behind the previous one
+MAILER_LOOKBACK_SEC = 60
+
+
+def get_report_digest(report_state):
     """
-    Receives the DB collection and SMTP server details, and the last data dict that was sent
-    If changes are detected in the data dict, an email is sent. Otherwise, nothing happens
-    Returns the new data dict if all OK; Returns the last dict if no changes were detected or if something has failed
+    Returns the digest of the whole report, from the digests of the agents with findings
     """
-    logger.info("Generating a new email report to send ...")
+    empty_digest = siaas_aux.get_payload_hash({})
+    return siaas_aux.get_payload_hash({uid: a["digest"] for uid, a in report_state["agents"].items() if a["digest"] != empty_digest})
 
-    out_dict = siaas_aux.get_dict_current_agent_data(
-        db_collection, agent_uid=None, module="portscanner")
 
+def load_report_vulns(db_collection, report_state, workers=1):
+    """
+    Recomputes the findings of the agents which don't have them in the report state (i.e. state reloaded from the DB after a restart)
+    Returns True if all OK; False if anything fails
+    """
+    missing = [uid for uid, a in report_state["agents"].items()
+               if a["vulns"] == None]
+    if len(missing) == 0:
+        return True
+    logger.debug("Recomputing the findings of "+str(len(missing)) +
+                 " agents from the persisted report state ...")
+    out_dict = siaas_aux.get_dict_current_agent_data(
+        db_collection, agent_uid=','.join(missing), module="portscanner")
     if out_dict == False:
-        logger.error(
-            "There was an error getting agent data to be sent in the email. Not sending any email.")
-        return last_dict
-
+        return False
     new_dict = siaas_aux.grab_vulns_from_agent_data_dict(
-        out_dict, report_type=smtp_report_type)
-
+        out_dict, report_type=report_state["report_type"], workers=workers)
     if new_dict == False:
+        return False
+    for uid in missing:
+        vulns = new_dict.get(uid, {})
+        report_state["agents"][uid] = dict(report_state["agents"][uid], vulns=vulns,
+                                           digest=siaas_aux.get_payload_hash(vulns))
+    return True
+
+
+def update_report_state(db_collection, report_type, last_state=None, workers=1):
+    """
+    Receives the DB collection, the report type, and the report state of the last run (report type, high-water time, and the payload hash, findings and digest of each agent)
+    Only agents whose current data was stored since the last run (minus a safety margin) and whose payload has changed have their findings recomputed; agents that are gone are dropped
+    Everything is recomputed in the first run, or if the report type has changed
+    Returns the new report state if all OK; Returns False if anything fails
+    """
+    run_start = siaas_aux.get_now_utc_obj()
+
+    if last_state == None or last_state.get("report_type") != report_type.lower():
+        state = {"report_type": report_type.lower(), "high_water": None, "agents": {},
+                 "sent_digest": None, "sent_time": None}
+        stored_since = None
+    else:
+        state = dict(last_state)
+        state["agents"] = dict(last_state["agents"])
+        stored_since = last_state["high_water"] - \
+            timedelta(seconds=MAILER_LOOKBACK_SEC)
+
+    agent_uids = siaas_aux.get_current_agent_uids(db_collection)
+    if agent_uids == False:
+        return False
+    for uid in list(state["agents"].keys()):
+        if uid not in agent_uids:
+            del state["agents"][uid]
+
+    hashes = siaas_aux.get_current_agent_data_hashes(
+        db_collection, stored_since=stored_since)
+    if hashes == False:
+        return False
+    changed = [uid for uid in hashes.keys() if hashes[uid] == None or state["agents"].get(
+        uid, {}).get("payload_hash") != hashes[uid]]
+
+    if len(changed) > 0:
+        logger.debug("Recomputing the findings of " +
+                     str(len(changed))+" agents ...")
+        out_dict = siaas_aux.get_dict_current_agent_data(
+            db_collection, agent_uid=','.join(changed) if stored_since != None else None, module="portscanner")
+        if out_dict == False:
+            return False
+        new_dict = siaas_aux.grab_vulns_from_agent_data_dict(
+            out_dict, report_type=report_type, workers=workers)
+        if new_dict == False:
+            return False
+        for uid in changed:
+            if uid not in out_dict.keys():
+                state["agents"].pop(uid, None)
+                continue
+            vulns = new_dict.get(uid, {})
+            state["agents"][uid] = {"payload_hash": hashes[uid], "vulns": vulns,
+                                    "digest": siaas_aux.get_payload_hash(vulns)}
+
+    state["high_water"] = run_start
+    return state
+
+
+def get_csv_report_lines(new_dict):
+    """
+    Yields the lines of the CSV report of a vuln dict (header first), encoded in UTF-8
+    Each line has the agent UID, the target host, the information type and its findings (as JSON)
+    """
+    buffer = io.StringIO()
+    w = csv.writer(buffer, delimiter=CSV_DELIMITER)
+    w.writerow(["AgentUID", "TargetHost", "InformationType", "Findings"])
+    yield buffer.getvalue().encode('utf-8')
+    for a in new_dict.keys():
+        for b in new_dict[a].keys():
+            for c in new_dict[a][b].keys():
+                for d in new_dict[a][b][c].keys():
+                    buffer.seek(0)
+                    buffer.truncate()
+                    w.writerow([a, c, d, json.dumps(
+                        new_dict[a][b][c][d], sort_keys=False, ensure_ascii=False)])
+                    yield buffer.getvalue().encode('utf-8')
+
+
+def compress_report_file(file_name, data, compression=None):
+    """
+    Compresses the contents of a report file with 'gzip' or 'zip' (anything else leaves it as it is)
+    Returns a tuple with the attachment name and its contents
+    """
+    if (compression or '').lower() == "gzip":
+        return (file_name+".gz", gzip.compress(data))
+    if (compression or '').lower() == "zip":
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as z:
+            z.writestr(file_name, data)
+        return (file_name+".zip", buffer.getvalue())
+    return (file_name, data)
+
+
+def build_csv_report(new_dict, file_name, compression=None, max_bytes=0):
+    """
+    Writes the CSV report of a vuln dict in memory and returns it as a list of attachments (tuples with name and contents), compressed with 'gzip' or 'zip' if set
+    If an attachment would be larger than max_bytes (0 for no limit), the report is split in parts of whole lines, each with the header and named '<name>_partN'
+    Compressed sizes are only known after compressing, so parts are made smaller until they fit (a single line larger than the limit still goes in a part of its own)
+    """
+    base_name, extension = os.path.splitext(file_name)
+    if (compression or '').lower() in ["gzip", "zip"]:
+        part_bytes = 0
+    else:
+        part_bytes = max_bytes
+    while True:
+        parts = []
+        header = None
+        for line in get_csv_report_lines(new_dict):
+            if header == None:
+                header = line
+                lines = [header]
+                size = len(header)
+                continue
+            if part_bytes > 0 and size+len(line) > part_bytes and len(lines) > 1:
+                parts.append((b''.join(lines), len(lines)-1))
+                lines = [header]
+                size = len(header)
+            lines.append(line)
+            size += len(line)
+        parts.append((b''.join(lines), len(lines)-1))
+        if len(parts) == 1:
+            attachments = [compress_report_file(
+                file_name, parts[0][0], compression)]
+        else:
+            attachments = [compress_report_file(base_name+"_part"+str(n+1)+extension, p[0], compression)
+                           for n, p in enumerate(parts)]
+        oversized = [n for n in range(len(attachments))
+                     if len(attachments[n][1]) > max_bytes]
+        if max_bytes <= 0 or len(oversized) == 0:
+            return attachments
+        if max([parts[n][1] for n in oversized]) <= 1:
+            logger.warning(
+                "The CSV report has lines larger than the attachment size limit. Sending them anyway.")
+            return attachments
+        largest = max([len(attachments[n][1]) for n in oversized])
+        if part_bytes <= 0:
+            part_bytes = len(parts[0][0])
+        part_bytes = max(int(part_bytes*max_bytes/largest*0.9), 1)
+
+
+def send_siaas_email(db_collection, smtp_account, smtp_pwd, smtp_receivers, smtp_server, smtp_tls_port, smtp_report_type, last_state=None, workers=1, compression=None, max_attachment_bytes=0):
+    """
+    Receives the DB collection and SMTP server details, and the report state of the last run (see update_report_state)
+    Vulnerabilities are extracted using the given number of worker processes
+    The CSV report is attached as it is, or compressed with 'gzip' or 'zip'; if it's larger than max_attachment_bytes (0 for no limit), it's split in parts, sent in separate emails
+    If the digest of the report differs from the one last sent, an email is sent. Otherwise, nothing happens
+    Returns the new report state if all OK (or if no changes were detected); Returns the last state if something has failed before the email could be built
+    """
+    logger.info("Generating a new email report to send ...")
+
+    report_state = update_report_state(
+        db_collection, smtp_report_type, last_state=last_state, workers=workers)
+
+    if report_state == False:
         logger.error(
-            "There was an error parsing vulnerability data to be sent in the email. Not sending any email.")
-        return last_dict
+            "There was an error getting vulnerability data to be sent in the email. Not sending any email.")
+        return last_state
 
-    if str(new_dict) == str(last_dict) and last_dict != None:
+    report_digest = get_report_digest(report_state)
+    if report_state["sent_digest"] == report_digest:
         logger.info("No new data to report. Not sending any email.")
-        return last_dict
+        return report_state
+
+    if not load_report_vulns(db_collection, report_state, workers=workers):
+        logger.error(
+            "There was an error getting vulnerability data to be sent in the email. Not sending any email.")
+        return report_state
+    report_digest = get_report_digest(report_state)
+
+    new_dict = {}
+    for uid in sorted(report_state["agents"].keys(), key=lambda x: x.casefold()):
+        if len(report_state["agents"][uid]["vulns"]) > 0:
+            new_dict[uid] = report_state["agents"][uid]["vulns"]
 
     if smtp_report_type.lower() == "all":
         mail_type = "All scanned data"
@@ -60,60 +246,55 @@ def send_siaas_email(db_collection, smtp_account, smtp_pwd, smtp_receivers, smtp
         mail_type = "Vulnerabilities"
         csv_type = "vulns"
 
-    last_dict = new_dict
     signature = "Server UID: " + siaas_aux.get_or_create_unique_system_id() + \
         "\nServer IP: " + siaas_aux.get_main_ip_address()
 
-    if len(new_dict) == 0:
-        mail_body = "Nothing to report."
+    # Create a CSV report (in memory), compressed and split in parts if configured
+    if len(new_dict) > 0:
+        file_name = "siaas_report_" + csv_type + "_" + siaas_aux.get_or_create_unique_system_id() + \
+            "_" + datetime.utcnow().strftime('%Y%m%d%H%M%S')+".csv"
+        attachments = build_csv_report(
+            new_dict, file_name, compression=compression, max_bytes=max_attachment_bytes)
     else:
-        #mail_body = pprint.pformat(new_dict, width=999, sort_dicts=False)
-        mail_body = "Report attached."
-    mail_body = mail_body + "\n\n" + signature
-
-    # Create a CSV report
+        attachments = [None]
 
-    csv_contents = []
-    for a in new_dict.keys():
-        for b in new_dict[a].keys():
-            for c in new_dict[a][b].keys():
-                for d in new_dict[a][b][c].keys():
-                    csv_contents.append([a, c, d, json.dumps(
-                        new_dict[a][b][c][d], sort_keys=False, ensure_ascii=False)])
-
-    csv_delimiter = ';'
-    file_to_write = "./tmp/siaas_report_" + csv_type + "_" + siaas_aux.get_or_create_unique_system_id() + \
-        "_" + datetime.utcnow().strftime('%Y%m%d%H%M%S')+".csv"
-    os.makedirs(os.path.dirname(os.path.join(
-        sys.path[0], file_to_write)), exist_ok=True)
-    with open(file_to_write, 'w') as f:
-        w = csv.writer(f, delimiter=csv_delimiter)
-        w.writerow(["AgentUID", "TargetHost", "InformationType", "Findings"])
-        w.writerows(csv_contents)
-
-    # Message headers
-    message = MIMEMultipart("alternative")
-    message["Subject"] = "SIAAS Report ("+mail_type+") from "+platform.node().split('.', 1)[
+    subject = "SIAAS Report ("+mail_type+") from "+platform.node().split('.', 1)[
         0]+" on "+datetime.now().strftime('%Y-%m-%d at %H:%M')+" "+datetime.now().astimezone().tzname()
-    #message["From"] = smtp_account
-    message["From"] = formataddr(
-        ("SIAAS Server ("+platform.node().split('.', 1)[0]+")", smtp_account))
-    message["To"] = smtp_receivers
-
-    # Create the MIMEText object
-    part1 = MIMEText(mail_body, "plain")
-    message.attach(part1)
-
-    with open(file_to_write, "r") as file:
-        part = MIMEApplication(
-            file.read(),
-            Name=os.path.basename(file_to_write)
-        )
-    part['Content-Disposition'] = 'attachment; filename="%s"' % os.path.basename(
-        file_to_write)
-
-    if len(new_dict) > 0:
-        message.attach(part)
+    messages = []
+    for n, attachment in enumerate(attachments):
+
+        if attachment == None:
+            mail_body = "Nothing to report."
+        elif len(attachments) > 1:
+            mail_body = "Report attached (part " + \
+                str(n+1)+" of "+str(len(attachments))+")."
+        else:
+            #mail_body = pprint.pformat(new_dict, width=999, sort_dicts=False)
+            mail_body = "Report attached."
+        mail_body = mail_body + "\n\n" + signature
+
+        # Message headers
+        message = MIMEMultipart("alternative")
+        if len(attachments) > 1:
+            message["Subject"] = subject+" ("+str(n+1) + \
+                "/"+str(len(attachments))+")"
+        else:
+            message["Subject"] = subject
+        #message["From"] = smtp_account
+        message["From"] = formataddr(
+            ("SIAAS Server ("+platform.node().split('.', 1)[0]+")", smtp_account))
+        message["To"] = smtp_receivers
+
+        # Create the MIMEText object
+        part1 = MIMEText(mail_body, "plain")
+        message.attach(part1)
+
+        if attachment != None:
+            part = MIMEApplication(attachment[1], Name=attachment[0])
+            part['Content-Disposition'] = 'attachment; filename="%s"' % attachment[0]
+            message.attach(part)
+
+        messages.append(message)
 
     # Create secure connection with server and send email
     try:
@@ -123,18 +304,19 @@ def send_siaas_email(db_collection, smtp_account, smtp_pwd, smtp_receivers, smtp
         with smtplib.SMTP(smtp_server, smtp_tls_port) as server:
             server.starttls(context=context)
             server.login(smtp_account, smtp_pwd)
-            server.sendmail(
-                smtp_account, smtp_receivers_list, message.as_string()
-            )
-
-        Path(file_to_write).unlink(missing_ok=True)
+            for message in messages:
+                server.sendmail(
+                    smtp_account, smtp_receivers_list, message.as_string()
+                )
     except Exception as e:
         logger.error("Error while sending email report: "+str(e))
-        return last_dict
+        return report_state
 
-    logger.info("Report sent via email.")
+    report_state["sent_digest"] = report_digest
+    report_state["sent_time"] = siaas_aux.get_now_utc_obj()
+    logger.info("Report sent via email ("+str(len(messages))+" messages).")
     logger.debug("Sent email contents:\n"+str(mail_body))
-    return new_dict
+    return report_state
 
 
 def loop():
@@ -176,7 +358,16 @@ def loop():
             "No valid DB collection received. No DB maintenance will be performed.")
         run = False
 
-    last_dict = None
+    # The report state of the last run survives restarts, so they don't trigger duplicate reports
+    report_state = None
+    if run:
+        report_state = siaas_aux.read_mailer_state(db_collection)
+        if report_state in [None, False]:
+            report_state = None
+        else:
+            logger.info("Mailer state loaded (last report sent: "+(report_state["sent_time"].strftime(
+                '%Y-%m-%dT%H:%M:%SZ') if report_state["sent_time"] != None else "never")+").")
+
     while run:
 
         send_mail = True
@@ -222,9 +413,33 @@ def loop():
                 logger.debug(
                     "SMTP TLS port is invalid or not defined. Using SMTP TLS port default (587).")
 
+            try:
+                report_workers = int(siaas_aux.get_config_from_configs_db(
+                    config_name="mailer_report_workers"))
+                if report_workers < 1:
+                    raise ValueError("Number of workers can't be less than 1.")
+            except:
+                report_workers = 1
+
+            mailer_report_compression = siaas_aux.get_config_from_configs_db(
+                config_name="mailer_report_compression")
+            if (mailer_report_compression or '').lower() not in ["gzip", "zip"]:
+                mailer_report_compression = None
+
+            try:
+                report_max_bytes = int(siaas_aux.get_config_from_configs_db(
+                    config_name="mailer_report_max_bytes"))
+                if report_max_bytes < 0:
+                    raise ValueError(
+                        "Attachment size limit can't be negative.")
+            except:
+                report_max_bytes = 10000000
+
             if send_mail:
-                last_dict = send_siaas_email(db_collection, mailer_smtp_account, mailer_smtp_pwd,
-                                             mailer_smtp_recipients, mailer_smtp_server, smtp_tls_port, mailer_smtp_report_type, last_dict)
+                report_state = send_siaas_email(db_collection, mailer_smtp_account, mailer_smtp_pwd,
+                                                mailer_smtp_recipients, mailer_smtp_server, smtp_tls_port, mailer_smtp_report_type, report_state, workers=report_workers, compression=mailer_report_compression, max_attachment_bytes=report_max_bytes)
+                if report_state != None:
+                    siaas_aux.write_mailer_state(db_collection, report_state)
 
         # Sleep before next loop
         try:
@@ -13,7 +13,9 @@ import ipaddress
 import logging
 import subprocess
 import pprint
+import signal
 import time
+from collections import deque
 from datetime import datetime
 
 start_time = time.time()
@@ -21,70 +23,205 @@ start_time = time.time()
 logger = logging.getLogger(__name__)
 
 
-def main(version="N/A"):
+# DMI fields read from sysfs (and the matching dmidecode keywords, used if sysfs can't be read)
+DMI_FIELDS = [
+    ("manufacturer", "sys_vendor", "system-manufacturer"),
+    ("product_name", "product_name", "system-product-name"),
+    ("version", "product_version", "system-version"),
+    ("serial_number", "product_serial", "system-serial-number"),
+    ("bios_version", "bios_version", "bios-version"),
+]
+
+STATIC_FACTS = None
+
+# Ring buffer of numeric platform samples, and the disk/network counters of the last sample (to compute rates)
+PLATFORM_HISTORY = deque(maxlen=288)
+LAST_COUNTERS = None
+
+# Set when the module is asked to stop, so the loop can write the platform history before exiting
+STOP_REQUESTED = False
+
+
+def read_sys_file(file_to_read):
     """
-    Main platform function (grabs all hardware information)
+    Reads a small file from sysfs/procfs
+    Returns its contents, stripped (also of trailing null chars); None if it can't be read
     """
-    logger.info("Grabbing all system information for this platform ...")
+    try:
+        with open(file_to_read, 'r') as file:
+            return file.read().strip().strip('\x00').strip()
+    except:
+        return None
 
-    platform = {}
 
-    platform["version"] = version
-    platform["uid"] = siaas_aux.get_or_create_unique_system_id()
-    platform["service_uptime"] = siaas_aux.convert_sec_to_pretty_format(
-        int(time.time() - start_time))
-    platform["system_info"] = {}
+def get_static_facts():
+    """
+    Grabs the platform facts that don't change while the server is running (hardware, OS and architecture, CPU brand, core counts and max frequency)
+    They're only collected in the first call, reading from sysfs where possible, and kept for the next ones
+    Returns a dict with the static facts
+    """
+    global STATIC_FACTS
+
+    if STATIC_FACTS != None:
+        return STATIC_FACTS
+
+    logger.debug("Grabbing static system information for this platform ...")
+    facts = {"hardware": {}, "system": {}, "cpu": {}}
 
     # Hardware
     try:
-        platform["system_info"]["hardware"] = {}
         if str(os.uname()[4]).lower().startswith("arm") or str(os.uname()[4]) == "aarch64":
-            platform["system_info"]["hardware"]["product_name"] = subprocess.check_output(
-                "cat /sys/firmware/devicetree/base/model", universal_newlines=True, shell=True).strip().strip('\x00')
-            platform["system_info"]["hardware"]["serial_number"] = subprocess.check_output(
-                "cat /sys/firmware/devicetree/base/serial-number", universal_newlines=True, shell=True).strip().strip('\x00')
+            for field, file_name in [("product_name", "model"), ("serial_number", "serial-number")]:
+                value = read_sys_file(
+                    "/sys/firmware/devicetree/base/"+file_name)
+                if value == None:
+                    raise OSError(
+                        "Can't read /sys/firmware/devicetree/base/"+file_name+".")
+                facts["hardware"][field] = value
         else:
-            platform["system_info"]["hardware"]["manufacturer"] = subprocess.check_output(
-                "dmidecode --string system-manufacturer", universal_newlines=True, shell=True).strip()
-            platform["system_info"]["hardware"]["product_name"] = subprocess.check_output(
-                "dmidecode --string system-product-name", universal_newlines=True, shell=True).strip()
-            platform["system_info"]["hardware"]["version"] = subprocess.check_output(
-                "dmidecode --string system-version", universal_newlines=True, shell=True).strip()
-            platform["system_info"]["hardware"]["serial_number"] = subprocess.check_output(
-                "dmidecode --string system-serial-number", universal_newlines=True, shell=True).strip()
-            platform["system_info"]["hardware"]["bios_version"] = subprocess.check_output(
-                "dmidecode --string bios-version", universal_newlines=True, shell=True).strip()
+            for field, dmi_file, dmi_keyword in DMI_FIELDS:
+                value = read_sys_file("/sys/class/dmi/id/"+dmi_file)
+                if value == None:
+                    value = subprocess.check_output(
+                        ["dmidecode", "--string", dmi_keyword], universal_newlines=True).strip()
+                facts["hardware"][field] = value
     except Exception as e:
         logger.warning("Couldn't get all hardware information: "+str(e))
 
     # OS and Arch
     try:
         uname = platform_mod.uname()
-        platform["system_info"]["system"] = {}
-        platform["system_info"]["system"]["os"] = uname.system
-        platform["system_info"]["system"]["node_name"] = uname.node
-        platform["system_info"]["system"]["kernel"] = uname.release
-        platform["system_info"]["system"]["flavor"] = uname.version
-        platform["system_info"]["system"]["arch"] = uname.machine
-        platform["system_info"]["system"]["processor"] = cpuinfo.get_cpu_info()[
-            'brand_raw']
+        facts["system"]["os"] = uname.system
+        facts["system"]["node_name"] = uname.node
+        facts["system"]["kernel"] = uname.release
+        facts["system"]["flavor"] = uname.version
+        facts["system"]["arch"] = uname.machine
+        facts["system"]["processor"] = cpuinfo.get_cpu_info()['brand_raw']
     except Exception as e:
         logger.warning(
             "Couldn't get all OS and architecture information: "+str(e))
 
+    # CPU cores and max frequency
+    try:
+        facts["cpu"]["physical_cores"] = psutil.cpu_count(logical=False)
+        facts["cpu"]["logical_cores"] = psutil.cpu_count(logical=True)
+        cpu_freq = psutil.cpu_freq()
+        if float(str(cpu_freq.max)) > 0:
+            facts["cpu"]["max_freq"] = f'{float(str(cpu_freq.max)):.2f}'+" MHz"
+    except Exception as e:
+        logger.warning("Couldn't get all CPU information: "+str(e))
+
+    # The first CPU load reading is meaningless (it's measured since the previous call), so that call is made here
+    psutil.cpu_percent()
+
+    STATIC_FACTS = facts
+    return STATIC_FACTS
+
+
+def sample_platform_metrics():
+    """
+    Takes a sample of the dynamic platform metrics, as numbers: CPU load, memory and swap usage, usage of each volume, and disk and network rates
+    Rates are in bytes per second, computed from the counters of the previous sample (None in the first sample, or if a counter went back)
+    Returns the sample dict
+    """
+    global LAST_COUNTERS
+
+    sample = {"time": siaas_aux.get_now_utc_str()}
+
+    try:
+        sample["cpu_percent"] = psutil.cpu_percent()
+        svmem = psutil.virtual_memory()
+        sample["memory_percent"] = svmem.percent
+        sample["memory_used_bytes"] = svmem.used
+        swap = psutil.swap_memory()
+        sample["swap_percent"] = swap.percent
+        sample["swap_used_bytes"] = swap.used
+    except Exception as e:
+        logger.warning("Couldn't sample all CPU and memory metrics: "+str(e))
+
+    sample["volumes"] = {}
+    try:
+        for partition in psutil.disk_partitions():
+            if partition.device.startswith("/dev/loop") or "/snap" in partition.mountpoint:
+                continue
+            try:
+                partition_usage = psutil.disk_usage(partition.mountpoint)
+                sample["volumes"][partition.device] = {
+                    "percent": partition_usage.percent, "used_bytes": partition_usage.used}
+            except:
+                pass
+    except Exception as e:
+        logger.warning("Couldn't sample all volume metrics: "+str(e))
+
+    counters = {"time": time.monotonic()}
+    try:
+        disk_io = psutil.disk_io_counters()
+        counters["disk_read"] = disk_io.read_bytes
+        counters["disk_write"] = disk_io.write_bytes
+    except Exception as e:
+        logger.warning("Couldn't sample IO counters: "+str(e))
+    try:
+        net_io = psutil.net_io_counters()
+        counters["net_recv"] = net_io.bytes_recv
+        counters["net_sent"] = net_io.bytes_sent
+    except Exception as e:
+        logger.warning("Couldn't sample network counters: "+str(e))
+    for k in ["disk_read", "disk_write", "net_recv", "net_sent"]:
+        sample[k+"_bytes_sec"] = None
+        try:
+            elapsed = counters["time"] - LAST_COUNTERS["time"]
+            delta = counters[k] - LAST_COUNTERS[k]
+            if elapsed > 0 and delta >= 0:
+                sample[k+"_bytes_sec"] = round(delta / elapsed, 1)
+        except:
+            pass
+    LAST_COUNTERS = counters
+
+    return sample
+
+
+def get_platform_history():
+    """
+    Returns a dict with the size of the platform history ring buffer and its samples (oldest first)
+    """
+    return {"size": PLATFORM_HISTORY.maxlen, "samples": list(PLATFORM_HISTORY)}
+
+
+def main(version="N/A"):
+    """
+    Main platform function (grabs all hardware information)
+    Static facts are collected only once, so each call only samples the dynamic metrics
+    A numeric sample of those metrics is also added to the platform history
+    """
+    logger.info("Grabbing all system information for this platform ...")
+
+    static_facts = get_static_facts()
+    sample = sample_platform_metrics()
+    PLATFORM_HISTORY.append(sample)
+    platform = {}
+
+    platform["version"] = version
+    platform["uid"] = siaas_aux.get_or_create_unique_system_id()
+    platform["service_uptime"] = siaas_aux.convert_sec_to_pretty_format(
+        int(time.time() - start_time))
+    platform["system_info"] = {}
+
+    # Hardware, OS and Arch
+    platform["system_info"]["hardware"] = dict(static_facts["hardware"])
+    platform["system_info"]["system"] = dict(static_facts["system"])
+
     # CPU information
     try:
         platform["system_info"]["cpu"] = {}
         platform["system_info"]["cpu"]["load_percent"] = str(
-            psutil.cpu_percent())+" %"
-        platform["system_info"]["cpu"]["physical_cores"] = psutil.cpu_count(
-            logical=False)
-        platform["system_info"]["cpu"]["logical_cores"] = psutil.cpu_count(
-            logical=True)
+            sample["cpu_percent"])+" %"
+        for c in ["physical_cores", "logical_cores"]:
+            if c in static_facts["cpu"].keys():
+                platform["system_info"]["cpu"][c] = static_facts["cpu"][c]
         cpu_freq = psutil.cpu_freq()
         platform["system_info"]["cpu"]["current_freq"] = f'{float(str(cpu_freq.current)):.2f}'+" MHz"
-        if float(str(cpu_freq.max)) > 0:
-            platform["system_info"]["cpu"]["max_freq"] = f'{float(str(cpu_freq.max)):.2f}'+" MHz"
+        if "max_freq" in static_facts["cpu"].keys():
+            platform["system_info"]["cpu"]["max_freq"] = static_facts["cpu"]["max_freq"]
         with open("/sys/class/thermal/thermal_zone0/temp", 'r') as file:
             current_temp = file.readline()
         platform["system_info"]["cpu"]["temp"] = f'{(float(str(current_temp))/1000):.2f}'+" C"
@@ -200,28 +337,91 @@ def main(version="N/A"):
     return platform
 
 
+def request_stop(signum, frame):
+    """
+    Signal handler for stopping the platform module: the loop finishes its current iteration, writes the history file and returns
+    """
+    global STOP_REQUESTED
+    STOP_REQUESTED = True
+
+
+def sleep_unless_stopped(sleep_time):
+    """
+    Sleeps for up to sleep_time seconds, returning early if the module is asked to stop
+    """
+    end_time = time.monotonic() + sleep_time
+    while not STOP_REQUESTED and time.monotonic() < end_time:
+        time.sleep(min(1, max(end_time - time.monotonic(), 0)))
+
+
 def loop(version=""):
     """
     Main Platform module loop (calls main function)
+    The history is published in the local state store every iteration, but only written to its local file every 'platform_history_write_interval' samples, and when the module stops
     """
+    global PLATFORM_HISTORY
+
+    history_file = os.path.join(sys.path[0], 'var/platform_history.db')
+
+    # Samples kept from the previous run
+    if os.path.exists(history_file):
+        try:
+            PLATFORM_HISTORY.extend(
+                siaas_aux.read_from_local_file(history_file)["samples"])
+        except:
+            logger.warning("Couldn't restore the platform history from " +
+                           history_file+". Starting a new one.")
+
     # Initializing the platform local DB
     os.makedirs(os.path.join(sys.path[0], 'var'), exist_ok=True)
     siaas_aux.write_to_local_file(
         os.path.join(sys.path[0], 'var/platform.db'), {})
     os.chmod(os.path.join(sys.path[0], 'var/platform.db'), os.stat(
         os.path.join(sys.path[0], 'var/platform.db')).st_mode & ~0o007)
+    siaas_aux.write_to_local_file(history_file, get_platform_history())
+    os.chmod(history_file, os.stat(history_file).st_mode & ~0o007)
+
+    # Static facts are collected once, at startup
+    get_static_facts()
 
-    while True:
+    # The handler only sets a flag, as an exception raised from it could be swallowed anywhere in the loop
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    samples_since_write = 0
+
+    while not STOP_REQUESTED:
 
         platform_dict = {}
 
         logger.debug("Loop running ...")
 
+        # The ring buffer is resized (keeping the latest samples) if its configured size changes
+        try:
+            history_size = int(siaas_aux.get_config_from_configs_db(
+                config_name="platform_history_size"))
+            if history_size < 1:
+                raise ValueError("History size can't be less than 1.")
+        except:
+            history_size = 288
+        if history_size != PLATFORM_HISTORY.maxlen:
+            PLATFORM_HISTORY = deque(PLATFORM_HISTORY, maxlen=history_size)
+
         platform_dict = main(version)
 
-        # Writing in local database
+        # Writing in local databases
         siaas_aux.write_to_local_file(os.path.join(
             sys.path[0], 'var/platform.db'), platform_dict)
+        try:
+            write_interval = int(siaas_aux.get_config_from_configs_db(
+                config_name="platform_history_write_interval"))
+        except:
+            write_interval = 12
+        samples_since_write += 1
+        if samples_since_write >= write_interval or not siaas_aux.write_to_local_state(history_file, get_platform_history()):
+            siaas_aux.write_to_local_file(
+                history_file, get_platform_history())
+            samples_since_write = 0
 
         # Sleep before next loop
         try:
@@ -229,11 +429,14 @@ def loop(version=""):
                 config_name="platform_loop_interval_sec"))
             logger.debug("Sleeping for "+str(sleep_time) +
                          " seconds before next loop ...")
-            time.sleep(sleep_time)
         except:
             logger.debug(
                 "The interval loop time is not configured or is invalid. Sleeping now for 5 minutes by default ...")
-            time.sleep(300)
+            sleep_time = 300
+        sleep_unless_stopped(sleep_time)
+
+    logger.debug("Writing the platform history before stopping ...")
+    siaas_aux.write_to_local_file(history_file, get_platform_history())
 
 
 if __name__ == "__main__":
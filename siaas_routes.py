@@ -5,13 +5,172 @@
 from __main__ import app, get_db_collection
 from flask import jsonify, request
 import siaas_aux
+import siaas_ingest
+import logging
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
 
 SIAAS_VERSION = "1.0.1"
+COMPRESSION_CHUNK_SIZE = 262144
+COMPRESSIBLE_MIMETYPES = ["application/json", "application/javascript",
+                          "application/xml", "text/html", "text/plain", "text/css", "text/xml"]
 
 app.config['JSON_AS_ASCII'] = False
 app.config['JSON_SORT_KEYS'] = False
 
 
+def get_response_encoding(accept_encoding=""):
+    """
+    Picks the content encoding for a response from the Accept-Encoding request header, among the ones available in this server
+    When the client gives them the same weight, zstd is preferred over brotli, and brotli over gzip
+    Returns None if the response should not be compressed
+    """
+    available_encodings = ["gzip"]
+    if brotli != None:
+        available_encodings.insert(0, "br")
+    if zstandard != None:
+        available_encodings.insert(0, "zstd")
+
+    weights = {}
+    for e in (accept_encoding or "").split(','):
+        try:
+            parts = e.split(';')
+            name = parts[0].strip().lower()
+            weight = 1.0
+            for p in parts[1:]:
+                if p.strip().lower().startswith("q="):
+                    weight = float(p.strip()[2:])
+            if len(name) > 0:
+                weights[name] = weight
+        except:
+            continue
+
+    best_encoding = None
+    best_weight = 0
+    for encoding in available_encodings:
+        weight = weights.get(encoding, weights.get("*", 0))
+        if weight > best_weight:
+            best_encoding = encoding
+            best_weight = weight
+
+    return best_encoding
+
+
+def get_compressor(encoding, level):
+    """
+    Returns the compress and flush functions of a streaming compressor for the given content encoding and level
+    The level is clamped to the range supported by each algorithm
+    """
+    if encoding == "zstd":
+        compressor = zstandard.ZstdCompressor(
+            level=max(1, min(level, 19))).compressobj()
+        return compressor.compress, compressor.flush
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=max(0, min(level, 11)))
+        return compressor.process, compressor.finish
+    compressor = zlib.compressobj(
+        max(1, min(level, 9)), zlib.DEFLATED, 31)  # gzip container
+    return compressor.compress, compressor.flush
+
+
+@app.after_request
+def compress_response(response):
+    """
+    Compresses the response body according to the Accept-Encoding request header
+    Small responses are sent as they are, and compression is abandoned if it uses more CPU time than allowed for a single response
+    """
+    if response.direct_passthrough or response.status_code < 200 or response.status_code in [204, 206, 304]:
+        return response
+    if "Content-Encoding" in response.headers or response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+    response.vary.add("Accept-Encoding")
+
+    encoding = get_response_encoding(
+        request.headers.get("Accept-Encoding", ""))
+    if encoding == None:
+        return response
+
+    try:
+        min_bytes = int(siaas_aux.get_config_from_configs_db(
+            config_name="api_compression_min_bytes"))
+    except:
+        min_bytes = 1024
+    try:
+        level = int(siaas_aux.get_config_from_configs_db(
+            config_name="api_compression_level"))
+    except:
+        level = 6
+    try:
+        max_cpu_sec = int(siaas_aux.get_config_from_configs_db(
+            config_name="api_compression_max_cpu_ms")) / 1000
+    except:
+        max_cpu_sec = 0.5
+
+    data = response.get_data()
+    if len(data) < min_bytes:
+        return response
+
+    try:
+        start = time.thread_time()
+        compress, flush = get_compressor(encoding, level)
+        compressed_chunks = []
+        for i in range(0, len(data), COMPRESSION_CHUNK_SIZE):
+            compressed_chunks.append(
+                compress(data[i:i+COMPRESSION_CHUNK_SIZE]))
+            if time.thread_time() - start > max_cpu_sec:
+                logger.debug("Compression of the response to "+request.path +
+                             " took too much CPU time. Sending it uncompressed.")
+                return response
+        compressed_chunks.append(flush())
+        compressed_data = b''.join(compressed_chunks)
+    except Exception as e:
+        logger.warning("Couldn't compress the response to " +
+                       request.path+": "+str(e))
+        return response
+
+    if len(compressed_data) >= len(data):
+        return response
+    response.set_data(compressed_data)
+    response.headers["Content-Encoding"] = encoding
+    etag, weak = response.get_etag()
+    if etag != None and not weak:
+        # Strong ETags must differ between encodings of the same representation
+        response.set_etag(etag+"-"+encoding)
+    return response
+
+
+def get_matching_etag(etag):
+    """
+    Checks the If-None-Match request header against a weak ETag (weak comparison, so any encoding of the same data matches)
+    Returns the matching entity tag; None if there's no match
+    """
+    if request.if_none_match.contains_weak(etag):
+        return etag
+    return None
+
+
+def get_not_modified_response(etag):
+    """
+    Returns an empty 304 Not Modified response carrying the given (weak) ETag
+    """
+    response = app.response_class(status=304)
+    response.set_etag(etag, weak=True)
+    response.vary.add("Accept-Encoding")
+    return response
+
+
 @app.route('/', strict_slashes=False)
 def index():
     """
@@ -49,19 +208,29 @@ def siaas_server():
         ip = request.remote_addr
     ret_code = 200
     module = request.args.get('module', default='*', type=str)
-    all_existing_modules = "platform,config"
-    siaas_aux.merge_configs_from_upstream(
-        upstream_dict=siaas_aux.get_dict_current_server_configs(get_db_collection()))
+    all_existing_modules = "platform,config,ingest"
+    siaas_aux.refresh_server_configs(get_db_collection())
     for m in module.split(','):
         if m.strip() == "*":
             module = all_existing_modules
-    output = siaas_aux.merge_module_dicts(module)
+    # The ingestion queue lives in this process, so its metrics don't come from a local DB
+    local_db_modules = []
+    for m in module.split(','):
+        if m.strip().lower() != "ingest":
+            local_db_modules.append(m)
+    if len(local_db_modules) > 0:
+        output = siaas_aux.merge_module_dicts(','.join(local_db_modules))
+    else:
+        output = {}
     if type(output) == bool and output == False:
         status = "failure"
         ret_code = 500
         output = {}
     else:
         status = "success"
+        if len(local_db_modules) < len(module.split(',')):
+            output["ingest"] = siaas_ingest.get_metrics()
+            output = dict(sorted(output.items()))
     try:
         for k in output["config"].keys():
             if k.endswith("_pwd") or k.endswith("_passwd") or k.endswith("_password"):
@@ -90,6 +259,10 @@ def server_configs():
     ret_code = 200
     collection = get_db_collection()
     if request.method == 'GET':
+        etag = siaas_aux.get_configs_etag(collection, scope="server_configs")
+        matching_etag = get_matching_etag(etag) if etag else None
+        if matching_etag != None:
+            return get_not_modified_response(matching_etag)
         output = siaas_aux.get_dict_current_server_configs(
             collection)
         if type(output) == bool and output == False:
@@ -98,21 +271,23 @@ def server_configs():
             output = {}
         else:
             status = "success"
-        return jsonify(
+        response = jsonify(
             {
                 'output': output,
                 'status': status,
                 'total_entries': len(output),
                 'time': siaas_aux.get_now_utc_str()
             }
-        ), ret_code
+        )
+        if etag and ret_code == 200:
+            response.set_etag(etag, weak=True)
+        return response, ret_code
     if request.method == 'POST':
         content = request.json
         output = siaas_aux.create_or_update_server_configs(
             collection, config_dict=content, orig_ip=ip)
         if output:
-            siaas_aux.merge_configs_from_upstream(
-                upstream_dict=siaas_aux.get_dict_current_server_configs(collection))
+            siaas_aux.refresh_server_configs(collection)
             status = "success"
         else:
             status = "failure"
@@ -131,8 +306,7 @@ def server_configs():
             ret_code = 500
             count_deleted = 0
         else:
-            siaas_aux.merge_configs_from_upstream(
-                upstream_dict=siaas_aux.get_dict_current_server_configs(collection))
+            siaas_aux.refresh_server_configs(collection)
             status = "success"
             count_deleted = int(output)
         return jsonify(
@@ -173,39 +347,68 @@ def agents():
     ), ret_code
 
 
-@app.route('/siaas-server/agents/data', methods=['GET'], strict_slashes=False)
+@app.route('/siaas-server/agents/data', methods=['GET', 'POST'], strict_slashes=False)
 def agents_data():
     """
-    Server API route - agents data
+    Server API route - agents data (POST uploads data from multiple agents at once)
     """
     if request.headers.getlist("X-Forwarded-For"):
         ip = request.headers.getlist("X-Forwarded-For")[0]
     else:
         ip = request.remote_addr
     ret_code = 200
-    module = request.args.get('module', default='*', type=str)
-    for m in module.split(','):
-        if m.strip() == "*":
-            module = None
     collection = get_db_collection()
-    output = siaas_aux.get_dict_current_agent_data(collection, module=module)
-    if type(output) == bool and output == False:
-        status = "failure"
-        ret_code = 500
-        output = {}
-    else:
-        status = "success"
-    return jsonify(
-        {
-            'output': output,
-            'status': status,
-            'total_entries': len(output),
-            'time': siaas_aux.get_now_utc_str()
-        }
-    ), ret_code
+    if request.method == 'GET':
+        module = request.args.get('module', default='*', type=str)
+        for m in module.split(','):
+            if m.strip() == "*":
+                module = None
+        output = siaas_aux.get_dict_current_agent_data(
+            collection, module=module)
+        if type(output) == bool and output == False:
+            status = "failure"
+            ret_code = 500
+            output = {}
+        else:
+            status = "success"
+        return jsonify(
+            {
+                'output': output,
+                'status': status,
+                'total_entries': len(output),
+                'time': siaas_aux.get_now_utc_str()
+            }
+        ), ret_code
+    if request.method == 'POST':
+        content = request.json
+        output = siaas_aux.upload_agent_data_bulk(
+            collection, entries=content, orig_ip=ip)
+        if type(output) == bool and output == False:
+            status = "failure"
+            ret_code = 500
+            output = []
+        else:
+            count_failed = len(
+                [r for r in output if r["status"] != "success"])
+            if count_failed == 0:
+                status = "success"
+            elif count_failed < len(output):
+                status = "partial"
+                ret_code = 207
+            else:
+                status = "failure"
+                ret_code = 500
+        return jsonify(
+            {
+                'output': output,
+                'status': status,
+                'total_entries': len(output),
+                'time': siaas_aux.get_now_utc_str()
+            }
+        ), ret_code
 
 
-@app.route('/siaas-server/agents/data/<agent_uid>', methods=['GET', 'POST', 'DELETE'], strict_slashes=False)
+@app.route('/siaas-server/agents/data/<agent_uid>', methods=['GET', 'POST', 'PATCH', 'DELETE'], strict_slashes=False)
 def agents_data_id(agent_uid):
     """
     Server API route - agents data (specific UIDs, comma-separated)
@@ -239,19 +442,25 @@ def agents_data_id(agent_uid):
         ), ret_code
     if request.method == 'POST':
         content = request.json
-        output = siaas_aux.upload_agent_data(
-            collection, agent_uid=agent_uid, data_dict=content, orig_ip=ip)
-        if output:
-            status = "success"
-        else:
-            status = "failure"
-            ret_code = 500
-        return jsonify(
-            {
-                'status': status,
-                'time': siaas_aux.get_now_utc_str()
-            }
-        ), ret_code
+        record = siaas_aux.build_agent_data_record(
+            agent_uid=agent_uid, data_dict=content, orig_ip=ip)
+        return get_agent_data_upload_response(collection, record)
+    if request.method == 'PATCH':
+        base = request.args.get('base', default='', type=str)
+        content = request.json
+        record, error = siaas_aux.build_agent_data_record_from_patch(
+            collection, agent_uid=agent_uid, patch=content, base_id=base, orig_ip=ip)
+        # Bad requests and patches are told apart from DB failures, so agents don't retry them as they are
+        error_codes = {"invalid": 400, "conflict": 409,
+                       "unprocessable": 422, "failure": 500}
+        if error != None:
+            return jsonify(
+                {
+                    'status': error if error == "conflict" else "failure",
+                    'time': siaas_aux.get_now_utc_str()
+                }
+            ), error_codes.get(error, 500)
+        return get_agent_data_upload_response(collection, record)
     if request.method == 'DELETE':
         days = request.args.get('days', default=365, type=int)
         output = siaas_aux.delete_all_records_older_than(
@@ -272,6 +481,47 @@ def agents_data_id(agent_uid):
         ), ret_code
 
 
+def get_agent_data_upload_response(collection, record):
+    """
+    Writes a validated agent data record (or queues it to be written in the background, if enabled) and returns the API response
+    The response includes the data ID of the record, which agents can name as the base of their next upload
+    """
+    if record == None:
+        return jsonify(
+            {
+                'status': "failure",
+                'time': siaas_aux.get_now_utc_str()
+            }
+        ), 500
+    if siaas_ingest.is_async_enabled():
+        if not siaas_ingest.enqueue(record):
+            return jsonify(
+                {
+                    'status': "failure",
+                    'time': siaas_aux.get_now_utc_str()
+                }
+            ), 503, {'Retry-After': str(siaas_ingest.get_retry_after())}
+        status = "accepted"
+        ret_code = 202
+    elif siaas_aux.upload_agent_data_record(collection, record):
+        status = "success"
+        ret_code = 200
+    else:
+        return jsonify(
+            {
+                'status': "failure",
+                'time': siaas_aux.get_now_utc_str()
+            }
+        ), 500
+    return jsonify(
+        {
+            'data_id': str(record["_id"]),
+            'status': status,
+            'time': siaas_aux.get_now_utc_str()
+        }
+    ), ret_code
+
+
 @app.route('/siaas-server/agents/configs', methods=['GET'], strict_slashes=False)
 def agents_configs():
     """
@@ -284,6 +534,11 @@ def agents_configs():
     ret_code = 200
     collection = get_db_collection()
     merge_broadcast = request.args.get('merge_broadcast', default=0, type=int)
+    etag = siaas_aux.get_configs_etag(
+        collection, scope="agent_configs", merge_broadcast=merge_broadcast)
+    matching_etag = get_matching_etag(etag) if etag else None
+    if matching_etag != None:
+        return get_not_modified_response(matching_etag)
     output = siaas_aux.get_dict_current_agent_configs(
         collection, merge_broadcast=merge_broadcast)
     if type(output) == bool and output == False:
@@ -292,14 +547,17 @@ def agents_configs():
         output = {}
     else:
         status = "success"
-    return jsonify(
+    response = jsonify(
         {
             'output': output,
             'status': status,
             'total_entries': len(output),
             'time': siaas_aux.get_now_utc_str()
         }
-    ), ret_code
+    )
+    if etag and ret_code == 200:
+        response.set_etag(etag, weak=True)
+    return response, ret_code
 
 
 @app.route('/siaas-server/agents/configs/<agent_uid>', methods=['GET', 'POST', 'DELETE'], strict_slashes=False)
@@ -316,6 +574,11 @@ def agents_configs_id(agent_uid):
     if request.method == 'GET':
         merge_broadcast = request.args.get(
             'merge_broadcast', default=0, type=int)
+        etag = siaas_aux.get_configs_etag(
+            collection, scope="agent_configs", agent_uid=agent_uid, merge_broadcast=merge_broadcast)
+        matching_etag = get_matching_etag(etag) if etag else None
+        if matching_etag != None:
+            return get_not_modified_response(matching_etag)
         output = siaas_aux.get_dict_current_agent_configs(
             collection, agent_uid=agent_uid, merge_broadcast=merge_broadcast)
         if type(output) == bool and output == False:
@@ -324,14 +587,17 @@ def agents_configs_id(agent_uid):
             output = {}
         else:
             status = "success"
-        return jsonify(
+        response = jsonify(
             {
                 'output': output,
                 'status': status,
                 'total_entries': len(output),
                 'time': siaas_aux.get_now_utc_str()
             }
-        ), ret_code
+        )
+        if etag and ret_code == 200:
+            response.set_etag(etag, weak=True)
+        return response, ret_code
     if request.method == 'POST':
         content = request.json
         output = siaas_aux.create_or_update_agent_configs(
@@ -383,14 +649,16 @@ def agents_history():
     sort_by = request.args.get('sort', default="date", type=str)
     older_first = request.args.get('older', default=0, type=int)
     hide_empty = request.args.get('hide', default=0, type=int)
+    page_token = request.args.get('page', default=None, type=str)
+    show_runs = request.args.get('runs', default=0, type=int)
     for m in module.split(','):
         if m.strip() == "*":
             module = None
     collection = get_db_collection()
     if limit_outputs < 0:
         limit_outputs = 0  # a negative value makes MongoDB behave differently. Let's avoid that
-    output = siaas_aux.get_dict_history_agent_data(
-        collection, module=module, limit_outputs=limit_outputs, days=days, sort_by=sort_by, older_first=older_first, hide_empty=hide_empty)
+    output, next_page_token = siaas_aux.get_dict_history_agent_data(
+        collection, module=module, limit_outputs=limit_outputs, days=days, sort_by=sort_by, older_first=older_first, hide_empty=hide_empty, page_token=page_token, paginate=True, show_runs=show_runs)
     if type(output) == bool and output == False:
         status = "failure"
         ret_code = 500
@@ -403,6 +671,7 @@ def agents_history():
             'output': output,
             'status': status,
             'total_entries': len(output),
+            'next_page': next_page_token,
             'time': siaas_aux.get_now_utc_str()
         }
     ), ret_code
@@ -425,14 +694,92 @@ def agents_history_id(agent_uid):
     sort_by = request.args.get('sort', default="date", type=str)
     older_first = request.args.get('older', default=0, type=int)
     hide_empty = request.args.get('hide', default=0, type=int)
+    page_token = request.args.get('page', default=None, type=str)
+    show_runs = request.args.get('runs', default=0, type=int)
     for m in module.split(','):
         if m.strip() == "*":
             module = None
     collection = get_db_collection()
     if limit_outputs < 0:
         limit_outputs = 0  # a negative value makes MongoDB behave differently. Let's avoid that
-    output = siaas_aux.get_dict_history_agent_data(
-        collection, agent_uid=agent_uid, module=module, limit_outputs=limit_outputs, days=days, sort_by=sort_by, older_first=older_first, hide_empty=hide_empty)
+    output, next_page_token = siaas_aux.get_dict_history_agent_data(
+        collection, agent_uid=agent_uid, module=module, limit_outputs=limit_outputs, days=days, sort_by=sort_by, older_first=older_first, hide_empty=hide_empty, page_token=page_token, paginate=True, show_runs=show_runs)
+    if type(output) == bool and output == False:
+        status = "failure"
+        ret_code = 500
+        output = {}
+    else:
+        status = "success"
+    return jsonify(
+        {
+            'output': output,
+            'status': status,
+            'total_entries': len(output),
+            'next_page': next_page_token,
+            'time': siaas_aux.get_now_utc_str()
+        }
+    ), ret_code
+
+
+@app.route('/siaas-server/vulns', methods=['GET'], strict_slashes=False)
+def vulns():
+    """
+    Server API route - vulnerability findings
+    """
+    if request.headers.getlist("X-Forwarded-For"):
+        ip = request.headers.getlist("X-Forwarded-For")[0]
+    else:
+        ip = request.remote_addr
+    ret_code = 200
+    target_host = request.args.get('host', default=None, type=str)
+    port = request.args.get('port', default=None, type=str)
+    source = request.args.get('source', default=None, type=str)
+    vuln_id = request.args.get('id', default=None, type=str)
+    exploit_only = request.args.get('exploit', default=0, type=int)
+    # less than 1 equates to having no output limit
+    limit_outputs = request.args.get('limit', default=1000, type=int)
+    page_token = request.args.get('page', default=None, type=str)
+    collection = get_db_collection()
+    output, next_page_token = siaas_aux.get_dict_vulns(
+        collection, target_host=target_host, port=port, source=source, vuln_id=vuln_id, exploit_only=exploit_only, limit_outputs=limit_outputs, page_token=page_token)
+    if type(output) == bool and output == False:
+        status = "failure"
+        ret_code = 500
+        output = {}
+    else:
+        status = "success"
+    return jsonify(
+        {
+            'output': output,
+            'status': status,
+            'total_entries': len(output),
+            'next_page': next_page_token,
+            'time': siaas_aux.get_now_utc_str()
+        }
+    ), ret_code
+
+
+@app.route('/siaas-server/vulns/<agent_uid>', methods=['GET'], strict_slashes=False)
+def vulns_id(agent_uid):
+    """
+    Server API route - vulnerability findings (specific UIDs, comma-separated)
+    """
+    if request.headers.getlist("X-Forwarded-For"):
+        ip = request.headers.getlist("X-Forwarded-For")[0]
+    else:
+        ip = request.remote_addr
+    ret_code = 200
+    target_host = request.args.get('host', default=None, type=str)
+    port = request.args.get('port', default=None, type=str)
+    source = request.args.get('source', default=None, type=str)
+    vuln_id = request.args.get('id', default=None, type=str)
+    exploit_only = request.args.get('exploit', default=0, type=int)
+    # less than 1 equates to having no output limit
+    limit_outputs = request.args.get('limit', default=1000, type=int)
+    page_token = request.args.get('page', default=None, type=str)
+    collection = get_db_collection()
+    output, next_page_token = siaas_aux.get_dict_vulns(
+        collection, agent_uid=agent_uid, target_host=target_host, port=port, source=source, vuln_id=vuln_id, exploit_only=exploit_only, limit_outputs=limit_outputs, page_token=page_token)
     if type(output) == bool and output == False:
         status = "failure"
         ret_code = 500
@@ -444,6 +791,7 @@ def agents_history_id(agent_uid):
             'output': output,
             'status': status,
             'total_entries': len(output),
+            'next_page': next_page_token,
             'time': siaas_aux.get_now_utc_str()
         }
     ), ret_code
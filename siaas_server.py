@@ -5,6 +5,7 @@
 import os
 import sys
 import logging
+import signal
 import time
 import multiprocessing_logging
 from logging.handlers import RotatingFileHandler
@@ -37,6 +38,7 @@ if __name__ == "__main__":
 
     import siaas_aux
     import siaas_dbmaintenance
+    import siaas_ingest
     import siaas_mailer
     import siaas_platform
     import siaas_routes
@@ -63,9 +65,13 @@ if __name__ == "__main__":
     # Deleting any existing databases leftovers
     old_dbs = os.listdir(os.path.join(sys.path[0], 'var/'))
     for db in old_dbs:
-        if db.endswith(".db"):
+        if db.endswith(".db") or db.endswith(".tmp"):
             os.remove(os.path.join(sys.path[0], 'var/'+db))
 
+    # Local databases shared between the server processes are also kept in shared memory (needs to happen before the modules are forked)
+    siaas_aux.init_local_state_store([os.path.join(
+        sys.path[0], 'var/config.db'), os.path.join(sys.path[0], 'var/platform.db'), os.path.join(sys.path[0], 'var/platform_history.db')])
+
     # Initializing local databases for configurations
     siaas_aux.write_to_local_file(
         os.path.join(sys.path[0], 'var/config.db'), {})
@@ -146,13 +152,30 @@ if __name__ == "__main__":
     siaas_aux.merge_configs_from_upstream(
         upstream_dict=siaas_aux.get_dict_current_server_configs(DB_COLLECTION_OBJ))
 
-    # Create MongoDB indexes
-    DB_COLLECTION_OBJ.create_index(
-        "origin", unique=False, name="agent_origin_index")
-    DB_COLLECTION_OBJ.create_index(
-        "destiny", unique=False, name="agent_destiny_index")
-    DB_COLLECTION_OBJ.create_index(
-        "timestamp", unique=False, name="agent_timestamp_index")
+    # Create MongoDB indexes and make sure queries are using them (the unique ones need duplicates left by older versions gone)
+    siaas_aux.remove_duplicate_agent_records(DB_COLLECTION_OBJ)
+    siaas_aux.create_mongodb_indexes(DB_COLLECTION_OBJ)
+    siaas_aux.check_mongodb_query_plans(DB_COLLECTION_OBJ)
+
+    # Agent data history might be stored in a time-series collection of its own
+    if not siaas_aux.create_history_timeseries_collection(DB_COLLECTION_OBJ):
+        logger.critical(
+            "Can't set up the time-series collection for the agent data history. Aborting !")
+        sys.exit(1)
+
+    # Build the current agent data snapshots if they don't exist yet (i.e. DB coming from an older version)
+    if DB_COLLECTION_OBJ.find_one({"scope": "agent_data_current"}) == None:
+        siaas_aux.rebuild_current_agent_data(DB_COLLECTION_OBJ)
+
+    # Same for the agent registry
+    if DB_COLLECTION_OBJ.find_one({"scope": "agent_registry"}) == None:
+        siaas_aux.rebuild_agent_registry(DB_COLLECTION_OBJ)
+
+    # And for the vulnerability index, which lives in a collection of its own
+    siaas_aux.create_mongodb_indexes(siaas_aux.get_vulns_collection(
+        DB_COLLECTION_OBJ), indexes=siaas_aux.MONGODB_VULNS_INDEXES, obsolete_indexes=[])
+    if siaas_aux.get_vulns_collection(DB_COLLECTION_OBJ).find_one() == None:
+        siaas_aux.rebuild_vulns_index(DB_COLLECTION_OBJ)
 
     print("\nSIAAS Server v"+SIAAS_VERSION +
           " starting ["+server_uid+"]\n\nLogging to: "+os.path.join(sys.path[0], log_file)+"\n")
@@ -170,6 +193,9 @@ if __name__ == "__main__":
 
     # give the modules some time to start before launching the API
     time.sleep(5)
+    siaas_ingest.start(DB_COLLECTION_OBJ)
+    # Queued agent data uploads are flushed before the API exits (the modules were forked already, so they keep their own handlers)
+    signal.signal(signal.SIGTERM, siaas_ingest.request_stop)
     app.register_blueprint(get_swaggerui_blueprint(SWAGGER_URL, SWAGGER_JSON_URL, config={
                            'app_name': SWAGGER_APP_NAME, 'validatorUrl': 'none'}), url_prefix=SWAGGER_URL)
     #app.run(debug=True, use_reloader=False, host="127.0.0.1", port=API_PORT)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+# Benchmark of the vulnerability report built from agent data (siaas_aux.grab_vulns_from_agent_data_dict), against the previous nested walk
+# Usage: python3 tests/benchmark_grab_vulns.py [number_of_agents] [number_of_workers]
+
+import copy
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import siaas_aux
+
+
+def legacy_grab_vulns(agent_data_dict, target_host=None, report_type="vuln_only"):
+    """
+    Previous version of the report (nested walk over the whole agent data), kept for comparison
+    Returns the vuln dict if all OK; Returns False if anything fails
+    """
+    if len(report_type or '') == 0:
+        report_type = "vuln_only"
+    new_dict = {}
+    try:
+        for a in agent_data_dict.keys():
+            for b in agent_data_dict[a].keys():
+                if b != "portscanner":
+                    continue
+                for c in agent_data_dict[a][b].keys():
+                    if len(target_host or '') > 0 and c not in target_host.split(','):
+                        continue
+                    if report_type.lower() == "all":
+                        new_dict.setdefault(a, {}).setdefault(b, {})[
+                            c] = agent_data_dict[a][b][c]
+                        continue
+                    for d in agent_data_dict[a][b][c].keys():
+                        if d == "last_check":
+                            new_dict.setdefault(a, {}).setdefault(b, {}).setdefault(
+                                c, {})["last_check"] = agent_data_dict[a][b][c]["last_check"]
+                        if d != "scanned_ports":
+                            continue
+                        for e in agent_data_dict[a][b][c][d].keys():
+                            for f in agent_data_dict[a][b][c][d][e].keys():
+                                if f != "scan_results":
+                                    continue
+                                for g in agent_data_dict[a][b][c][d][e][f].keys():
+                                    for h in agent_data_dict[a][b][c][d][e][f][g].keys():
+                                        if "vulners" not in h and "vulscan" not in h:
+                                            continue
+                                        if report_type.lower() == "exploit_vuln_only":
+                                            for i in agent_data_dict[a][b][c][d][e][f][g][h].keys():
+                                                for j in agent_data_dict[a][b][c][d][e][f][g][h][i].keys():
+                                                    if "siaas_exploit_tag" in agent_data_dict[a][b][c][d][e][f][g][h][i][j]:
+                                                        new_dict.setdefault(a, {}).setdefault(b, {}).setdefault(c, {}).setdefault(d, {}).setdefault(e, {}).setdefault(f, {}).setdefault(
+                                                            g, {}).setdefault(h, {}).setdefault(i, {})[j] = agent_data_dict[a][b][c][d][e][f][g][h][i][j]
+                                        else:  # default to vuln_only
+                                            new_dict.setdefault(a, {}).setdefault(b, {}).setdefault(c, {}).setdefault(d, {}).setdefault(
+                                                e, {}).setdefault(f, {}).setdefault(g, {})[h] = agent_data_dict[a][b][c][d][e][f][g][h]
+    except Exception:
+        return False
+    return new_dict
+
+
+def generate_fleet(number_of_agents):
+    """
+    Generates agent data for a fleet by scaling up the sample agent uploads in this folder: each agent gets a copy of one of them, in turn
+    Returns the agent data dict
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    samples = []
+    for f in ("data.json", "data2.json", "data3.json", "data4.json"):
+        with open(os.path.join(here, f)) as fp:
+            samples.append(json.load(fp))
+    fleet_dict = {}
+    for n in range(number_of_agents):
+        fleet_dict["agent-%05d" % n] = copy.deepcopy(
+            samples[n % len(samples)])
+    return fleet_dict
+
+
+def best_time(function, rounds=3):
+    """
+    Runs a function a few times
+    Returns the best time, in seconds
+    """
+    times = []
+    for r in range(rounds):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter()-start)
+    return min(times)
+
+
+if __name__ == "__main__":
+
+    number_of_agents = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    number_of_workers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    fleet_dict = generate_fleet(number_of_agents)
+
+    for report_type in ("all", "vuln_only", "exploit_vuln_only"):
+        old_dict = legacy_grab_vulns(fleet_dict, report_type=report_type)
+        new_dict = siaas_aux.grab_vulns_from_agent_data_dict(
+            fleet_dict, report_type=report_type)
+        if json.dumps(old_dict) != json.dumps(new_dict):
+            print("Report '%s' differs from the previous version!" %
+                  report_type)
+            sys.exit(1)
+
+    print("Agents: %d; Workers: %d" % (number_of_agents, number_of_workers))
+    for report_type in ("vuln_only", "exploit_vuln_only"):
+        old_time = best_time(lambda: legacy_grab_vulns(
+            fleet_dict, report_type=report_type))
+        new_time = best_time(lambda: siaas_aux.grab_vulns_from_agent_data_dict(
+            fleet_dict, report_type=report_type))
+        pool_time = best_time(lambda: siaas_aux.grab_vulns_from_agent_data_dict(
+            fleet_dict, report_type=report_type, workers=number_of_workers))
+        print("%-18s previous: %.3fs; now: %.3fs (%.1fx); with %d workers: %.3fs" % (
+            report_type, old_time, new_time, old_time/new_time, number_of_workers, pool_time))
@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+
+# Tests for siaas_aux (run with: python3 -m pytest tests)
+
+import calendar
+import json
+import os
+import struct
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+from bson.objectid import ObjectId
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import siaas_aux
+from benchmark_grab_vulns import generate_fleet, legacy_grab_vulns
+
+
+EDGE_CASES_AGENT_DATA = {
+    "agent-1": {
+        "platform": {"version": "1"},
+        "portscanner": {
+            "10.0.0.1": {"system_info": {"os": "Linux"}},  # no last check nor findings
+            "10.0.0.2": {"last_check": None, "scanned_ports": {}},
+            "10.0.0.3": {  # findings come before the last check
+                "scanned_ports": {"22/tcp": {"scan_results": {"vuln": {"vulners": {"cpe:/a:openbsd:openssh": {"CVE-1": "5.0 *EXPLOIT* siaas_exploit_tag", "CVE-2": "4.0"}}}}}},
+                "last_check": "2024-01-01T00:00:00Z"
+            },
+            "10.0.0.4": {  # empty and non-dict script results, and no last check
+                "scanned_ports": {
+                    "80/tcp": {"scan_results": {"vuln": {"vulners": {}, "http-vulners-regex": "ERROR: Script execution failed", "http-title": {"title": "t"}}}},
+                    "443/tcp": {"service": "https"}
+                }
+            }
+        }
+    },
+    "agent-2": {"portscanner": {"10.0.0.9": {"system_info": {}}}},
+    "agent-3": {"platform": {"version": "1"}}
+}
+
+
+def test_grab_vulns_edge_cases_match_legacy():
+    for report_type in ("all", "vuln_only"):
+        for target_host in (None, "10.0.0.1,10.0.0.4", "10.0.0.3"):
+            assert json.dumps(siaas_aux.grab_vulns_from_agent_data_dict(EDGE_CASES_AGENT_DATA, target_host=target_host, report_type=report_type)) == json.dumps(
+                legacy_grab_vulns(EDGE_CASES_AGENT_DATA, target_host=target_host, report_type=report_type))
+
+
+def test_grab_vulns_edge_cases_vuln_only():
+    vulns_dict = siaas_aux.grab_vulns_from_agent_data_dict(
+        EDGE_CASES_AGENT_DATA, report_type="vuln_only")
+    assert list(vulns_dict.keys()) == ["agent-1"]
+    hosts_dict = vulns_dict["agent-1"]["portscanner"]
+    assert "10.0.0.1" not in hosts_dict
+    assert hosts_dict["10.0.0.2"] == {"last_check": None}
+    assert list(hosts_dict["10.0.0.3"].keys()) == ["scanned_ports", "last_check"]
+    assert hosts_dict["10.0.0.4"]["scanned_ports"]["80/tcp"]["scan_results"]["vuln"] == {
+        "vulners": {}, "http-vulners-regex": "ERROR: Script execution failed"}
+
+
+def test_grab_vulns_edge_cases_exploit_vuln_only():
+    # The previous version failed on non-dict script results, so only the outcome is checked here
+    vulns_dict = siaas_aux.grab_vulns_from_agent_data_dict(
+        EDGE_CASES_AGENT_DATA, report_type="exploit_vuln_only")
+    assert vulns_dict == {"agent-1": {"portscanner": {
+        "10.0.0.2": {"last_check": None},
+        "10.0.0.3": {"scanned_ports": {"22/tcp": {"scan_results": {"vuln": {"vulners": {"cpe:/a:openbsd:openssh": {"CVE-1": "5.0 *EXPLOIT* siaas_exploit_tag"}}}}}}, "last_check": "2024-01-01T00:00:00Z"}
+    }}}
+
+
+def test_grab_vulns_fleet_matches_legacy():
+    fleet_dict = generate_fleet(8)
+    for report_type in ("all", "vuln_only", "exploit_vuln_only"):
+        for target_host in (None, "192.168.122.1,216.58.215.174"):
+            expected = json.dumps(legacy_grab_vulns(
+                fleet_dict, target_host=target_host, report_type=report_type))
+            assert json.dumps(siaas_aux.grab_vulns_from_agent_data_dict(
+                fleet_dict, target_host=target_host, report_type=report_type)) == expected
+            assert json.dumps(siaas_aux.grab_vulns_from_agent_data_dict(
+                fleet_dict, target_host=target_host, report_type=report_type, workers=2)) == expected
+
+
+def test_parse_json_pointer():
+    assert siaas_aux.parse_json_pointer("") == []
+    assert siaas_aux.parse_json_pointer("/a~1b/c~0d/~01") == ["a/b", "c~d", "~1"]
+    assert siaas_aux.parse_json_pointer("a/b") == None
+    assert siaas_aux.parse_json_pointer(None) == None
+
+
+def test_apply_json_patch():
+    document = {"a": {"b": [1, 2]}, "x/y": 1, "m~n": 2}
+    patched = siaas_aux.apply_json_patch(document, [
+        {"op": "add", "path": "/a/b/-", "value": 3},
+        {"op": "add", "path": "/a/b/0", "value": 0},
+        {"op": "replace", "path": "/x~1y", "value": 10},
+        {"op": "move", "from": "/m~0n", "path": "/a/c"},
+        {"op": "copy", "from": "/a/b", "path": "/d"},
+        {"op": "test", "path": "/d/3", "value": 3}
+    ])
+    assert patched == {"a": {"b": [0, 1, 2, 3], "c": 2},
+                       "x/y": 10, "d": [0, 1, 2, 3]}
+    # The document itself is not changed
+    assert document == {"a": {"b": [1, 2]}, "x/y": 1, "m~n": 2}
+
+
+def test_apply_json_patch_failures():
+    document = {"a": {"b": [1, 2]}}
+    # Patches are atomic: a failed test (or any other failed operation) applies nothing
+    assert siaas_aux.apply_json_patch(document, [{"op": "remove", "path": "/a/b/0"}, {
+                                      "op": "test", "path": "/a/b/0", "value": 1}]) == None
+    assert siaas_aux.apply_json_patch(
+        document, [{"op": "move", "from": "/a", "path": "/a/c"}]) == None
+    assert siaas_aux.apply_json_patch(
+        document, [{"op": "add", "path": "/a/b/3", "value": 3}]) == None
+    assert siaas_aux.apply_json_patch(
+        document, [{"op": "remove", "path": "/a/b/01"}]) == None
+    assert siaas_aux.apply_json_patch(
+        document, [{"op": "remove", "path": "/z"}]) == None
+    assert siaas_aux.apply_json_patch(
+        document, [{"op": "unknown", "path": "/a"}]) == None
+    assert siaas_aux.apply_json_patch(document, {"op": "remove", "path": "/a"}) == None
+    assert document == {"a": {"b": [1, 2]}}
+
+
+def test_build_agent_data_record_from_patch():
+    mongomock = pytest.importorskip("mongomock")
+    collection = mongomock.MongoClient().db.patch_records
+    stored = siaas_aux.build_agent_data_record(
+        agent_uid="a", data_dict={"config": {"a": "1"}})
+    siaas_aux.store_agent_data_records(collection, [stored])
+    base_id = str(stored["_id"])
+    record, error = siaas_aux.build_agent_data_record_from_patch(
+        collection, agent_uid="a", patch=[{"op": "replace", "path": "/config/a", "value": "2"}], base_id=base_id)
+    assert error == None
+    assert record["payload"] == {"config": {"a": "2"}}
+    # Bad requests, bad patches and stale bases are told apart
+    assert siaas_aux.build_agent_data_record_from_patch(
+        collection, agent_uid="a", patch=[], base_id="not-an-id") == (None, "invalid")
+    assert siaas_aux.build_agent_data_record_from_patch(
+        collection, agent_uid="a", patch=[], base_id=str(ObjectId())) == (None, "conflict")
+    assert siaas_aux.build_agent_data_record_from_patch(collection, agent_uid="a", patch=[
+                                                        {"op": "test", "path": "/config/a", "value": "2"}], base_id=base_id) == (None, "unprocessable")
+    assert siaas_aux.build_agent_data_record_from_patch(collection, agent_uid="a", patch=[
+                                                        {"op": "add", "path": "/bad key$", "value": 1}], base_id=base_id) == (None, "unprocessable")
+
+
+def test_page_tokens():
+    page = {"id": "0123456789abcdef01234567", "older": 0,
+            "ts": "2024-01-01T00:00:00"}
+    page_token = siaas_aux.encode_page_token(page)
+    assert "=" not in page_token
+    assert siaas_aux.decode_page_token(page_token) == page
+    assert siaas_aux.decode_page_token(page_token[:-3]) == None
+    assert siaas_aux.decode_page_token("garbage!") == None
+    assert siaas_aux.decode_page_token(
+        siaas_aux.encode_page_token(["0123456789abcdef01234567"])) == None
+    assert siaas_aux.decode_page_token(
+        siaas_aux.encode_page_token({"id": "not-an-id", "older": 0})) == None
+
+
+def test_history_page_token_direction():
+    mongomock = pytest.importorskip("mongomock")
+    collection = mongomock.MongoClient().db.page_tokens
+    collection.insert_many([{"scope": "agent_data", "origin": "agent_a%d" % n, "destiny": "server", "payload": {
+                           "config": {"n": n}}, "timestamp": datetime.utcnow()} for n in range(3)])
+    output, page_token = siaas_aux.get_dict_history_agent_data(
+        collection, limit_outputs=2, paginate=True)
+    assert page_token != None
+    # A token from a listing in the other direction is stale for this one
+    assert siaas_aux.get_dict_history_agent_data(
+        collection, limit_outputs=2, older_first=True, page_token=page_token, paginate=True) == (False, None)
+    output, page_token = siaas_aux.get_dict_history_agent_data(
+        collection, limit_outputs=2, page_token=page_token, paginate=True)
+    assert page_token == None
+    assert sum([len(v) for v in output.values()]) == 1
+
+
+def test_store_agent_data_records_seen_again():
+    mongomock = pytest.importorskip("mongomock")
+    collection = mongomock.MongoClient().db.store_seen_again
+    first = siaas_aux.build_agent_data_record(
+        agent_uid="a", data_dict={"config": {"a": "1"}}, orig_ip="10.0.0.1")
+    assert siaas_aux.store_agent_data_records(collection, [first]) == [True]
+    again = [siaas_aux.build_agent_data_record(
+        agent_uid="a", data_dict={"config": {"a": "1"}}, orig_ip="10.0.0.2") for n in range(2)]
+    assert siaas_aux.store_agent_data_records(collection, again) == [True, True]
+    # The history keeps a single record for the run, seen three times
+    history = list(collection.find({"scope": "agent_data"}))
+    assert [r["_id"] for r in history] == [first["_id"]]
+    assert history[0]["seen_count"] == 3
+    assert history[0]["last_seen"] == again[1]["timestamp"]
+    assert history[0]["orig_ip"] == "10.0.0.2"
+    current = collection.find_one({"scope": "agent_data_current"})
+    assert current["data_id"] == again[1]["_id"]
+    assert current["history_id"] == first["_id"]
+    # A changed payload starts a new run
+    changed = siaas_aux.build_agent_data_record(
+        agent_uid="a", data_dict={"config": {"a": "2"}})
+    assert siaas_aux.store_agent_data_records(collection, [changed]) == [True]
+    assert collection.count_documents({"scope": "agent_data"}) == 2
+    assert collection.find_one({"scope": "agent_data_current"})[
+        "history_id"] == changed["_id"]
+
+
+def test_store_agent_data_records_history_missing():
+    mongomock = pytest.importorskip("mongomock")
+    collection = mongomock.MongoClient().db.store_history_missing
+    first = siaas_aux.build_agent_data_record(
+        agent_uid="a", data_dict={"config": {"a": "1"}})
+    siaas_aux.store_agent_data_records(collection, [first])
+    # The history record of the run is gone (i.e. deleted by the DB maintenance)
+    collection.delete_one({"_id": first["_id"]})
+    again = [siaas_aux.build_agent_data_record(
+        agent_uid="a", data_dict={"config": {"a": "1"}}) for n in range(3)]
+    assert siaas_aux.store_agent_data_records(
+        collection, again) == [True, True, True]
+    # Uploads of the same snapshot in the batch are stored again as a single record
+    history = list(collection.find({"scope": "agent_data"}))
+    assert [r["_id"] for r in history] == [again[0]["_id"]]
+    assert history[0]["seen_count"] == 3
+    assert history[0]["last_seen"] == again[2]["timestamp"]
+    assert "history_id" not in history[0].keys()
+    current = collection.find_one({"scope": "agent_data_current"})
+    assert current["history_id"] == again[0]["_id"]
+    assert current["data_id"] == again[2]["_id"]
+
+
+def test_store_agent_data_records_results():
+    mongomock = pytest.importorskip("mongomock")
+    collection = mongomock.MongoClient().db.store_results
+    stored = siaas_aux.build_agent_data_record(
+        agent_uid="a", data_dict={"config": {"a": "1"}})
+    siaas_aux.store_agent_data_records(collection, [stored])
+    # A new record whose insertion fails (same ID as a stored one) fails alone, and the others are stored
+    duplicate = siaas_aux.build_agent_data_record(
+        agent_uid="b", data_dict={"config": {"b": "1"}})
+    duplicate["_id"] = stored["_id"]
+    records = [siaas_aux.build_agent_data_record(agent_uid="a", data_dict={"config": {"a": "1"}}), duplicate,
+               siaas_aux.build_agent_data_record(agent_uid="c", data_dict={"config": {"c": "1"}})]
+    assert siaas_aux.store_agent_data_records(
+        collection, records) == [True, False, True]
+    assert sorted([r["origin"] for r in collection.find(
+        {"scope": "agent_data_current"})]) == ["agent_a", "agent_c"]
+    # The records received are not changed
+    assert "history_id" not in records[0].keys()
+    assert siaas_aux.store_agent_data_records(collection, []) == []
+
+
+def test_current_agent_data_not_rolled_back():
+    mongomock = pytest.importorskip("mongomock")
+    collection = mongomock.MongoClient().db.current_order
+    assert siaas_aux.create_mongodb_indexes(collection) == True
+    older, newer = [siaas_aux.build_agent_data_record(
+        agent_uid="a", data_dict={"config": {"n": str(n)}}) for n in range(2)]
+    # Concurrent uploads of the same agent can reach the DB in any order
+    assert siaas_aux.update_current_agent_data(collection, [newer]) == True
+    assert siaas_aux.update_current_agent_data(collection, [older]) == True
+    current = list(collection.find({"scope": "agent_data_current"}))
+    assert [r["data_id"] for r in current] == [newer["_id"]]
+    registry = list(collection.find({"scope": "agent_registry"}))
+    assert [r["last_seen"] for r in registry] == [newer["timestamp"]]
+    # Seen again, with an older data ID
+    older["history_id"] = newer["_id"]
+    assert siaas_aux.update_current_agent_data(collection, [older]) == True
+    assert collection.find_one({"scope": "agent_data_current"})[
+        "data_id"] == newer["_id"]
+
+
+def test_remove_duplicate_agent_records():
+    mongomock = pytest.importorskip("mongomock")
+    collection = mongomock.MongoClient().db.current_duplicates
+    older, newer = [ObjectId() for n in range(2)]
+    collection.insert_many([{"scope": "agent_data_current", "origin": "agent_a", "data_id": newer}, {"scope": "agent_data_current", "origin": "agent_a", "data_id": older},
+                            {"scope": "agent_registry", "origin": "agent_a", "last_seen": datetime(2024, 1, 2)}, {
+                                "scope": "agent_registry", "origin": "agent_a", "last_seen": datetime(2024, 1, 1)},
+                            {"scope": "agent_data_current", "origin": "agent_b", "data_id": older}])
+    assert siaas_aux.remove_duplicate_agent_records(collection) == 2
+    assert [r["data_id"] for r in collection.find(
+        {"scope": "agent_data_current", "origin": "agent_a"})] == [newer]
+    assert [r["last_seen"] for r in collection.find(
+        {"scope": "agent_registry"})] == [datetime(2024, 1, 2)]
+    assert siaas_aux.create_mongodb_indexes(collection) == True
+    assert siaas_aux.remove_duplicate_agent_records(collection) == 0
+
+
+def test_upload_agent_data_bulk():
+    mongomock = pytest.importorskip("mongomock")
+    collection = mongomock.MongoClient().db.upload_bulk
+    results = siaas_aux.upload_agent_data_bulk(collection, entries=[{"agent_uid": "a", "payload": {
+                                               "config": {"a": "1"}}}, {"agent_uid": "bad uid$", "payload": {}}, "not an entry"])
+    assert [r["status"] for r in results] == ["success", "failure", "failure"]
+    assert collection.count_documents({"scope": "agent_data"}) == 1
+    # Bodies that are not lists are rejected as a whole
+    for entries in (5, {"agent_uid": "a"}, "entries"):
+        assert siaas_aux.upload_agent_data_bulk(
+            collection, entries=entries) == False
+    assert siaas_aux.upload_agent_data_bulk(collection) == []
+
+
+def test_history_move_to_timeseries_retried(monkeypatch):
+    mongomock = pytest.importorskip("mongomock")
+    database = mongomock.MongoClient().db
+    collection = database.history_move
+    monkeypatch.setattr(siaas_aux, "get_config_from_configs_db", lambda config_name=None, **kwargs: "true" if config_name ==
+                        "mongo_history_timeseries" else None)
+    records = [siaas_aux.build_agent_data_record(agent_uid="agent-%d" % (n % 2), data_dict={
+                                                 "config": {"n": str(n)}}) for n in range(5)]
+    collection.insert_many([dict(r) for r in records])
+    # A previous run was interrupted after inserting its first records in the time-series collection, but before deleting them here
+    # (mongomock can't create time-series collections, so a regular one stands in for it)
+    database.history_move_history.insert_many([dict(r) for r in records[:2]])
+    assert siaas_aux.create_history_timeseries_collection(
+        collection, batch_size=3) == True
+    assert sorted([r["_id"] for r in database.history_move_history.find()]) == sorted(
+        [r["_id"] for r in records])
+    assert collection.count_documents({"scope": "agent_data"}) == 0
+
+
+def test_generate_vulns_from_portscanner():
+    vulns = list(siaas_aux.generate_vulns_from_portscanner(
+        EDGE_CASES_AGENT_DATA["agent-1"]["portscanner"]))
+    assert [(v["type"], v["target_host"]) for v in vulns] == [("host", "10.0.0.1"), ("host", "10.0.0.2"), (
+        "vuln", "10.0.0.3"), ("vuln", "10.0.0.3"), ("host", "10.0.0.3"), ("host", "10.0.0.4")]
+    assert "last_check" not in vulns[0]
+    assert vulns[2] == {"type": "vuln", "target_host": "10.0.0.3", "port": "22/tcp", "scan": "vuln", "script": "vulners", "source": "vulners", "group": "cpe:/a:openbsd:openssh",
+                        "last_check": "2024-01-01T00:00:00Z", "vuln_id": "CVE-1", "details": "5.0 *EXPLOIT* siaas_exploit_tag", "exploit": True}
+    assert vulns[3]["exploit"] == False
+    assert [v["vuln_id"] for v in siaas_aux.generate_vulns_from_portscanner(
+        EDGE_CASES_AGENT_DATA["agent-1"]["portscanner"], exploit_only=True) if v["type"] == "vuln"] == ["CVE-1"]
+    assert list(siaas_aux.generate_vulns_from_portscanner(None)) == []
+
+
+def get_old_object_id(date):
+    """
+    Returns a new ObjectId as if it had been generated at the given (UTC) date
+    """
+    return ObjectId(struct.pack(">I", calendar.timegm(date.timetuple()))+os.urandom(8))
+
+
+def test_history_runs_expire_by_last_seen():
+    mongomock = pytest.importorskip("mongomock")
+    collection = mongomock.MongoClient().db.history_runs
+    old = datetime.utcnow().replace(microsecond=0) - timedelta(days=3)
+    # An agent that keeps uploading the same data since 3 days ago, and one that stopped uploading then
+    active = siaas_aux.build_agent_data_record(
+        agent_uid="active", data_dict={"config": {"a": "1"}})
+    siaas_aux.store_agent_data_records(collection, [active])
+    collection.update_one({"_id": active["_id"]}, {
+                          "$set": {"timestamp": old, "first_seen": old}})
+    siaas_aux.store_agent_data_records(collection, [siaas_aux.build_agent_data_record(
+        agent_uid="active", data_dict={"config": {"a": "1"}})])
+    collection.insert_one({"_id": get_old_object_id(old), "scope": "agent_data", "origin": "agent_stopped", "destiny": "server",
+                           "payload": {"config": {"b": "2"}}, "timestamp": old, "first_seen": old, "last_seen": old, "seen_count": 1})
+    assert collection.count_documents({"scope": "agent_data"}) == 2
+
+    assert list(siaas_aux.get_dict_history_agent_data(
+        collection, days=1, sort_by="agent").keys()) == ["active"]
+    assert siaas_aux.delete_agent_data_in_batches(
+        collection, days_to_keep=1) == 1
+    assert [r["origin"] for r in collection.find(
+        {"scope": "agent_data"})] == ["agent_active"]
+    assert siaas_aux.delete_all_records_older_than(
+        collection, scope="agent_data", days_to_keep=1) == 0
+    assert collection.count_documents({"scope": "agent_data"}) == 1
+
+
+def test_history_ttl_index_on_last_seen():
+    mongomock = pytest.importorskip("mongomock")
+    collection = mongomock.MongoClient().db.history_ttl
+    collection.insert_one({"scope": "agent_data", "origin": "agent_legacy", "payload": {
+    }, "timestamp": datetime(2030, 1, 1)})
+    collection.create_index([("timestamp", 1)], name="agent_data_ttl_index",
+                            expireAfterSeconds=86400, partialFilterExpression={"scope": "agent_data"})
+    assert siaas_aux.set_history_ttl(collection, days_to_keep=14) == True
+    ttl_index = collection.index_information()["agent_data_ttl_index"]
+    assert ttl_index["key"] == [("last_seen", 1)]
+    assert ttl_index["expireAfterSeconds"] == 14*86400
+    # Records from older versions get a last seen time, so they expire too
+    assert collection.find_one({"origin": "agent_legacy"})[
+        "last_seen"] == datetime(2030, 1, 1)
+    assert siaas_aux.set_history_ttl(collection, days_to_keep=None) == True
+    assert "agent_data_ttl_index" not in collection.index_information().keys()
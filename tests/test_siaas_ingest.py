@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+
+# Tests for siaas_ingest (run with: python3 -m pytest tests)
+
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import siaas_aux
+import siaas_ingest
+
+
+def test_stop_flushes_queue_and_batch_in_hand():
+    mongomock = pytest.importorskip("mongomock")
+    collection = mongomock.MongoClient().db.ingest_stop
+    assert siaas_ingest.start(collection) == True
+    records = [siaas_aux.build_agent_data_record(
+        agent_uid="agent-%d" % n, data_dict={"config": {"n": str(n)}}) for n in range(5)]
+    assert siaas_ingest.enqueue(records[0]) == True
+    # Let the writer thread take the first record, so it holds a batch that is still waiting to fill up
+    deadline = time.monotonic() + 5
+    while siaas_ingest.INGEST_QUEUE.qsize() > 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    for r in records[1:]:
+        assert siaas_ingest.enqueue(r) == True
+    siaas_ingest.stop()
+    assert not siaas_ingest.INGEST_THREAD.is_alive()
+    assert sorted([r["_id"] for r in collection.find({"scope": "agent_data"})]) == sorted(
+        [r["_id"] for r in records])
+    # Uploads are rejected once the queue is stopping
+    assert siaas_ingest.enqueue(siaas_aux.build_agent_data_record(
+        agent_uid="late", data_dict={})) == False
+    assert siaas_ingest.get_metrics()["rejected_total"] == 1
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+# Tests for siaas_mailer (run with: python3 -m pytest tests)
+
+import gzip
+import io
+import os
+import sys
+import zipfile
+from datetime import datetime
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import siaas_aux
+import siaas_mailer
+from benchmark_grab_vulns import generate_fleet
+
+
+# Only one in four sample agents has portscanner data (3 hosts)
+VULNS_DICT = {a: {"portscanner": v["portscanner"]}
+              for a, v in generate_fleet(20).items()}
+
+
+def get_report_lines(attachments, compression=None):
+    """
+    Returns the header and the (other) lines of each attachment of a report, after decompressing them
+    """
+    parts = []
+    for name, data in attachments:
+        if compression == "gzip":
+            data = gzip.decompress(data)
+        elif compression == "zip":
+            with zipfile.ZipFile(io.BytesIO(data)) as z:
+                data = z.read(z.namelist()[0])
+        lines = data.decode('utf-8').splitlines(keepends=True)
+        parts.append((lines[0], lines[1:]))
+    return parts
+
+
+def test_build_csv_report():
+    attachments = siaas_mailer.build_csv_report(VULNS_DICT, "report.csv")
+    assert [a[0] for a in attachments] == ["report.csv"]
+    header, lines = get_report_lines(attachments)[0]
+    assert header == "AgentUID;TargetHost;InformationType;Findings\r\n"
+    # One line per host and information type (last check, system info, scanned ports)
+    assert len(lines) == 5*3*3
+    assert lines[0].startswith("agent-00003;192.168.122.1;system_info;")
+
+
+def test_build_csv_report_split():
+    whole = b''.join(
+        [a[1] for a in siaas_mailer.build_csv_report(VULNS_DICT, "report.csv")])
+    max_bytes = len(whole)//4
+    attachments = siaas_mailer.build_csv_report(
+        VULNS_DICT, "report.csv", max_bytes=max_bytes)
+    assert len(attachments) > 1
+    assert [a[0] for a in attachments] == ["report_part%d.csv" %
+                                           (n+1) for n in range(len(attachments))]
+    assert max([len(a[1]) for a in attachments]) <= max_bytes
+    parts = get_report_lines(attachments)
+    header, lines = get_report_lines([("report.csv", whole)])[0]
+    assert set([p[0] for p in parts]) == set([header])
+    assert [l for p in parts for l in p[1]] == lines
+
+
+def test_build_csv_report_compressed_split():
+    header, lines = get_report_lines(
+        siaas_mailer.build_csv_report(VULNS_DICT, "report.csv"))[0]
+    for compression, extension in (("gzip", ".gz"), ("zip", ".zip")):
+        whole = siaas_mailer.build_csv_report(
+            VULNS_DICT, "report.csv", compression=compression)
+        assert [a[0] for a in whole] == ["report.csv"+extension]
+        max_bytes = len(whole[0][1])//2
+        attachments = siaas_mailer.build_csv_report(
+            VULNS_DICT, "report.csv", compression=compression, max_bytes=max_bytes)
+        assert len(attachments) > 1
+        assert attachments[0][0] == "report_part1.csv"+extension
+        assert max([len(a[1]) for a in attachments]) <= max_bytes
+        parts = get_report_lines(attachments, compression=compression)
+        assert [l for p in parts for l in p[1]] == lines
+
+
+def test_build_csv_report_line_over_limit():
+    # A line larger than the limit still goes in a part of its own
+    attachments = siaas_mailer.build_csv_report(
+        VULNS_DICT, "report.csv", max_bytes=100)
+    parts = get_report_lines(attachments)
+    assert len(parts) == 5*3*3
+    assert set([len(p[1]) for p in parts]) == set([1])
+
+
+def test_build_csv_report_empty():
+    attachments = siaas_mailer.build_csv_report({}, "report.csv", max_bytes=10)
+    assert get_report_lines(attachments) == [
+        ("AgentUID;TargetHost;InformationType;Findings\r\n", [])]
+
+
+def test_mailer_state_round_trip():
+    mongomock = pytest.importorskip("mongomock")
+    collection = mongomock.MongoClient().db.mailer_state
+    assert siaas_aux.read_mailer_state(collection) == None
+    state = {"report_type": "vuln_only", "high_water": datetime(2024, 1, 1, 12, 0, 0), "sent_digest": "abc", "sent_time": "2024-01-01T12:00:00Z",
+             "agents": {"agent.1": {"payload_hash": "h1", "vulns": {"x": 1}, "digest": "d1"}, "agent$2": {"payload_hash": "h2", "vulns": {}, "digest": "d2"}}}
+    assert siaas_aux.write_mailer_state(collection, state) == True
+    # Findings are not persisted, so they come back as None (and are loaded again when needed)
+    assert siaas_aux.read_mailer_state(collection) == {"report_type": "vuln_only", "high_water": datetime(2024, 1, 1, 12, 0, 0), "sent_digest": "abc", "sent_time": "2024-01-01T12:00:00Z",
+                                                      "agents": {"agent.1": {"payload_hash": "h1", "vulns": None, "digest": "d1"}, "agent$2": {"payload_hash": "h2", "vulns": None, "digest": "d2"}}}
+    state["agents"].pop("agent.1")
+    assert siaas_aux.write_mailer_state(collection, state) == True
+    assert list(siaas_aux.read_mailer_state(collection)["agents"].keys()) == ["agent$2"]
+    assert collection.count_documents({"scope": "mailer_state"}) == 1
+    collection.update_one({"scope": "mailer_state"}, {
+                          "$set": {"payload.high_water": "not a date"}})
+    assert siaas_aux.read_mailer_state(collection) == None